@@ -1,49 +1,192 @@
 import pandas as pd
 import os
-from PIL import Image
+import sys
+import math
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import tifffile as tf
 
-# Function to align the major axis of an image
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import stage
+
+ORIENTATION_COLUMN = 'Mean_IdentifyPrimaryObjects_AreaShape_Orientation'  # Update with the actual column name
+
+# Function to compute the transform of PIL's Image.rotate(angle_degrees, expand=True): the size of the
+# expanded canvas and the affine matrix mapping output pixel edges back to the input, computed with PIL's
+# arithmetic so that the canvas size and the sampled pixels are the ones PIL produces
+def rotation_transform(width, height, angle_degrees):
+    angle = angle_degrees % 360.0
+    theta = -math.radians(angle)
+    matrix = [round(math.cos(theta), 15), round(math.sin(theta), 15), 0.0,
+              round(-math.sin(theta), 15), round(math.cos(theta), 15), 0.0]
+
+    def transform(x, y):
+        a, b, c, d, e, f = matrix
+        return a * x + b * y + c, d * x + e * y + f
+
+    center_x, center_y = width / 2, height / 2
+    matrix[2], matrix[5] = transform(-center_x, -center_y)
+    matrix[2] += center_x
+    matrix[5] += center_y
+
+    if angle in (0, 180):
+        new_width, new_height = width, height
+    elif angle in (90, 270):
+        # PIL transposes the image for quarter turns, without expanding the canvas
+        new_width, new_height = height, width
+    else:
+        xs, ys = zip(*(transform(x, y) for x, y in ((0, 0), (width, 0), (width, height), (0, height))))
+        new_width = math.ceil(max(xs)) - math.floor(min(xs))
+        new_height = math.ceil(max(ys)) - math.floor(min(ys))
+    matrix[2], matrix[5] = transform(-(new_width - width) / 2.0, -(new_height - height) / 2.0)
+    return np.array(matrix).reshape(2, 3), new_width, new_height
+
+# Function to check whether PIL can sample with a matrix in 16.16 fixed point
+def fits_fixed_point(matrix, width, height, new_width, new_height):
+    return all(np.all(np.abs(matrix @ [x, y, 1]) < 32768.0) for x, y in ((new_width, new_height), (width, height)))
+
+# Function to rotate an image like PIL's Image.rotate(angle_degrees, expand=True) with nearest neighbour sampling
+def rotate_expand(image, angle_degrees):
+    height, width = image.shape[:2]
+    matrix, new_width, new_height = rotation_transform(width, height, angle_degrees)
+    quarter_turns = (angle_degrees % 360.0) / 90
+    if quarter_turns in (0, 1, 2, 3):
+        return np.rot90(image, int(quarter_turns)).copy(), matrix
+
+    # Sample every output pixel at the input position its centre maps to, rounded down as PIL does
+    (a, b, c), (d, e, f) = matrix
+    x_out = np.arange(new_width)
+    y_out = np.arange(new_height)[:, None]
+    if image.dtype == np.uint16 or not fits_fixed_point(matrix, width, height, new_width, new_height):
+        # PIL samples 16-bit images (and large images) in floating point
+        x_in = a * (x_out + 0.5) + b * (y_out + 0.5) + c
+        y_in = d * (x_out + 0.5) + e * (y_out + 0.5) + f
+    else:
+        # and other images in 16.16 fixed point
+        def fixed(value):
+            return math.floor(value * 65536.0 + 0.5)
+        x_in = (fixed(c + a * 0.5 + b * 0.5) + y_out * fixed(b) + x_out * fixed(a)) >> 16
+        y_in = (fixed(f + d * 0.5 + e * 0.5) + y_out * fixed(e) + x_out * fixed(d)) >> 16
+    inside = (x_in >= 0) & (x_in < width) & (y_in >= 0) & (y_in < height)
+    rotated = np.zeros((new_height, new_width) + image.shape[2:], dtype=image.dtype)
+    rotated[inside] = image[y_in[inside].astype(np.intp), x_in[inside].astype(np.intp)]
+    return rotated, matrix
+
+# Function to convert the output-to-input matrix of rotation_transform, which works on pixel edges, into the
+# matrix mapping pixel positions (x, y) of the original image to the aligned image
+def forward_matrix(matrix):
+    linear = matrix[:, :2]
+    # Pixel positions are pixel edges minus one half
+    translation = linear @ [0.5, 0.5] + matrix[:, 2] - 0.5
+    inverse = np.linalg.inv(linear)
+    return np.hstack([inverse, (-inverse @ translation)[:, None]])
+
+# Function to read alignment_transforms.csv with one row per cell, joined to the padding_offsets.csv that
+# PadExtractedTiffs writes next to the padded images if it is given
+def read_transforms(transforms_path, padding_path=None):
+    transforms = pd.read_csv(transforms_path)
+    if padding_path is not None:
+        padding = pd.read_csv(padding_path, usecols=['file', 'padded_file', 'pad_x', 'pad_y'])
+        transforms = transforms.merge(padding, left_on='aligned_filename', right_on='file', how='left')
+        transforms = transforms.drop(columns='file')
+    return transforms
+
+# Function to map (x, y) positions in an aligned image back to the original extracted image.
+# If the transform carries pad_x and pad_y (read_transforms with padding_offsets.csv), the positions
+# are taken in the padded image instead.
+def map_to_original(points, transform):
+    matrix = np.array([[transform['m00'], transform['m01'], transform['m02']],
+                       [transform['m10'], transform['m11'], transform['m12']]])
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if 'pad_x' in transform and 'pad_y' in transform:
+        points = points - [transform['pad_x'], transform['pad_y']]
+    inverse = np.linalg.inv(matrix[:, :2])
+    return (points - matrix[:, 2]) @ inverse.T
+
+# Function to align the major axis of an image and return the transform that was applied
 def align_major_axis(image_path, orientation_angle):
-    # Open the image file
-    with Image.open(image_path) as img:
-        # Rotate the image to align the major axis upright
-        rotated_img = img.rotate(-np.degrees(orientation_angle), expand=True)
-        # Save the rotated image with "_aligned" appended to the original filename
-        rotated_img.save(image_path[:-4] + "_aligned.tif")
-
-# Replace the directory paths with the paths where the CSV that was converted from the SQLite database and the extracted TIFF files are stored
-csv_directory = './experiment/extracted/csv'  
-tif_directory = './experiment/extracted/tif'  
-
-# Iterate over all CSV files in the given directory
-for csv_file in os.listdir(csv_directory):
-    if csv_file.endswith(".csv"):
-        csv_path = os.path.join(csv_directory, csv_file)
-        # Read the CSV file into a DataFrame
-        df = pd.read_csv(csv_path)
-
-        # Remove the file extension to create a base filename
-        base_filename = os.path.splitext(csv_file)[0]
-
-        # Iterate over each row in the DataFrame
-        for _, row in df.iterrows():
-            # Extract the orientation and handle NaN values
-            orientation = row['Mean_IdentifyPrimaryObjects_AreaShape_Orientation']  # Update with the actual column name
-            if np.isnan(orientation):
-                print(f"Skipped {base_filename}_cell_{int(row['ImageNumber'])}.tif due to NaN orientation.")
-                continue
-
-            # Construct the image filename and path
-            image_filename = f"{base_filename}_cell_{int(row['ImageNumber'])}.tif"
-            image_path = os.path.join(tif_directory, image_filename)
-
-            # Check if the image file exists and align it if it does
-            if os.path.exists(image_path):
-                align_major_axis(image_path, orientation)
-            else:
-                # Log an error if the image file does not exist
-                print(f"Image not found: {image_path}")
-
-# Indicate that the process is complete
-print("Process completed!")
+    image = tf.imread(image_path)
+    height, width = image.shape[:2]
+    # Rotate the image to align the major axis upright
+    angle_degrees = -np.degrees(orientation_angle)
+    rotated, matrix = rotate_expand(image, angle_degrees)
+    matrix = forward_matrix(matrix)
+    # Save the rotated image with "_aligned" appended to the original filename
+    aligned_path = image_path[:-4] + "_aligned.tif"
+    tf.imwrite(aligned_path, rotated)
+    return {
+        'image_filename': os.path.basename(image_path),
+        'aligned_filename': os.path.basename(aligned_path),
+        'angle_degrees': angle_degrees,
+        'width': width,
+        'height': height,
+        'aligned_width': rotated.shape[1],
+        'aligned_height': rotated.shape[0],
+        'm00': matrix[0, 0], 'm01': matrix[0, 1], 'm02': matrix[0, 2],
+        'm10': matrix[1, 0], 'm11': matrix[1, 1], 'm12': matrix[1, 2],
+    }
+
+def _align_chunk(tasks):
+    return [align_major_axis(image_path, orientation) for image_path, orientation in tasks]
+
+# Function to join every orientation table to the extracted images found on disk
+def build_alignment_table(csv_directory, tif_directory):
+    tables = []
+    for csv_file in sorted(os.listdir(csv_directory)):
+        if csv_file.endswith(".csv"):
+            df = pd.read_csv(os.path.join(csv_directory, csv_file), usecols=['ImageNumber', ORIENTATION_COLUMN])
+            # Remove the file extension to create a base filename
+            df['base_filename'] = os.path.splitext(csv_file)[0]
+            tables.append(df)
+    if not tables:
+        return pd.DataFrame(columns=['ImageNumber', ORIENTATION_COLUMN, 'base_filename', 'image_filename', 'on_disk'])
+    table = pd.concat(tables, ignore_index=True)
+
+    # Construct the image filenames once for the whole table
+    table['image_filename'] = (table['base_filename'] + "_cell_"
+                               + table['ImageNumber'].astype(int).astype(str) + ".tif")
+
+    # One directory listing replaces a stat call per row
+    files_on_disk = set(os.listdir(tif_directory))
+    table['on_disk'] = table['image_filename'].isin(files_on_disk)
+    return table
+
+# Function to align every extracted cell listed in the orientation tables
+def align_directory(csv_directory, tif_directory, workers=None, chunk_size=64):
+    table = build_alignment_table(csv_directory, tif_directory)
+
+    # Handle NaN orientations and missing images
+    for image_filename in table.loc[table[ORIENTATION_COLUMN].isna(), 'image_filename']:
+        print(f"Skipped {image_filename} due to NaN orientation.")
+    table = table[table[ORIENTATION_COLUMN].notna()]
+    for image_filename in table.loc[~table['on_disk'], 'image_filename']:
+        # Log an error if the image file does not exist
+        print(f"Image not found: {os.path.join(tif_directory, image_filename)}")
+    table = table[table['on_disk']]
+
+    tasks = list(zip((os.path.join(tif_directory, name) for name in table['image_filename']),
+                     table[ORIENTATION_COLUMN]))
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+
+    # Rotate the crops in a worker pool
+    transforms = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for records in executor.map(_align_chunk, chunks):
+            transforms.extend(records)
+
+    # Record the rotation applied to every cell so later stages can map positions back
+    transforms = pd.DataFrame(transforms)
+    transforms.to_csv(os.path.join(tif_directory, 'alignment_transforms.csv'), index=False)
+    return transforms
+
+if __name__ == "__main__":
+    # Replace the directory paths with the paths where the CSV that was converted from the SQLite database and the extracted TIFF files are stored
+    csv_directory = './experiment/extracted/csv'
+    tif_directory = './experiment/extracted/tif'
+
+    with stage('align_extracted_objects', file=csv_directory) as record:
+        transforms = align_directory(csv_directory, tif_directory)
+        record['items'] = len(transforms)
+
+    # Indicate that the process is complete
+    print("Process completed!")
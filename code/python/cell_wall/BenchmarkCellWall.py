@@ -0,0 +1,323 @@
+"""
+Benchmark for the cell wall scripts on synthetic data.
+
+The script generates 16-bit fields of ellipsoidal cells whose calcofluor-like
+wall has a known thickness, together with the CellProfiler-style CSVs the
+scripts expect, and lays them out in a scratch "./experiment" tree. It then runs
+ExtractIndividualCells, AlignExtractedObjects, PadExtractedTiffs,
+RadialIntensityMajorMinor and PeakAndWidthExtractor in turn, each as its own
+process from the scratch directory, performing the manual file moves described
+in the README between stages. For every stage it reports wall time, CPU time,
+peak RSS and cells per second, and finally compares the FWHM of the wall peaks
+found by PeakAndWidthExtractor against the ground-truth thickness.
+"""
+
+import argparse
+import glob
+import math
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import tifffile as tf
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Width of the line scan in RadialIntensityMajorMinor.extract_intensity_profile
+LINE_SCAN_THICKNESS = 5
+
+# Functions preparing the inputs of each stage from the outputs of the previous one. They stand in for
+# the manual moves described in the README.
+def _prepare_extract(root):
+    pass
+
+def _prepare_align(root):
+    # Extracted cells are moved to ./experiment/extracted/tif for alignment
+    extracted = os.path.join(root, 'experiment', 'extracted')
+    tif_directory = os.path.join(extracted, 'tif')
+    os.makedirs(tif_directory, exist_ok=True)
+    for path in glob.glob(os.path.join(extracted, '*_cell_*.tif')):
+        shutil.move(path, tif_directory)
+
+def _prepare_pad(root):
+    # "_aligned" files are moved to their own "aligned" subfolder
+    tif_directory = os.path.join(root, 'experiment', 'extracted', 'tif')
+    aligned_directory = os.path.join(tif_directory, 'aligned')
+    os.makedirs(aligned_directory, exist_ok=True)
+    for path in glob.glob(os.path.join(tif_directory, '*_aligned.tif')):
+        shutil.move(path, aligned_directory)
+
+def _prepare_radial(root):
+    # "padded_" files are moved to their own "padded" subfolder and the marked output folder is created
+    aligned_directory = os.path.join(root, 'experiment', 'extracted', 'tif', 'aligned')
+    padded_directory = os.path.join(aligned_directory, 'padded')
+    os.makedirs(padded_directory, exist_ok=True)
+    for path in glob.glob(os.path.join(aligned_directory, 'padded_*.tif')):
+        shutil.move(path, padded_directory)
+    os.makedirs(os.path.join(root, 'experiment', 'extracted', 'tif', 'padded', 'aligned', 'marked', 'Marked'),
+                exist_ok=True)
+
+def _prepare_peaks(root):
+    # Line scan CSVs are moved next to the padded images for peak extraction
+    marked_directory = os.path.join(root, 'experiment', 'extracted', 'tif', 'padded', 'aligned', 'marked')
+    csv_directory = os.path.join(root, 'experiment', 'extracted', 'tif', 'aligned', 'padded', 'csv')
+    os.makedirs(csv_directory, exist_ok=True)
+    for path in glob.glob(os.path.join(marked_directory, '*_axis_data.csv')):
+        shutil.copy(path, csv_directory)
+
+# Stages in pipeline order: (name, script, function preparing the inputs from the previous stage)
+STAGES = [
+    ("ExtractIndividualCells", "ExtractIndividualCells.py", _prepare_extract),
+    ("AlignExtractedObjects", "AlignExtractedObjects.py", _prepare_align),
+    ("PadExtractedTiffs", "PadExtractedTiffs.py", _prepare_pad),
+    ("RadialIntensityMajorMinor", "RadialIntensityMajorMinor.py", _prepare_radial),
+    ("PeakAndWidthExtractor", "PeakAndWidthExtractor.py", _prepare_peaks),
+]
+
+def draw_walled_cell(field, center_x, center_y, a, b, thickness, beta, amplitude):
+    """
+    Add a cell wall to a field. The wall is a ridge with a Gaussian cross-section whose
+    FWHM equals `thickness`, centred on the ellipse with semi-axes a (major) and b (minor).
+    `beta` is the displayed angle of the major axis in degrees (counter-clockwise, y up).
+    """
+    half = int(math.ceil(a + 3 * thickness)) + 1
+    x0, x1 = max(int(center_x) - half, 0), min(int(center_x) + half + 1, field.shape[1])
+    y0, y1 = max(int(center_y) - half, 0), min(int(center_y) + half + 1, field.shape[0])
+    yy, xx = np.mgrid[y0:y1, x0:x1]
+    dx = xx - center_x
+    dy = yy - center_y
+
+    # Coordinates along the major (u) and minor (v) axes; rows increase downwards
+    cos_b, sin_b = math.cos(math.radians(beta)), math.sin(math.radians(beta))
+    u = dx * cos_b - dy * sin_b
+    v = dx * sin_b + dy * cos_b
+
+    # First-order distance to the ellipse, exact on both axes where the line scans are taken
+    r = np.sqrt((u / a) ** 2 + (v / b) ** 2)
+    gradient = np.sqrt((u / a ** 2) ** 2 + (v / b ** 2) ** 2) / np.maximum(r, 1e-9)
+    distance = (r - 1) / np.maximum(gradient, 1e-9)
+
+    sigma = thickness / (2 * math.sqrt(2 * math.log(2)))
+    field[y0:y1, x0:x1] += amplitude * np.exp(-distance ** 2 / (2 * sigma ** 2))
+
+def draw_clump(field, center_x, center_y, radius, amplitude):
+    """Add a wall-less, uniformly filled clump; these set the padded canvas size like clumped objects do in real runs."""
+    yy, xx = np.ogrid[:field.shape[0], :field.shape[1]]
+    field[(xx - center_x) ** 2 + (yy - center_y) ** 2 <= radius ** 2] += amplitude
+
+def generate_dataset(root, n_fields=4, cells_per_field=16, field_size=2048, semi_major=(22, 34),
+                     aspect=(0.75, 0.95), thickness=(4.0, 8.0), clump_radius=170, seed=0):
+    """
+    Write synthetic fields and CSVs into the layout the cell wall scripts expect:
+    - ./CellWallAnalysisImages/<field>.tif           raw 16-bit fields
+    - ./experiment/csv/<field>.csv                   CW_Pipeline object table (centers and areas)
+    - ./experiment/extracted/csv/<field>.csv         CW_Pipeline_Extracted table (orientation per extracted cell)
+    Returns the ground-truth table, one row per extracted object.
+    """
+    rng = np.random.default_rng(seed)
+    raw_directory = os.path.join(root, 'CellWallAnalysisImages')
+    csv_directory = os.path.join(root, 'experiment', 'csv')
+    extracted_csv_directory = os.path.join(root, 'experiment', 'extracted', 'csv')
+    for directory in (raw_directory, csv_directory, extracted_csv_directory):
+        os.makedirs(directory, exist_ok=True)
+
+    ground_truth = []
+    for field_index in range(n_fields):
+        field_name = f"field_{field_index:03d}"
+        field = np.full((field_size, field_size), 400.0)
+
+        # One clump in the corner, cells on a jittered grid elsewhere so that crops never overlap objects
+        objects = [dict(kind='clump', x=clump_radius + 20.0, y=clump_radius + 20.0, a=clump_radius,
+                        b=clump_radius, thickness=np.nan, beta=0.0)]
+        grid = int(math.ceil(math.sqrt(cells_per_field + 1)))
+        spacing = field_size / grid
+        slots = [(i, j) for i in range(grid) for j in range(grid) if (i, j) != (0, 0)][:cells_per_field]
+        for i, j in slots:
+            a = rng.uniform(*semi_major)
+            objects.append(dict(
+                kind='cell',
+                x=(j + 0.5) * spacing + rng.uniform(-0.1, 0.1) * spacing,
+                y=(i + 0.5) * spacing + rng.uniform(-0.1, 0.1) * spacing,
+                a=a,
+                b=a * rng.uniform(*aspect),
+                thickness=rng.uniform(*thickness),
+                beta=rng.uniform(0, 180),
+            ))
+
+        for obj in objects:
+            if obj['kind'] == 'clump':
+                draw_clump(field, obj['x'], obj['y'], obj['a'], 1500)
+            else:
+                draw_walled_cell(field, obj['x'], obj['y'], obj['a'], obj['b'], obj['thickness'], obj['beta'], 20000)
+        field += rng.normal(0, 30, field.shape)
+        tf.imwrite(os.path.join(raw_directory, f"{field_name}.tif"),
+                   np.clip(field, 0, 65535).astype(np.uint16))
+
+        cp_rows = []
+        extracted_rows = []
+        for index, obj in enumerate(objects):
+            outer_a = obj['a'] + (0 if obj['kind'] == 'clump' else obj['thickness'] / 2)
+            outer_b = obj['b'] + (0 if obj['kind'] == 'clump' else obj['thickness'] / 2)
+            cp_rows.append({
+                'ImageNumber': field_index + 1,
+                'ObjectNumber': index + 1,
+                'AreaShape_Area': math.pi * outer_a * outer_b,
+                'AreaShape_MajorAxisLength': 2 * outer_a,
+                'AreaShape_MinorAxisLength': 2 * outer_b,
+                'AreaShape_Orientation': obj['beta'] - 90,
+                'Location_Center_X': obj['x'],
+                'Location_Center_Y': obj['y'],
+            })
+            # AlignExtractedObjects rotates by -degrees(orientation); this brings the major axis to vertical
+            extracted_rows.append({
+                'ImageNumber': index,
+                'Image_FileName_AllExtractedImages': f"{field_name}_cell_{index}.tif",
+                'Mean_IdentifyPrimaryObjects_AreaShape_Orientation': math.radians(obj['beta'] - 90),
+            })
+            ground_truth.append({
+                'file': f"padded_{field_name}_cell_{index}_aligned.tif",
+                'kind': obj['kind'],
+                'semi_major': obj['a'],
+                'semi_minor': obj['b'],
+                'thickness': obj['thickness'],
+            })
+        pd.DataFrame(cp_rows).to_csv(os.path.join(csv_directory, f"{field_name}.csv"), index=False)
+        pd.DataFrame(extracted_rows).to_csv(os.path.join(extracted_csv_directory, f"{field_name}.csv"), index=False)
+
+    ground_truth = pd.DataFrame(ground_truth)
+    ground_truth.to_csv(os.path.join(root, 'ground_truth.csv'), index=False)
+    return ground_truth
+
+# Each stage runs under this wrapper, which reports the peak RSS of the stage itself.
+# (ru_maxrss from wait4 would include the benchmark's own memory inherited across fork/exec on Linux.)
+STAGE_RUNNER = """
+import resource, runpy, sys
+runpy.run_path(sys.argv[1], run_name='__main__')
+peak_rss = None
+try:
+    with open('/proc/self/status') as status:
+        peak_rss = next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmHWM'))
+except OSError:
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+with open(sys.argv[2], 'w') as stats:
+    stats.write(str(peak_rss))
+"""
+
+def run_stage(script, root):
+    """Run one stage script from the scratch root and return its wall time, CPU time and peak RSS in MB."""
+    environment = dict(os.environ, MPLBACKEND='Agg')
+    stats_path = os.path.join(root, '.stage_peak_rss')
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', STAGE_RUNNER, os.path.join(SCRIPT_DIRECTORY, script), stats_path],
+                               cwd=root, env=environment, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{script} exited with status {process.returncode}")
+
+    with open(stats_path) as stats:
+        peak_rss = int(stats.read()) / (1024 * 1024)
+    os.remove(stats_path)
+    return wall_time, usage.ru_utime + usage.ru_stime, peak_rss
+
+def check_fwhm(root, ground_truth, tolerance=1.5):
+    """
+    Compare the widths of the two highest peaks of each line scan against the expected FWHM.
+    The 5 pixel line scan averages along the scan direction, which broadens a Gaussian ridge
+    by a box of that width; the expected value accounts for this. Nearest-neighbour rotation
+    and linear interpolation in peak_widths add a further bias of up to about a pixel on thin
+    walls, so the check uses an absolute tolerance in pixels.
+    """
+    csv_directory = os.path.join(root, 'experiment', 'extracted', 'tif', 'aligned', 'padded', 'csv')
+    padded_directory = os.path.join(root, 'experiment', 'extracted', 'tif', 'aligned', 'padded')
+    height, width = tf.imread(glob.glob(os.path.join(padded_directory, 'padded_*.tif'))[0]).shape
+    samples = max(width, height)
+    box_variance = (LINE_SCAN_THICKNESS ** 2 - 1) / 12
+    truth = ground_truth.set_index('file')
+
+    rows = []
+    for axis, line_length in (('major', height), ('minor', width)):
+        processed = pd.read_csv(os.path.join(csv_directory, f"processed_padded_{axis}_axis_data.csv"))
+        peak_columns = [col for col in processed.columns if col.startswith('Peak_')]
+        width_columns = [col for col in processed.columns if col.startswith('Width_')]
+        pixels_per_sample = line_length / (samples - 1)
+        for _, row in processed.iterrows():
+            file = row['Cell #'][len('Cell '):-len(f' ({axis.capitalize()})')]
+            if file not in truth.index or truth.loc[file, 'kind'] != 'cell':
+                continue
+            thickness = truth.loc[file, 'thickness']
+            expected = math.sqrt(thickness ** 2 + 8 * math.log(2) * box_variance)
+            peaks = row[peak_columns].to_numpy(dtype=float)
+            widths = row[width_columns].to_numpy(dtype=float)
+            valid = ~np.isnan(peaks)
+            if valid.sum() < 2:
+                measured = np.nan
+            else:
+                top_two = np.argsort(np.where(valid, peaks, -np.inf))[-2:]
+                measured = widths[top_two].mean() * pixels_per_sample
+            rows.append({'file': file, 'axis': axis, 'thickness': thickness,
+                         'expected_fwhm': expected, 'measured_fwhm': measured})
+
+    result = pd.DataFrame(rows)
+    result['error_px'] = result['measured_fwhm'] - result['expected_fwhm']
+    result['within_tolerance'] = result['error_px'].abs() <= tolerance
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cell wall scripts on synthetic cells.')
+    parser.add_argument('--root', default='./benchmark_cell_wall', help='Scratch directory for the synthetic experiment.')
+    parser.add_argument('--fields', type=int, default=4, help='Number of synthetic fields.')
+    parser.add_argument('--cells-per-field', type=int, default=16, help='Number of walled cells per field.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic data.')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='Allowed FWHM error in pixels.')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch directory afterwards.')
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    # The scratch directory is deleted afterwards, so only a new or empty directory is used
+    if os.path.isdir(root) and os.listdir(root):
+        parser.error(f"{root} is not empty; remove it or give another --root.")
+    os.makedirs(root, exist_ok=True)
+
+    print(f"Generating {args.fields} fields with {args.cells_per_field} cells each in {root}")
+    ground_truth = generate_dataset(root, args.fields, args.cells_per_field, seed=args.seed)
+    n_objects = len(ground_truth)
+
+    report = []
+    for name, script, prepare in STAGES:
+        prepare(root)
+        wall_time, cpu_time, peak_rss = run_stage(script, root)
+        report.append({'stage': name, 'wall_s': wall_time, 'cpu_s': cpu_time, 'peak_rss_mb': peak_rss,
+                       'cells_per_s': n_objects / wall_time})
+        print(f"{name:<28} wall {wall_time:8.2f} s  cpu {cpu_time:8.2f} s  "
+              f"peak RSS {peak_rss:8.1f} MB  {n_objects / wall_time:10.1f} cells/s")
+
+    report = pd.DataFrame(report)
+    report_path = os.path.join(root, 'benchmark_report.csv')
+    report.to_csv(report_path, index=False)
+
+    fwhm = check_fwhm(root, ground_truth, args.tolerance)
+    fwhm.to_csv(os.path.join(root, 'fwhm_check.csv'), index=False)
+    print(f"FWHM check: {fwhm['within_tolerance'].sum()} of {len(fwhm)} line scans within "
+          f"{args.tolerance} px of the expected width "
+          f"(mean bias {fwhm['error_px'].mean():+.2f} px, max error {fwhm['error_px'].abs().max():.2f} px)")
+
+    if args.keep:
+        print(f"Benchmark outputs kept in {root}")
+    else:
+        # Keep only the reports next to the scratch directory
+        for path in (report_path, os.path.join(root, 'fwhm_check.csv')):
+            shutil.copy(path, os.path.dirname(root))
+        shutil.rmtree(root)
+
+    if not fwhm['within_tolerance'].all():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,76 @@
-from PIL import Image
 import os
+import sys
+import numpy as np
+import pandas as pd
+import tifffile as tf
 
-def pad_image(img, target_width, target_height, fill_value=0):
-    width, height = img.size
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented
+
+# Read the shape and dtype of a TIFF from its tags without decoding any pixel data
+def read_tiff_header(path):
+    with tf.TiffFile(path) as tif:
+        page = tif.pages[0]
+        return page.shape[:2], page.dtype
+
+# Pad an array centrally into a target canvas, keeping its dtype.
+# If `out` is given the image is written into that preallocated canvas instead of a new one.
+def pad_image(image, target_width, target_height, fill_value=0, out=None):
+    height, width = image.shape[:2]
     pad_width = (target_width - width) // 2
     pad_height = (target_height - height) // 2
 
-    new_img = Image.new("I;16", (target_width, target_height), fill_value)
-    new_img.paste(img, (pad_width, pad_height))
-    
-    return new_img
+    if out is None:
+        out = np.empty((target_height, target_width), dtype=image.dtype)
+    out.fill(fill_value)
+    out[pad_height:pad_height + height, pad_width:pad_width + width] = image
+
+    return out
+
+@instrumented('pad_extracted_tiffs')
+def process_images_in_directory(directory, stack_path=None, write_individual=True):
+    tif_files = sorted(f for f in os.listdir(directory) if f.endswith('.tif') and not f.startswith('padded_'))
+    if not tif_files:
+        return
+
+    # Single pass over the TIFF tags to find the max width and height
+    headers = [read_tiff_header(os.path.join(directory, file)) for file in tif_files]
+    max_height = max(shape[0] for shape, _ in headers)
+    max_width = max(shape[1] for shape, _ in headers)
 
-def process_images_in_directory(directory):
-    tif_files = [f for f in os.listdir(directory) if f.endswith('.tif')]
+    # Record where every cell sits in its padded image, so positions measured on the padded images can be
+    # mapped back through alignment_transforms.csv (join on aligned_filename == file)
+    pd.DataFrame({'file': tif_files, 'padded_file': ["padded_" + file for file in tif_files],
+                  'pad_x': [(max_width - shape[1]) // 2 for shape, _ in headers],
+                  'pad_y': [(max_height - shape[0]) // 2 for shape, _ in headers]}).to_csv(
+        os.path.join(directory, 'padding_offsets.csv'), index=False)
 
-    max_width = 0
-    max_height = 0
+    # Optionally collect every padded cell into one memory-mappable (N, H, W) stack
+    stack = None
+    if stack_path is not None:
+        stack_dtype = np.result_type(*(dtype for _, dtype in headers))
+        stack = tf.memmap(stack_path, shape=(len(tif_files), max_height, max_width), dtype=stack_dtype)
+        # Sidecar listing which file each page of the stack came from
+        pd.DataFrame({'page': range(len(tif_files)), 'file': tif_files}).to_csv(
+            os.path.splitext(stack_path)[0] + '_index.csv', index=False)
 
-    # First pass: Determine max width and height
-    for file in tif_files:
-        with Image.open(os.path.join(directory, file)) as img:
-            width, height = img.size
-            max_width = max(max_width, width)
-            max_height = max(max_height, height)
+    # One canvas per dtype is reused for every image
+    canvases = {}
+    for index, (file, (_, dtype)) in enumerate(zip(tif_files, headers)):
+        image = tf.imread(os.path.join(directory, file))
+        if dtype not in canvases:
+            canvases[dtype] = np.empty((max_height, max_width), dtype=dtype)
+        padded_image = pad_image(image, max_width, max_height, out=canvases[dtype])
+        if write_individual:
+            tf.imwrite(os.path.join(directory, "padded_" + file), padded_image)
+        if stack is not None:
+            stack[index] = padded_image
 
-    # Second pass: Pad and save each image
-    for file in tif_files:
-        with Image.open(os.path.join(directory, file)) as img:
-            padded_image = pad_image(img, max_width, max_height)
-            padded_image.save(os.path.join(directory, "padded_" + file))
+    if stack is not None:
+        stack.flush()
+        del stack
 
 if __name__ == "__main__":
     dir_path = './experiment/extracted/tif/aligned'  # change this to your directory path
-    process_images_in_directory(dir_path)
+    stack_path = None  # e.g. './experiment/extracted/tif/aligned/padded_stack.tif' to also write all cells into one stack
+    process_images_in_directory(dir_path, stack_path)
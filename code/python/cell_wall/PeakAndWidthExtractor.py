@@ -1,6 +1,10 @@
 import pandas as pd
 from scipy.signal import find_peaks, peak_widths
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented, stage
 
 def process_row(row):
     try:
@@ -42,14 +46,17 @@ def process_file(file_path):
     # Save the transformed data to a new CSV file
     df.to_csv(output_file_path, index=False)
 
+@instrumented('peak_and_width_extractor')
 def process_all_files(folder_path):
     for file_name in os.listdir(folder_path):
         if file_name.endswith('.csv'):
             file_path = os.path.join(folder_path, file_name)
-            process_file(file_path)
+            with stage('peak_and_width_extractor.file', file=file_path):
+                process_file(file_path)
 
-# Specify the folder containing the CSV files
-folder_path = './experiment/extracted/tif/aligned/padded/csv'
+if __name__ == "__main__":
+    # Specify the folder containing the CSV files
+    folder_path = './experiment/extracted/tif/aligned/padded/csv'
 
-# Process all CSV files in the specified folder
-process_all_files(folder_path)
+    # Process all CSV files in the specified folder
+    process_all_files(folder_path)
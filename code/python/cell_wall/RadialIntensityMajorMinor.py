@@ -1,9 +1,13 @@
 import os
+import sys
 import numpy as np
 import csv
 import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented, stage
+
 def extract_intensity_profile(img, start, end, thickness=5):
     intensities = []
     width, height = img.size
@@ -17,6 +21,7 @@ def extract_intensity_profile(img, start, end, thickness=5):
 
     return intensities
 
+@instrumented('radial_intensity_major_minor')
 def process_images_in_directory(directory, prefixes=None, output_directory=None):
     if prefixes is None:
         prefixes = [""]  # Empty prefix will match all files
@@ -32,7 +37,7 @@ def process_images_in_directory(directory, prefixes=None, output_directory=None)
     for file in tif_files:
         prefix = next((p for p in prefixes if p in file), "")
         
-        with Image.open(os.path.join(directory, file)) as img:
+        with stage('radial_intensity_major_minor.file', file=file), Image.open(os.path.join(directory, file)) as img:
             width, height = img.size
             
             start_major = (width // 2, 0)
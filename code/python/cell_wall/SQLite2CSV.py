@@ -1,39 +1,179 @@
 import sqlite3
 import csv
-from collections import defaultdict
+import os
+import pathlib
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import stage
+
+# Rows are pulled from the database in batches of this size so that the whole
+# CellProfiler table is never held in memory at once
+FETCH_SIZE = 10000
+
+# SQL expression equivalent to extract_image_name() without the '.tif' suffix.
+# Ordering by this expression keeps every group contiguous in the cursor.
+GROUP_EXPRESSION = (
+    "CASE WHEN instr({col}, '_cell_') > 0 "
+    "THEN substr({col}, 1, instr({col}, '_cell_') - 1) "
+    "ELSE {col} END"
+)
 
 # Function to extract the base image name
 def extract_image_name(full_name):
     parts = full_name.split('_cell_')
     return parts[0] + '.tif'
 
-# Connect to the SQLite database
-db_path = './experiment/extracted'  # Path to where the SQLite database from the second Cell Profiler run is
-connection = sqlite3.connect(db_path)
-cursor = connection.cursor()
+# Function to open the database; it is opened read-only unless an index is to be written into it,
+# so an export leaves the CellProfiler database as it was
+def connect(db_path, create_index=False):
+    if create_index:
+        return sqlite3.connect(db_path)
+    return sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + '?mode=ro', uri=True)
+
+# Function to look up the position and quoted name of a column by name
+def resolve_column(cursor, table_name, column_name):
+    cursor.execute(f'PRAGMA table_info("{table_name}")')
+    columns = [info[1] for info in cursor.fetchall()]
+    if column_name not in columns:
+        raise KeyError(f"Column '{column_name}' not found in table '{table_name}'.")
+    return columns.index(column_name), f'"{column_name}"'
+
+# Function to stream (image_name, rows) groups out of the database in image order
+def iter_image_groups(connection, table_name, column_name, create_index=False, fetch_size=FETCH_SIZE):
+    cursor = connection.cursor()
+    column_index, quoted_column = resolve_column(cursor, table_name, column_name)
+    group_expression = GROUP_EXPRESSION.format(col=quoted_column)
+
+    # Without an index SQLite sorts the rows in a temporary B-tree (spilling to disk for large tables).
+    # Opting in to create_index writes an index on the grouping expression into the database once, so that
+    # repeated exports walk the rows in order instead of sorting them.
+    if create_index:
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_image_group" '
+            f'ON "{table_name}" ({group_expression})'
+        )
+        connection.commit()
+
+    cursor.execute(f'SELECT * FROM "{table_name}" ORDER BY {group_expression}')
+    headers = [description[0] for description in cursor.description]
+
+    def groups():
+        current_name = None
+        current_rows = []
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                image_name = extract_image_name(row[column_index])
+                if image_name != current_name and current_rows:
+                    yield current_name, current_rows
+                    current_rows = []
+                current_name = image_name
+                current_rows.append(row)
+            # Hand over partial groups at every batch boundary so memory stays bounded
+            if current_rows:
+                yield current_name, current_rows
+                current_rows = []
+
+    return headers, groups()
+
+# Function to export each image group to its own CSV file
+def export_csv(db_path, output_directory='.', table_name='MyExpt_Per_Image',
+               column_name='Image_FileName_AllExtractedImages', create_index=False, fetch_size=FETCH_SIZE):
+    os.makedirs(output_directory, exist_ok=True)
+    connection = connect(db_path, create_index)
+    try:
+        headers, groups = iter_image_groups(connection, table_name, column_name, create_index, fetch_size)
+
+        # Only one CSV file is open at a time; it is closed as soon as its group ends
+        csv_file = None
+        current_name = None
+        for image_name, rows in groups:
+            if image_name != current_name:
+                if csv_file is not None:
+                    csv_file.close()
+                csv_file = open(os.path.join(output_directory, f"{image_name}.csv"), 'w', newline='')
+                writer = csv.writer(csv_file)
+                # Write the headers first
+                writer.writerow(headers)
+                current_name = image_name
+            # Write the content
+            writer.writerows(rows)
+        if csv_file is not None:
+            csv_file.close()
+    finally:
+        # Close the SQLite connection
+        connection.close()
+
+# Function to export each image group to Parquet, either as one file per image
+# or as a hive-partitioned dataset (output_directory/image_name=<name>/part-0.parquet)
+def export_parquet(db_path, output_directory='.', table_name='MyExpt_Per_Image',
+                   column_name='Image_FileName_AllExtractedImages', partitioned=False,
+                   create_index=False, fetch_size=FETCH_SIZE):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet export requires pyarrow (conda install pyarrow).") from e
 
-# Fetch all rows from the table
-table_name = 'MyExpt_Per_Image' 
-cursor.execute(f"SELECT * FROM {table_name}")
-rows = cursor.fetchall()
+    os.makedirs(output_directory, exist_ok=True)
+    connection = connect(db_path, create_index)
+    try:
+        headers, groups = iter_image_groups(connection, table_name, column_name, create_index, fetch_size)
 
-# Group rows by image name
-grouped_data = defaultdict(list)
-column_index = 9  # REPLACE with the index of 'Image_FileName_AllExtractedImages' in your table
-for row in rows:
-    image_name = extract_image_name(row[column_index])
-    grouped_data[image_name].append(row)
+        # Derive the Arrow schema from the declared column types using SQLite's affinity rules,
+        # so batches whose first values happen to be NULL still get a stable type
+        cursor = connection.cursor()
+        cursor.execute(f'PRAGMA table_info("{table_name}")')
+        declared_types = {info[1]: (info[2] or '').upper() for info in cursor.fetchall()}
+        fields = []
+        for header in headers:
+            declared = declared_types.get(header, '')
+            if 'INT' in declared:
+                arrow_type = pa.int64()
+            elif any(key in declared for key in ('CHAR', 'CLOB', 'TEXT')):
+                arrow_type = pa.string()
+            elif 'BLOB' in declared:
+                arrow_type = pa.binary()
+            else:
+                arrow_type = pa.float64()
+            fields.append(pa.field(header, arrow_type))
+        schema = pa.schema(fields)
 
-# Export each group to a separate CSV file
-for image_name, data in grouped_data.items():
-    with open(f"{image_name}.csv", 'w', newline='') as csv_file:
-        writer = csv.writer(csv_file)
+        writer = None
+        current_name = None
+        for image_name, rows in groups:
+            batch = pa.Table.from_pylist([dict(zip(headers, row)) for row in rows], schema=schema)
 
-        # Write the headers first
-        writer.writerow([description[0] for description in cursor.description])
+            if image_name != current_name:
+                if writer is not None:
+                    writer.close()
+                if partitioned:
+                    partition_directory = os.path.join(output_directory, f"image_name={image_name}")
+                    os.makedirs(partition_directory, exist_ok=True)
+                    parquet_path = os.path.join(partition_directory, "part-0.parquet")
+                else:
+                    parquet_path = os.path.join(output_directory, f"{image_name}.parquet")
+                writer = pq.ParquetWriter(parquet_path, schema)
+                current_name = image_name
+            writer.write_table(batch)
+        if writer is not None:
+            writer.close()
+    finally:
+        connection.close()
 
-        # Write the content
-        writer.writerows(data)
+if __name__ == "__main__":
+    db_path = './experiment/extracted'  # Path to where the SQLite database from the second Cell Profiler run is
+    table_name = 'MyExpt_Per_Image'
+    column_name = 'Image_FileName_AllExtractedImages'  # Column holding the extracted cell file names
+    output_format = 'csv'  # 'csv', 'parquet' or 'dataset' (hive-partitioned Parquet)
+    create_index = False  # True writes an index into the database that speeds up repeated exports
 
-# Close the SQLite connection
-connection.close()
+    with stage('sqlite2csv', file=db_path, output_format=output_format):
+        if output_format == 'csv':
+            export_csv(db_path, '.', table_name, column_name, create_index)
+        else:
+            export_parquet(db_path, './parquet', table_name, column_name, partitioned=(output_format == 'dataset'),
+                           create_index=create_index)
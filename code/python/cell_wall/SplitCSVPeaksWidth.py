@@ -1,52 +1,76 @@
 import csv
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 
-# Set these paths as needed
-directory_path = './experiment/extracted/tif/aligned/padded/csv/processed'
-output_directory = './experiment/extracted/tif/aligned/padded/csv/processed/split'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented, stage
 
-if not os.path.exists(output_directory):
-    os.makedirs(output_directory)
+# Build a function that projects a row onto the given column positions.
+# itemgetter returns a bare value for a single index and fails for none, so both cases are wrapped.
+def make_projector(positions):
+    if not positions:
+        return lambda row: ()
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda row: (row[position],)
+    return itemgetter(*positions)
 
-for filename in os.listdir(directory_path):
-    if filename.endswith('.csv'):
-        input_filepath = os.path.join(directory_path, filename)
+def split_file(input_filepath, output_directory):
+    filename = os.path.basename(input_filepath)
 
-        # Name the output files by appending "_peak.csv" and "_width.csv"
-        peak_output_filepath = os.path.join(output_directory, filename.replace('.csv', '_peak.csv'))
-        width_output_filepath = os.path.join(output_directory, filename.replace('.csv', '_width.csv'))
+    # Name the output files by appending "_peak.csv" and "_width.csv"
+    peak_output_filepath = os.path.join(output_directory, filename.replace('.csv', '_peak.csv'))
+    width_output_filepath = os.path.join(output_directory, filename.replace('.csv', '_width.csv'))
 
-        with open(input_filepath, 'r') as infile:
-            reader = csv.reader(infile)
+    with stage('split_csv_peaks_width.file', file=input_filepath) as record, \
+            open(input_filepath, 'r', newline='') as infile, \
+            open(peak_output_filepath, 'w', newline='') as peak_outfile, \
+            open(width_output_filepath, 'w', newline='') as width_outfile:
+        reader = csv.reader(infile)
+        peak_writer = csv.writer(peak_outfile)
+        width_writer = csv.writer(width_outfile)
 
-            peak_rows = []
-            width_rows = []
+        # Extract the header
+        header = next(reader)
 
-            # Extract the header
-            header = next(reader)
+        # Resolve the column positions once instead of searching the header on every row
+        peak_positions = [i for i, col in enumerate(header) if col.startswith('Peak')]
+        width_positions = [i for i, col in enumerate(header) if col.startswith('Width')]
+        project_peaks = make_projector(peak_positions)
+        project_widths = make_projector(width_positions)
 
-            peak_headers = [col for col in header if col.startswith('Peak')]
-            width_headers = [col for col in header if col.startswith('Width')]
+        peak_writer.writerow(project_peaks(header))
+        width_writer.writerow(project_widths(header))
 
-            for row in reader:
-                peak_data = [row[header.index(col)] for col in peak_headers]
-                width_data = [row[header.index(col)] for col in width_headers]
+        # Write both outputs while reading
+        for row in reader:
+            peak_writer.writerow(project_peaks(row))
+            width_writer.writerow(project_widths(row))
+            record['items'] += 1
 
-                peak_rows.append(peak_data)
-                width_rows.append(width_data)
+    return filename, peak_output_filepath, width_output_filepath
 
-            # Write the Peak data
-            with open(peak_output_filepath, 'w', newline='') as peak_outfile:
-                writer = csv.writer(peak_outfile)
-                writer.writerow(peak_headers)
-                writer.writerows(peak_rows)
+@instrumented('split_csv_peaks_width')
+def split_directory(directory_path, output_directory, workers=None):
+    os.makedirs(output_directory, exist_ok=True)
 
-            # Write the Width data
-            with open(width_output_filepath, 'w', newline='') as width_outfile:
-                writer = csv.writer(width_outfile)
-                writer.writerow(width_headers)
-                writer.writerows(width_rows)
+    input_filepaths = [os.path.join(directory_path, filename)
+                       for filename in sorted(os.listdir(directory_path)) if filename.endswith('.csv')]
 
+    # Files are independent, so split them concurrently
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(split_file, path, output_directory) for path in input_filepaths]
+        for future in futures:
+            filename, peak_output_filepath, width_output_filepath = future.result()
             print(f"Data from {filename} split into '{peak_output_filepath}' and '{width_output_filepath}'")
 
-print(f"Processing complete. Check the '{output_directory}' for the split files.")
+if __name__ == "__main__":
+    # Set these paths as needed
+    directory_path = './experiment/extracted/tif/aligned/padded/csv/processed'
+    output_directory = './experiment/extracted/tif/aligned/padded/csv/processed/split'
+
+    split_directory(directory_path, output_directory)
+
+    print(f"Processing complete. Check the '{output_directory}' for the split files.")
@@ -0,0 +1,360 @@
+"""
+One command-line entry point for the stages of all pipelines, with the
+paths, thresholds and experiment lists the scripts use read from one shared
+configuration file instead of being set in every script:
+
+    python3 code/python/chlamy.py [--config chlamy.toml] [--workers N] [--cache-dir DIR] [--dry-run] STAGE [ARGS]
+
+Every stage runs from the directory the pipelines are run from, like the
+scripts themselves. Stages that call a function of a script pass it the
+configured paths and thresholds; stages of scripts with their own arguments
+(e.g. gallery, deconvolution, cumulative-projection) take those arguments
+after the stage name. --workers is passed to the stages that run in
+parallel, --cache-dir to the stages that cache their results (the gallery
+pages), and --dry-run prints what every stage would run without running it.
+`chlamy.py config` prints the configuration in use.
+
+The configuration is a TOML (or, with PyYAML installed, YAML) file given by
+--config or the CHLAMY_CONFIG environment variable, or ./chlamy.toml if it
+exists; its values replace the defaults below (see code/python/chlamy.toml).
+The scripts of a stage, and with them cv2, scikit-image, matplotlib and
+pandas, are only imported when the stage runs, so the entry point itself
+starts in a few tens of milliseconds.
+"""
+
+import argparse
+import copy
+import importlib
+import json
+import os
+import sys
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CONFIG_VARIABLE = 'CHLAMY_CONFIG'
+DEFAULT_CONFIG_FILE = 'chlamy.toml'
+
+DEFAULT_CONFIG = {
+    'paths': {
+        'experiments': './experiments',
+        'cell_wall': './experiment',
+        'cell_wall_images': './CellWallAnalysisImages',
+    },
+    'focus': {'percentile': 95},
+    'organize': {'method': 'hardlink'},
+    'segment': {'threshold': 32767.5, 'min_diameter': 3, 'max_diameter': 40},
+    'training': {'samples': 3},
+    'motility': {'allowed_experiments': ['exp1_230509', 'exp2_230516', 'exp4_230523'], 'bins': 18},
+}
+
+def read_config_file(path):
+    """Sections of a TOML or YAML configuration file as a dict."""
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError(f"Reading {path} needs PyYAML (pip install pyyaml); TOML files need no extra package.")
+        with open(path) as config_file:
+            return yaml.safe_load(config_file) or {}
+    try:
+        import tomllib
+    except ImportError:
+        # Python before 3.11
+        import tomli as tomllib
+    with open(path, 'rb') as config_file:
+        return tomllib.load(config_file)
+
+def load_config(path=None):
+    """
+    The default configuration, with the values of the configuration file replacing the defaults. The file is
+    path, or the file named by CHLAMY_CONFIG, or ./chlamy.toml if it exists. Unknown sections and keys are errors,
+    so a misspelled setting is not silently ignored.
+    """
+    path = path or os.environ.get(CONFIG_VARIABLE) or (DEFAULT_CONFIG_FILE if os.path.exists(DEFAULT_CONFIG_FILE)
+                                                        else None)
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path is None:
+        return config
+    for section, values in read_config_file(path).items():
+        if section not in config:
+            raise ValueError(f"Unknown section [{section}] in {path}; expected one of {', '.join(config)}.")
+        unknown = set(values) - set(config[section])
+        if unknown:
+            raise ValueError(f"Unknown keys {', '.join(sorted(unknown))} in section [{section}] of {path}.")
+        config[section].update(values)
+    return config
+
+def format_config(config):
+    """The configuration as TOML."""
+    lines = []
+    for section, values in config.items():
+        lines.append(f"[{section}]")
+        lines.extend(f"{key} = {json.dumps(value)}" for key, value in values.items())
+        lines.append('')
+    return '\n'.join(lines)
+
+def load_script(script):
+    """Import a pipeline script, e.g. 'morphology_2d/segment_chlamy', with its directory on the import path."""
+    directory = os.path.join(SCRIPTS_DIRECTORY, os.path.dirname(script))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return importlib.import_module(os.path.basename(script))
+
+def call(options, script, function, *args, **kwargs):
+    """Call a function of a pipeline script, or with --dry-run print the call."""
+    arguments = ', '.join([repr(arg) for arg in args] + [f"{key}={value!r}" for key, value in kwargs.items()])
+    if options.dry_run:
+        print(f"{os.path.basename(script)}.{function}({arguments})")
+        return None
+    return getattr(load_script(script), function)(*args, **kwargs)
+
+def call_with_table(options, script, function, table_path, *args, **kwargs):
+    """Call a function of a pipeline script on the table read from table_path, or with --dry-run print the call."""
+    if options.dry_run:
+        arguments = ', '.join([f"read_csv({table_path!r})"] + [repr(arg) for arg in args] +
+                              [f"{key}={value!r}" for key, value in kwargs.items()])
+        print(f"{os.path.basename(script)}.{function}({arguments})")
+        return None
+    import pandas as pd
+    return getattr(load_script(script), function)(pd.read_csv(table_path), *args, **kwargs)
+
+def run_main(options, script, argv):
+    """Run the main() of a pipeline script with its own command-line arguments, or with --dry-run print them."""
+    if options.dry_run:
+        path = os.path.join(SCRIPTS_DIRECTORY, script + '.py')
+        relative_path = os.path.relpath(path)
+        print(' '.join(['python3', path if relative_path.startswith('..') else relative_path] + argv))
+        return None
+    module = load_script(script)
+    saved_argv = sys.argv
+    sys.argv = [module.__file__] + list(argv)
+    try:
+        return module.main()
+    finally:
+        sys.argv = saved_argv
+
+def forward(script, flags=()):
+    """
+    A stage that runs the main() of a script with the arguments given after the stage name. The global options in
+    flags ('workers', 'cache_dir') are added to the arguments, unless the arguments already set them.
+    """
+    def run(config, options, argv):
+        argv = list(argv)
+        for flag in flags:
+            value = getattr(options, flag)
+            option = '--' + flag.replace('_', '-')
+            if value is not None and option not in argv:
+                argv += [option, str(value)]
+        return run_main(options, script, argv)
+    return run
+
+# 2D morphology
+
+def focus_filter(config, options, argv):
+    return call(options, 'morphology_2d/focus_filter_laplacian', 'process_directory',
+                config['paths']['experiments'], config['focus']['percentile'])
+
+def sample_training(config, options, argv):
+    return call(options, 'morphology_2d/sample_training_set', 'sample_training_set',
+                config['paths']['experiments'], config['training']['samples'])
+
+def organize_prob_maps(config, options, argv):
+    return call(options, 'morphology_2d/organize_tif_by_species_and_well', 'organize_prob_maps',
+                config['paths']['experiments'], config['organize']['method'], workers=options.workers)
+
+def segment(config, options, argv):
+    settings = config['segment']
+    return call(options, 'morphology_2d/segment_chlamy', 'process_directory', config['paths']['experiments'],
+                settings['threshold'], settings['min_diameter'], settings['max_diameter'])
+
+def max_area(config, options, argv):
+    return call(options, 'morphology_2d/max_area_focus_seq', 'extract_max_area_object', config['paths']['experiments'])
+
+def parse_2d(config, options, argv):
+    return call(options, 'morphology_2d/parse_2d_morphology', 'compute_area_means', config['paths']['experiments'])
+
+# Qualitative morphology
+
+def object_list(config, options, argv):
+    return call(options, 'morphology_qualitative/frames_for_angle', 'object_list_frames',
+                config['paths']['experiments'])
+
+def swim_angle(config, options, argv):
+    return call(options, 'morphology_qualitative/swim_angle', 'add_swim_angles', config['paths']['experiments'])
+
+def image_mask(config, options, argv):
+    experiments = config['paths']['experiments']
+    return call_with_table(options, 'morphology_qualitative/image_mask', 'mask_objects',
+                           os.path.join(experiments, 'object_image_list_angles.csv'), experiments,
+                           workers=options.workers)
+
+def object_stats(config, options, argv):
+    return call(options, 'morphology_qualitative/object_stats', 'compute_object_stats',
+                config['paths']['experiments'], workers=options.workers)
+
+def crop_orient(config, options, argv):
+    experiments = config['paths']['experiments']
+    return call_with_table(options, 'morphology_qualitative/crop_orient_major', 'orient_objects',
+                           os.path.join(experiments, 'object_image_list_obj_stats.csv'), experiments)
+
+def save_stack(config, options, argv):
+    experiments = config['paths']['experiments']
+    return call_with_table(options, 'morphology_qualitative/save_stack', 'save_stacks',
+                           os.path.join(experiments, 'object_image_list_obj_stats.csv'), experiments)
+
+def mask_crop_orient_stack(config, options, argv):
+    experiments = config['paths']['experiments']
+    return call_with_table(options, 'morphology_qualitative/mask_crop_orient_stack', 'run_pipeline',
+                           os.path.join(experiments, 'object_image_list_obj_stats.csv'), experiments,
+                           workers=options.workers)
+
+# Motility
+
+def mean_per_track(config, options, argv):
+    experiments = config['paths']['experiments']
+    return call(options, 'motility_dynamic_fig/mean_per_track_allowed_experiments', 'mean_per_track',
+                os.path.join(experiments, 'centroids_displacements.csv'),
+                os.path.join(experiments, 'mean_angular_displacements_allowed.csv'),
+                config['motility']['allowed_experiments'])
+
+def filter_data(config, options, argv):
+    experiments = config['paths']['experiments']
+    return call(options, 'motility_dynamic_fig/filter_data', 'filter_csv_by_seq_frame',
+                os.path.join(experiments, 'mean_angular_displacements_allowed.csv'),
+                os.path.join(experiments, 'filtered_unbinned_data.csv'))
+
+def sample_filtered(config, options, argv):
+    experiments = config['paths']['experiments']
+    return call(options, 'motility_dynamic_fig/sample_filtered_data', 'sample_csv_by_experiment_and_species',
+                os.path.join(experiments, 'filtered_unbinned_data.csv'),
+                os.path.join(experiments, 'sampled_unbinned_data.csv'))
+
+def bin_sampled(config, options, argv):
+    experiments = config['paths']['experiments']
+    return call(options, 'motility_dynamic_fig/bin_sampled_data', 'bin_sampled_data',
+                os.path.join(experiments, 'sampled_unbinned_data.csv'),
+                os.path.join(experiments, 'sampled_binned_data.csv'), config['motility']['bins'])
+
+# Cell wall
+
+def extract_cells(config, options, argv):
+    root = config['paths']['cell_wall']
+    return call(options, 'cell_wall/ExtractIndividualCells', 'extract_cells', config['paths']['cell_wall_images'],
+                os.path.join(root, 'csv'), os.path.join(root, 'extracted'))
+
+def sqlite_to_csv(config, options, argv):
+    return call(options, 'cell_wall/SQLite2CSV', 'export_csv', os.path.join(config['paths']['cell_wall'], 'extracted'),
+                '.')
+
+def align_objects(config, options, argv):
+    extracted = os.path.join(config['paths']['cell_wall'], 'extracted')
+    return call(options, 'cell_wall/AlignExtractedObjects', 'align_directory', os.path.join(extracted, 'csv'),
+                os.path.join(extracted, 'tif'), workers=options.workers)
+
+def pad_tiffs(config, options, argv):
+    return call(options, 'cell_wall/PadExtractedTiffs', 'process_images_in_directory',
+                os.path.join(config['paths']['cell_wall'], 'extracted', 'tif', 'aligned'))
+
+def radial_intensity(config, options, argv):
+    tif = os.path.join(config['paths']['cell_wall'], 'extracted', 'tif')
+    return call(options, 'cell_wall/RadialIntensityMajorMinor', 'process_images_in_directory',
+                os.path.join(tif, 'aligned', 'padded'), prefixes=['padded'],
+                output_directory=os.path.join(tif, 'padded', 'aligned', 'marked'))
+
+def peak_width(config, options, argv):
+    return call(options, 'cell_wall/PeakAndWidthExtractor', 'process_all_files',
+                os.path.join(config['paths']['cell_wall'], 'extracted', 'tif', 'aligned', 'padded', 'csv'))
+
+def split_peaks_width(config, options, argv):
+    processed = os.path.join(config['paths']['cell_wall'], 'extracted', 'tif', 'aligned', 'padded', 'csv', 'processed')
+    return call(options, 'cell_wall/SplitCSVPeaksWidth', 'split_directory', processed,
+                os.path.join(processed, 'split'), workers=options.workers)
+
+# Stage name: (function, whether it takes its own arguments, help)
+STAGES = {
+    'focus-filter': (focus_filter, False, 'Parse focal sequences of frames from the pools.'),
+    'sample-training': (sample_training, False, 'Sample focal sequences for the pixel classification training set.'),
+    'organize-prob-maps': (organize_prob_maps, False, 'Organize probability maps by species and pool.'),
+    'segment': (segment, False, 'Segment cells in the probability maps and measure them.'),
+    'max-area': (max_area, False, 'Keep the object of maximal area of every focal sequence.'),
+    'parse-2d': (parse_2d, False, 'Per pool means of the 2D morphology measurements.'),
+    'synthetic-2d': (forward('morphology_2d/synthetic_2d_dataset'), True, 'Write a synthetic experiments tree.'),
+    'chlamy-modeler': (forward('idealized_cell/chlamy_modeler'), True, 'Vector graphics of idealized cells.'),
+    'object-list': (object_list, False, 'List the max-area objects with their previous and next frames.'),
+    'swim-angle': (swim_angle, False, 'Add the swim angles to the object list.'),
+    'image-mask': (image_mask, False, 'Mask the frames of the objects.'),
+    'object-stats': (object_stats, False, 'Object statistics per experiment, species and pool.'),
+    'crop-orient': (crop_orient, False, 'Crop and orient the masked objects along their major axis.'),
+    'save-stack': (save_stack, False, 'Save the oriented objects as stacks per experiment and species.'),
+    'mask-crop-orient-stack': (mask_crop_orient_stack, False, 'Mask, crop, orient and stack the objects in one pass.'),
+    'gallery': (forward('morphology_qualitative/gallery', ('workers', 'cache_dir')), True,
+                'Render gallery pages of a stack.'),
+    'zstack': (forward('morphology_3d/zstack_pipeline', ('workers',)), True,
+               'Split, subtract background, merge and project z-stacks.'),
+    'deconvolution': (forward('morphology_3d/deconvolution', ('workers',)), True, 'Deconvolve z-stacks.'),
+    'organelle-volumes': (forward('morphology_3d/organelle_volumes'), True, 'Cell volumes and organelle ratios.'),
+    'object-trajectory-info': (forward('motility_dynamic_fig/object_trajectory_info'), True,
+                               'Direction of movement of the objects.'),
+    'angular-linear-displacement': (forward('motility_dynamic_fig/angular_linear_displacement'), True,
+                                    'Angular and linear displacements of the tracks.'),
+    'mean-per-track': (mean_per_track, False, 'Mean angular displacement per track of the allowed experiments.'),
+    'filter-data': (filter_data, False, 'Keep the first frame of every sequence.'),
+    'sample-filtered': (sample_filtered, False, 'Sample the same number of sequences per experiment and species.'),
+    'bin-sampled': (bin_sampled, False, 'Bin the sampled sequences by mean angular displacement.'),
+    'parse-sampled-binned': (forward('motility_dynamic_fig/parse_sampled_binned_sequences'), True,
+                             'Merge the binned sequences with their centroids.'),
+    'rotate-translate': (forward('motility_dynamic_fig/rotate_translate'), True, 'Rotate and translate the frames.'),
+    'plot-histogram-vectors': (forward('motility_dynamic_fig/plot_histogram_vector_images'), True,
+                               'Histogram and vector images of the bins.'),
+    'cumulative-projection': (forward('motility_dynamic_fig/cumulative_projection', ('workers',)), True,
+                              'Cumulative projections of movies.'),
+    'motility-tracks': (forward('motility_dynamic_fig/motility_tracks', ('workers',)), True,
+                        'Load CellProfiler motility tracks.'),
+    'density-maps': (forward('motility_dynamic_fig/density_maps'), True, 'Density maps per species.'),
+    'track-correlations': (forward('motility_dynamic_fig/track_correlations'), True,
+                           'Autocorrelations and lagged joint histograms of tracks.'),
+    'extract-cells': (extract_cells, False, 'Extract the individual cells of the cell wall images.'),
+    'sqlite-to-csv': (sqlite_to_csv, False, 'Export the CellProfiler database to CSV files.'),
+    'align-objects': (align_objects, False, 'Align the extracted cells along their major axis.'),
+    'pad-tiffs': (pad_tiffs, False, 'Pad the aligned cells to one size.'),
+    'radial-intensity': (radial_intensity, False, 'Intensity profiles along the major and minor axes.'),
+    'peak-width': (peak_width, False, 'Peaks and their widths in the intensity profiles.'),
+    'split-peaks-width': (split_peaks_width, False, 'Split the peak and width tables by axis.'),
+    'summarize-runs': (forward('instrumentation'), True, 'Summarize the run logs.'),
+}
+
+def add_global_options(parser, suppress=False):
+    """Options of all stages; with suppress, they do not replace values already parsed."""
+    defaults = {'default': argparse.SUPPRESS} if suppress else {}
+    parser.add_argument('--config', help=f'TOML or YAML configuration (default: ${CONFIG_VARIABLE} or '
+                                         f'./{DEFAULT_CONFIG_FILE}).', **defaults)
+    parser.add_argument('--workers', type=int, help='Worker processes or threads of parallel stages.', **defaults)
+    parser.add_argument('--cache-dir', help='Where stages that cache their results keep them.', **defaults)
+    parser.add_argument('--dry-run', action='store_true', help='Print what the stage would run without running it.',
+                        **defaults)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a stage of the pipelines with a shared configuration.')
+    add_global_options(parser)
+    # The global options can also follow the name of stages without arguments of their own
+    common = argparse.ArgumentParser(add_help=False)
+    add_global_options(common, suppress=True)
+    stages = parser.add_subparsers(dest='stage', required=True, metavar='STAGE')
+    stages.add_parser('config', parents=[common], help='Print the configuration in use as TOML.')
+    for name, (_, own_arguments, help_text) in STAGES.items():
+        if own_arguments:
+            stages.add_parser(name, help=help_text, add_help=False)
+        else:
+            stages.add_parser(name, parents=[common], help=help_text)
+    options, argv = parser.parse_known_args(argv)
+
+    config = load_config(options.config)
+    if options.stage == 'config':
+        print(format_config(config), end='')
+        return
+    run, own_arguments, _ = STAGES[options.stage]
+    if argv and not own_arguments:
+        parser.error(f"unrecognized arguments for {options.stage}: {' '.join(argv)}")
+    run(config, options, argv)
+
+if __name__ == "__main__":
+    main()
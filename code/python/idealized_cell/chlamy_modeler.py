@@ -1,45 +1,198 @@
+"""
+The script models an idealized cell for every species from the 2D morphology
+measurements. It reads either the per-cell max_area_data.csv tables under
+./experiments (written by max_area_focus_seq.py) or the per-pool summary
+measure_2d_exp_species.v.1.csv (written by parse_2d_morphology.py), and for
+each species computes the mean and standard deviation of cell length (major
+axis), width (minor axis) and eccentricity, with bootstrapped confidence
+intervals from thousands of resamples drawn as one NumPy array per batch.
+
+All measured cells of a species are also rasterized as centred ellipses on a
+common grid in batched array operations, and averaged into a density map: the
+fraction of cells that cover each point. For each species the density map is
+drawn with the mean ellipse and the +1 and -1 standard deviation ellipses and
+saved as an SVG file, which can be further edited in Illustrator; the map
+itself is saved as a float32 TIFF and the statistics as a CSV file.
+"""
+
+import argparse
+import os
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
+import tifffile
 from matplotlib.patches import Ellipse
 
-# Given dimensions in um
-mean_length = 10 # set your measured length mean
-mean_width = 7  # set your measured width mean
+MEASUREMENTS = ['length', 'width', 'eccentricity']
+
+def load_cells(source="./experiments", pixel_size=1.0):
+    """
+    One row per cell (or per pool, for the summary table) with species, length, width and
+    eccentricity. Lengths are converted to um with pixel_size (um per pixel).
+    """
+    if os.path.isfile(source):
+        # Per-pool means from parse_2d_morphology.py
+        df = pd.read_csv(source)
+        cells = pd.DataFrame({'species': df['species'], 'length': df['mean_major_axis_length'],
+                              'width': df['mean_minor_axis_length'], 'eccentricity': df['mean_eccentricity']})
+    else:
+        frames = []
+        for root, dirs, files in os.walk(source):
+            if '/max_area/' in root and 'max_area_data.csv' in files:
+                frames.append(pd.read_csv(os.path.join(root, 'max_area_data.csv'),
+                                          usecols=['metadata_species', 'MajorAxisLength', 'MinorAxisLength',
+                                                   'Eccentricity']))
+        if not frames:
+            raise FileNotFoundError(f"No max_area_data.csv files found under {source}")
+        df = pd.concat(frames, ignore_index=True)
+        cells = pd.DataFrame({'species': df['metadata_species'], 'length': df['MajorAxisLength'],
+                              'width': df['MinorAxisLength'], 'eccentricity': df['Eccentricity']})
+
+    cells[['length', 'width']] *= pixel_size
+    return cells.dropna().reset_index(drop=True)
+
+def bootstrap_ci(values, n_resamples=10000, ci=0.95, seed=0, batch_size=None):
+    """
+    Bootstrap confidence intervals of the mean and standard deviation of each column of an
+    (n, k) sample. Every resample draws whole rows, so all columns are resampled together.
+    A batch of resamples is turned into a (batch, n) matrix of how often each row was drawn,
+    and the sums of every resample come from one matrix product with the (centred) values.
+    Returns (mean_low, mean_high, std_low, std_high), each an array of length k.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    n, k = values.shape
+    rng = np.random.default_rng(seed)
+    batch_size = batch_size or max(1, 10_000_000 // max(n, 1))
+
+    # Centring first keeps the variance from sums of squares accurate
+    centre = values.mean(axis=0)
+    centred = values - centre
+    means = np.empty((n_resamples, k))
+    second_moments = np.empty((n_resamples, k))
+    for start in range(0, n_resamples, batch_size):
+        stop = min(start + batch_size, n_resamples)
+        draws = rng.integers(0, n, size=(stop - start, n)) + n * np.arange(stop - start)[:, None]
+        counts = np.bincount(draws.ravel(), minlength=(stop - start) * n).reshape(stop - start, n).astype(float)
+        means[start:stop] = counts @ centred / n
+        second_moments[start:stop] = counts @ centred ** 2 / n
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stds = np.sqrt(np.maximum(second_moments - means ** 2, 0) * n / (n - 1))
+    means += centre
+
+    tails = [100 * (1 - ci) / 2, 100 * (1 + ci) / 2]
+    mean_low, mean_high = np.percentile(means, tails, axis=0)
+    std_low, std_high = np.percentile(stds, tails, axis=0)
+    return mean_low, mean_high, std_low, std_high
+
+def summarize_species(cells, n_resamples=10000, ci=0.95, seed=0):
+    """Per species and measurement: n, mean, std, median and bootstrapped CIs of the mean and std."""
+    rows = []
+    for species, group in cells.groupby('species'):
+        values = group[MEASUREMENTS].to_numpy(dtype=float)
+        intervals = bootstrap_ci(values, n_resamples, ci, seed)
+        for column, measurement in enumerate(MEASUREMENTS):
+            mean_low, mean_high, std_low, std_high = (interval[column] for interval in intervals)
+            rows.append({'species': species, 'measurement': measurement, 'n': len(values),
+                         'mean': values[:, column].mean(),
+                         'std': values[:, column].std(ddof=1) if len(values) > 1 else np.nan,
+                         'median': np.median(values[:, column]), 'mean_ci_low': mean_low,
+                         'mean_ci_high': mean_high, 'std_ci_low': std_low, 'std_ci_high': std_high})
+    return pd.DataFrame(rows)
+
+def density_map(lengths, widths, extent=10.0, grid_size=401):
+    """
+    Fraction of ellipses (major axis along x, centred) covering each point of a grid_size x grid_size
+    grid spanning [-extent, extent] on both axes. All ellipses are rasterized at once: each one covers,
+    in every grid column, the points with |y| up to its half height there, so sorting the half heights
+    of all ellipses per column turns the coverage counts into one searchsorted per column.
+    """
+    lengths = np.asarray(lengths, dtype=float)
+    widths = np.asarray(widths, dtype=float)
+    coordinates = np.linspace(-extent, extent, grid_size)
+
+    # Half height b * sqrt(1 - (x / a)^2) of every ellipse in every column, -1 outside the ellipse
+    semi_major = (lengths / 2)[:, None]
+    semi_minor = (widths / 2)[:, None]
+    inside = 1 - (coordinates[None, :] / semi_major) ** 2
+    half_heights = np.where(inside >= 0, semi_minor * np.sqrt(np.clip(inside, 0, None)), -1.0)
+    half_heights.sort(axis=0)
+
+    counts = np.empty((grid_size, grid_size), dtype=np.int64)
+    abs_y = np.abs(coordinates)
+    for column in range(grid_size):
+        counts[:, column] = len(lengths) - np.searchsorted(half_heights[:, column], abs_y, side='left')
+    return (counts / max(len(lengths), 1)).astype(np.float32)
+
+def draw_idealized_cell(ax, mean_length, mean_width, std_dev_length, std_dev_width, density=None, extent=10.0):
+    """Draw the density map and the mean and +/-1 standard deviation ellipses on ax."""
+    if density is not None:
+        ax.imshow(density, extent=(-extent, extent, -extent, extent), origin='lower', cmap='Greys', vmin=0, vmax=1)
 
-# Given standard deviations in um
-std_dev_length = 2 # set your measured length std. dev.
-std_dev_width = 1 # set your measured width std. dev.
+    # Create an Ellipse patch for mean cell dimensions
+    ellipse = Ellipse((0, 0), width=mean_length, height=mean_width, edgecolor='r', facecolor='none')
 
-# Given eccentricity and its standard deviation
-mean_eccentricity = 0.5 # set your measured eccentricity mean
-std_dev_eccentricity = 0.03 # set your measured eccentricity std. dev.
+    # Create Ellipse patches for +1 and -1 standard deviations
+    ellipse_std_dev_plus = Ellipse((0, 0), width=mean_length + std_dev_length, height=mean_width + std_dev_width, edgecolor='b', facecolor='none')
+    ellipse_std_dev_minus = Ellipse((0, 0), width=max(mean_length - std_dev_length, 0), height=max(mean_width - std_dev_width, 0), edgecolor='b', facecolor='none')
 
-# Create figure and axes
-fig, ax = plt.subplots(1)
+    # Add the patches to the Axes
+    ax.add_patch(ellipse)
+    ax.add_patch(ellipse_std_dev_plus)
+    ax.add_patch(ellipse_std_dev_minus)
 
-# Create an Ellipse patch for mean cell dimensions
-ellipse = Ellipse((0, 0), width=mean_length, height=mean_width, edgecolor='r', facecolor='none')
+    # Setting the limits of the plot
+    ax.set_xlim([-extent, extent])
+    ax.set_ylim([-extent, extent])
+    ax.set_aspect('equal', 'box')
 
-# Create Ellipse patches for +1 and -1 standard deviations
-ellipse_std_dev_plus = Ellipse((0, 0), width=mean_length + std_dev_length, height=mean_width + std_dev_width, edgecolor='b', facecolor='none')
-ellipse_std_dev_minus = Ellipse((0, 0), width=max(mean_length - std_dev_length, 0), height=max(mean_width - std_dev_width, 0), edgecolor='b', facecolor='none')
+def model_species(source="./experiments", output_directory=".", pixel_size=1.0, n_resamples=10000, ci=0.95,
+                  seed=0, grid_size=401):
+    """Write the statistics, density maps and SVG drawings for every species; returns the statistics."""
+    cells = load_cells(source, pixel_size)
+    summary = summarize_species(cells, n_resamples, ci, seed)
+    os.makedirs(output_directory, exist_ok=True)
+    summary.to_csv(os.path.join(output_directory, 'idealized_cell_stats.csv'), index=False)
 
-# Add the patches to the Axes
-ax.add_patch(ellipse)
-ax.add_patch(ellipse_std_dev_plus)
-ax.add_patch(ellipse_std_dev_minus)
+    # One extent for all species so their maps are comparable
+    extent = float(np.ceil(0.6 * cells['length'].max()))
+    stats = summary.set_index(['species', 'measurement'])
+    for species, group in cells.groupby('species'):
+        density = density_map(group['length'], group['width'], extent, grid_size)
+        tifffile.imwrite(os.path.join(output_directory, f"idealized_cell_{species}_density.tif"), density)
 
-# Showing the eccentricity
-print("Eccentricity: {:.4f} ± {:.5f}".format(mean_eccentricity, std_dev_eccentricity))
+        fig, ax = plt.subplots(1)
+        draw_idealized_cell(ax, stats.loc[(species, 'length'), 'mean'], stats.loc[(species, 'width'), 'mean'],
+                            stats.loc[(species, 'length'), 'std'], stats.loc[(species, 'width'), 'std'],
+                            density, extent)
+        ax.set_title(species)
 
-# Setting the limits of the plot
-ax.set_xlim([-10, 10]) # set the x-axis range to -10 to 10
-ax.set_ylim([-10, 10]) # set the y-axis range to -10 to 10
-ax.set_aspect('equal', 'box')
+        # Showing the eccentricity
+        eccentricity = stats.loc[(species, 'eccentricity')]
+        print("{}: eccentricity {:.4f} ± {:.5f} (mean {:.0%} CI {:.4f}-{:.4f}, n={})".format(
+            species, eccentricity['mean'], eccentricity['std'], ci, eccentricity['mean_ci_low'],
+            eccentricity['mean_ci_high'], int(eccentricity['n'])))
 
-# Save the figure as an SVG file so it can be edited in illustrator
-plt.savefig("filename.svg", format='svg') #replace filename with the sample descriptor
+        # Save the figure as an SVG file so it can be edited in illustrator
+        fig.savefig(os.path.join(output_directory, f"idealized_cell_{species}.svg"), format='svg')
+        plt.close(fig)
+    return summary
 
-# Showing the plot
-plt.show()
+def main():
+    parser = argparse.ArgumentParser(description='Model an idealized cell per species from 2D morphology data.')
+    parser.add_argument('--source', default='./experiments',
+                        help='Directory with max_area/.../max_area_data.csv files, or measure_2d_exp_species.v.1.csv.')
+    parser.add_argument('--output-directory', default='.', help='Where the statistics and figures are written.')
+    parser.add_argument('--pixel-size', type=float, default=1.0, help='Microns per pixel (1 keeps pixels).')
+    parser.add_argument('--resamples', type=int, default=10000, help='Bootstrap resamples.')
+    parser.add_argument('--ci', type=float, default=0.95, help='Confidence level of the intervals.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the bootstrap.')
+    parser.add_argument('--grid-size', type=int, default=401, help='Pixels per side of the density maps.')
+    args = parser.parse_args()
+    model_species(args.source, args.output_directory, args.pixel_size, args.resamples, args.ci, args.seed,
+                  args.grid_size)
 
+if __name__ == "__main__":
+    main()
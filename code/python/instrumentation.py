@@ -0,0 +1,250 @@
+"""
+Shared stage timing and resource instrumentation for the Python scripts of
+the pipelines. A stage is timed with the stage() context manager or the
+instrumented() decorator, which record for every stage (and for every file,
+when a stage runs per file) the wall time, the CPU time of the process and
+of its finished child processes, the peak resident memory, the number of
+items processed and the bytes read and written. Each record is appended as
+one JSON line to a run log, ./run_log.jsonl by default, or the file named by
+the CHLAMY_RUN_LOG environment variable (an empty value turns the log off).
+Records of one run share a run id, also across worker processes.
+
+Run as a script, the module summarizes one or more run logs by stage, file
+or script, so the hot spots of the pipelines can be compared across runs:
+
+    python3 code/python/instrumentation.py run_log.jsonl --by stage --top 20
+
+setup_logging() sends log messages to a log file and to the console, in
+place of redirecting sys.stdout to a file. Only the standard library is
+imported here, so instrumenting a script does not slow its start.
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; CPU time of child processes and ru_maxrss are then not recorded
+    resource = None
+
+RUN_LOG_VARIABLE = 'CHLAMY_RUN_LOG'
+RUN_ID_VARIABLE = 'CHLAMY_RUN_ID'
+DEFAULT_RUN_LOG = 'run_log.jsonl'
+
+_local = threading.local()
+
+def run_id():
+    """Id of the current run, created once per run and inherited by worker processes through the environment."""
+    if RUN_ID_VARIABLE not in os.environ:
+        os.environ[RUN_ID_VARIABLE] = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    return os.environ[RUN_ID_VARIABLE]
+
+def run_log_path(path=None):
+    """Path of the run log, or None if logging is turned off."""
+    if path is not None:
+        return path
+    return os.environ.get(RUN_LOG_VARIABLE, DEFAULT_RUN_LOG) or None
+
+def _stage_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _io_counters():
+    """Bytes read and written by this process so far (Linux /proc/self/io), or None where unavailable."""
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(':') for line in io)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _reset_peak_rss():
+    """Reset the peak resident memory of this process (Linux 4.0 and later); returns whether it was reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    """Peak resident memory of this process in MB, since the last reset if it could be reset."""
+    try:
+        with open('/proc/self/status') as status:
+            return next(int(line.split()[1]) / 1024 for line in status if line.startswith('VmHWM'))
+    except (OSError, StopIteration):
+        if resource is None:
+            return None
+        # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _children_usage():
+    """CPU seconds and peak resident memory in MB of the finished child processes."""
+    if resource is None:
+        return 0.0, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak = usage.ru_maxrss / (1024 * 1024) if sys.platform == 'darwin' else usage.ru_maxrss / 1024
+    return usage.ru_utime + usage.ru_stime, peak
+
+def write_record(record, path=None):
+    """Append one record to the run log as a JSON line. Lines are written in one call, so processes can share a log."""
+    path = run_log_path(path)
+    if path is None:
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a') as log:
+        log.write(json.dumps(record, default=str) + '\n')
+
+@contextmanager
+def stage(name, file=None, log_path=None, **fields):
+    """
+    Time a stage of a script and append its record to the run log.
+
+    Input:
+    - name (str): Name of the stage, e.g. 'segment_chlamy' or 'segment_chlamy.file'.
+    - file (str): Optional file the stage processes, for per-file records.
+    - log_path (str): Optional run log, instead of CHLAMY_RUN_LOG or ./run_log.jsonl.
+    - fields: Further values stored with the record.
+    Output:
+    - The record (dict) is yielded, so the stage can set 'items' (e.g. frames, cells or rows processed) and,
+      if it knows them better than the process counters, 'bytes_read' and 'bytes_written'.
+
+    The peak resident memory is that of the process since the outermost running stage started. Errors are
+    recorded with the stage and raised again.
+    """
+    stack = _stage_stack()
+    record = {'run_id': run_id(), 'stage': name, 'file': file, 'parent': stack[-1] if stack else None,
+              'script': os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None, 'pid': os.getpid(),
+              'start': datetime.now().isoformat(timespec='milliseconds'), 'items': 0,
+              'bytes_read': None, 'bytes_written': None}
+    record.update(fields)
+    if not stack:
+        _reset_peak_rss()
+    stack.append(name)
+
+    io_start = _io_counters()
+    children_cpu_start, _ = _children_usage()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    record['status'] = 'ok'
+    try:
+        yield record
+    except BaseException as error:
+        record['status'] = 'error'
+        record['error'] = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        children_cpu_end, children_peak = _children_usage()
+        io_end = _io_counters()
+        stack.pop()
+
+        record['wall_s'] = wall
+        record['cpu_s'] = cpu
+        record['children_cpu_s'] = children_cpu_end - children_cpu_start
+        record['peak_rss_mb'] = _peak_rss_mb()
+        record['children_peak_rss_mb'] = children_peak
+        if io_start is not None and io_end is not None:
+            if record['bytes_read'] is None:
+                record['bytes_read'] = io_end[0] - io_start[0]
+            if record['bytes_written'] is None:
+                record['bytes_written'] = io_end[1] - io_start[1]
+        record['items_per_s'] = record['items'] / wall if record['items'] and wall > 0 else None
+        write_record(record, log_path)
+
+def instrumented(name=None, **fields):
+    """Decorator that runs every call of a function as a stage named after the function (or name)."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__, **fields):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def setup_logging(path='log.txt', level=logging.INFO, console_level=logging.INFO):
+    """
+    Send log messages of at least level to a log file (appended to), and those of at least console_level to
+    the console. Calling it again with the same file adds no further handlers.
+    """
+    root = logging.getLogger()
+    root.setLevel(min(level, console_level))
+    path = os.path.abspath(path)
+    if not any(isinstance(handler, logging.FileHandler) and handler.baseFilename == path for handler in root.handlers):
+        file_handler = logging.FileHandler(path)
+        file_handler.setLevel(level)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        root.addHandler(file_handler)
+    if not any(type(handler) is logging.StreamHandler for handler in root.handlers):
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setLevel(console_level)
+        root.addHandler(console_handler)
+
+def load_run_logs(paths):
+    """DataFrame of the records of one or more run logs."""
+    import pandas as pd
+    records = []
+    for path in paths:
+        with open(path) as log:
+            records.extend(json.loads(line) for line in log if line.strip())
+    return pd.DataFrame(records)
+
+def summarize(records, by='stage', top=20, runs=None):
+    """
+    Hot spots of one or more runs: per stage (or file, or script) the number of calls and runs, total, mean
+    and maximum wall time, CPU time, the largest peak memory, items, items per second and bytes read and
+    written, sorted by total wall time. runs keeps only the last given number of runs.
+    """
+    import pandas as pd
+    if records.empty:
+        return pd.DataFrame()
+    if runs:
+        last_runs = records.groupby('run_id')['start'].min().sort_values().index[-runs:]
+        records = records[records['run_id'].isin(last_runs)]
+    if by == 'file':
+        records = records[records['file'].notna()]
+    records = records.assign(cpu_total_s=records['cpu_s'] + records['children_cpu_s'].fillna(0),
+                             errors=records['status'] != 'ok')
+    summary = records.groupby(by, dropna=False).agg(
+        calls=('wall_s', 'size'), runs=('run_id', 'nunique'), wall_total_s=('wall_s', 'sum'),
+        wall_mean_s=('wall_s', 'mean'), wall_max_s=('wall_s', 'max'), cpu_total_s=('cpu_total_s', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'), items=('items', 'sum'), bytes_read=('bytes_read', 'sum'),
+        bytes_written=('bytes_written', 'sum'), errors=('errors', 'sum'))
+    summary['items_per_s'] = (summary['items'] / summary['wall_total_s']).where(summary['items'] > 0)
+    summary['cpu_per_wall'] = summary['cpu_total_s'] / summary['wall_total_s']
+    return summary.sort_values('wall_total_s', ascending=False).head(top).reset_index()
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize the hot spots of one or more run logs.')
+    parser.add_argument('run_logs', nargs='*', default=[DEFAULT_RUN_LOG], help='JSONL run logs.')
+    parser.add_argument('--by', choices=['stage', 'file', 'script', 'run_id'], default='stage',
+                        help='Group the records by stage, file, script or run.')
+    parser.add_argument('--top', type=int, default=20, help='Number of rows shown.')
+    parser.add_argument('--runs', type=int, default=None, help='Only the last given number of runs.')
+    parser.add_argument('--output', default=None, help='Optional CSV of the summary.')
+    args = parser.parse_args()
+
+    import pandas as pd
+    records = load_run_logs(args.run_logs)
+    summary = summarize(records, args.by, args.top, args.runs)
+    if args.output:
+        summary.to_csv(args.output, index=False)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(summary.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+
+if __name__ == "__main__":
+    main()
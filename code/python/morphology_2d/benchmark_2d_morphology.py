@@ -0,0 +1,240 @@
+"""
+The script benchmarks the 2D morphology protocol on synthetic data at
+several scales. For every scale it writes a scratch "./experiments" tree
+with synthetic_2d_dataset.py (the given number of pools per experiment and
+species) and runs focus_filter_laplacian.py, segment_chlamy.py,
+max_area_focus_seq.py and parse_2d_morphology.py on it as they are run on
+the real data, from the scratch directory. Between focus filtering and
+segmentation, probability maps of the written focal sequences take the
+place of the Ilastik pixel classification.
+
+For every stage it reports the wall and CPU time and peak memory from the
+run log, and the number of items processed, and it checks the outputs
+against the ground truth: that the focal sequences contain the sharpest
+frames, that the segmented objects and the max-area objects have exactly
+the expected areas, that in-focus objects have the area, axis lengths and
+eccentricity of the synthetic ellipses, and that the per pool means are those of the
+max-area objects. The script exits with an error if a check fails.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_2d_dataset import (generate_dataset, read_focus_sequences, true_focus_sequences,
+                                  write_probability_maps)
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['focus_filter_laplacian', 'segment_chlamy', 'max_area_focus_seq', 'parse_2d_morphology']
+# Area limits of segment_chlamy.py (diameters of 3 and 40 pixels)
+MIN_AREA = np.pi * 1.5 ** 2
+MAX_AREA = np.pi * 20 ** 2
+IMAGE_PATTERN = re.compile(r'_seq(?P<sequence>\d+)_f(?P<first>\d+)to(?P<last>\d+)_Probabilities_(?P<index>\d+)\.tif$')
+
+def run_stage(script, root, run_log, run_id):
+    """Run a pipeline script from root as it is run on the real data; returns the wall time of the process."""
+    env = dict(os.environ, CHLAMY_RUN_LOG=run_log, CHLAMY_RUN_ID=run_id, MPLBACKEND='Agg',
+               PYTHONWARNINGS='ignore')
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(SCRIPTS_DIRECTORY, f'{script}.py')], cwd=root, env=env,
+                   stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def stage_records(run_log, run_id):
+    """Top-level stage records of a run, by stage name."""
+    records = {}
+    with open(run_log) as log:
+        for line in log:
+            record = json.loads(line)
+            if record['run_id'] == run_id and record['parent'] is None:
+                records[record['stage']] = record
+    return records
+
+def read_csvs(directory, name):
+    """All CSV files of the given name below a directory, concatenated."""
+    tables = [pd.read_csv(os.path.join(dirpath, name), dtype={'metadata_pool_id': str})
+              for dirpath, _, filenames in os.walk(directory) if name in filenames]
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+def check_focus(truth, sequences):
+    """
+    Fraction of the true focal sequences whose sharpest frame is in a written sequence (recall), and of the
+    written sequences that contain a frame of a true focal sequence (precision).
+    """
+    defocus = truth['frames'].set_index(['experiment', 'species', 'pool_id', 'frame'])['defocus'].abs()
+    hits, true_total, written_hits, written_total = 0, 0, 0, 0
+    for key, true_sequences in true_focus_sequences(truth['frames']).items():
+        written = sequences.get(key, [])
+        written_frames = {frame for first, last in written for frame in range(first, last + 1)}
+        true_frames = {frame for first, last in true_sequences for frame in range(first, last + 1)}
+        for first, last in true_sequences:
+            sharpest = min(range(first, last + 1), key=lambda frame: defocus.loc[key + (frame,)])
+            hits += sharpest in written_frames
+            true_total += 1
+        written_hits += sum(bool(true_frames & set(range(first, last + 1))) for first, last in written)
+        written_total += len(written)
+    return hits / max(true_total, 1), written_hits / max(written_total, 1)
+
+def check_outputs(root, truth, objects):
+    """Compare the objects, max_area and per pool mean tables with the ground truth; returns {check: value}."""
+    experiments_directory = os.path.join(root, 'experiments')
+    expected = objects[(objects['area_px'] >= MIN_AREA) & (objects['area_px'] <= MAX_AREA)]
+    checks = {}
+
+    # Segmentation: every probability map holds exactly the expected object areas
+    measured = read_csvs(experiments_directory, 'object_measurements.csv')
+    expected_areas = expected.groupby('Image')['area_px'].apply(lambda areas: sorted(areas.astype(float)))
+    measured_areas = measured.groupby('Image')['Area'].apply(lambda areas: sorted(areas.astype(float)))
+    images = expected_areas.index.union(measured_areas.index)
+    checks['segment_maps_exact'] = np.mean([expected_areas.get(image, []) == measured_areas.get(image, [])
+                                            for image in images])
+
+    # Max area: the largest object of every sequence
+    max_area = read_csvs(experiments_directory, 'max_area_data.csv')
+    max_area = max_area.rename(columns={'metadata_experiment': 'experiment', 'metadata_species': 'species',
+                                        'metadata_pool_id': 'pool_id', 'metadata_sequence': 'sequence'})
+    keys = ['experiment', 'species', 'pool_id', 'sequence']
+    expected_max = expected.groupby(keys)['area_px'].max().rename('expected_area').reset_index()
+    merged = expected_max.merge(max_area, on=keys, how='outer')
+    checks['max_area_exact'] = float((merged['Area'] == merged['expected_area']).mean())
+
+    # Analytic shape: max-area objects in focus have the area and eccentricity of the nearest synthetic ellipse
+    parsed = max_area['Image'].str.extract(IMAGE_PATTERN).astype(int)
+    max_area['frame'] = parsed['first'] + parsed['index']
+    frames = truth['frames'].set_index(['experiment', 'species', 'pool_id', 'frame'])['defocus']
+    max_area['defocus'] = frames.loc[list(max_area[['experiment', 'species', 'pool_id', 'frame']]
+                                          .itertuples(index=False, name=None))].to_numpy()
+    in_focus = max_area[max_area['defocus'].abs() <= 0.5]
+    positions = truth['positions'].merge(truth['cells'], on=['experiment', 'species', 'pool_id', 'cell_id'])
+    candidates = in_focus.reset_index().merge(positions, on=['experiment', 'species', 'pool_id', 'frame'])
+    candidates['distance'] = np.hypot(candidates['Center_X'] - candidates['x'] - candidates['subpixel_x'],
+                                      candidates['Center_Y'] - candidates['y'] - candidates['subpixel_y'])
+    matched = candidates.loc[candidates.groupby('index')['distance'].idxmin()]
+    checks['in_focus_objects'] = len(matched)
+    checks['area_relative_error_max'] = float((matched['Area'] / matched['area'] - 1).abs().max())
+    axis_errors = pd.concat([matched['MajorAxisLength'] / matched['major_axis_length'] - 1,
+                             matched['MinorAxisLength'] / matched['minor_axis_length'] - 1])
+    checks['axis_relative_error_max'] = float(axis_errors.abs().max())
+    # The eccentricity of nearly round cells changes steeply with their axes, so only elongated cells are compared
+    elongated = matched[matched['eccentricity'] >= 0.5]
+    checks['eccentricity_error_max'] = float((elongated['Eccentricity'] - elongated['eccentricity']).abs().max())
+
+    # Per pool means: the mean of the max-area objects of every pool
+    means = pd.read_csv(os.path.join(experiments_directory, 'measure_2d_exp_species.v.1.csv'), dtype={'pool_id': str})
+    expected_means = expected_max.groupby(['experiment', 'species', 'pool_id'])['expected_area'].mean().reset_index()
+    merged = expected_means.merge(means, on=['experiment', 'species', 'pool_id'], how='outer')
+    checks['pool_means_exact'] = float(np.isclose(merged['mean_area'], merged['expected_area']).mean())
+    return checks
+
+def run_scale(root, n_pools, args):
+    """Generate the data set of one scale and run the protocol on it; returns (stage rows, checks)."""
+    os.makedirs(root)
+    run_log = os.path.join(root, 'run_log.jsonl')
+    run_id = f"pools{n_pools}"
+
+    truth = generate_dataset(root, args.experiments, args.species, n_pools, args.frames, args.size, args.cells,
+                             args.size_scale, args.drift_amplitude, seed=args.seed)
+    n_stacks = len(args.experiments) * len(args.species) * n_pools
+
+    process_seconds = {'focus_filter_laplacian': run_stage('focus_filter_laplacian', root, run_log, run_id)}
+    sequences = read_focus_sequences(root)
+    start = time.perf_counter()
+    objects = write_probability_maps(root, truth, sequences, args.size)
+    probability_seconds = time.perf_counter() - start
+    for script in STAGES[1:]:
+        process_seconds[script] = run_stage(script, root, run_log, run_id)
+
+    records = stage_records(run_log, run_id)
+    max_area = read_csvs(os.path.join(root, 'experiments'), 'max_area_data.csv')
+    items = {'focus_filter_laplacian': n_stacks, 'segment_chlamy': objects['Image'].nunique(),
+             'max_area_focus_seq': len(max_area), 'parse_2d_morphology': n_stacks}
+    rows = [{'pools': n_pools, 'stage': 'probability_maps (synthetic)', 'items': objects['Image'].nunique(),
+             'process_s': probability_seconds, 'wall_s': probability_seconds}]
+    for script in STAGES:
+        record = records.get(script, {})
+        rows.append({'pools': n_pools, 'stage': script, 'items': items[script], 'process_s': process_seconds[script],
+                     'wall_s': record.get('wall_s'), 'cpu_s': record.get('cpu_s'),
+                     'peak_rss_mb': record.get('peak_rss_mb')})
+
+    recall, precision = check_focus(truth, sequences)
+    checks = dict({'pools': n_pools, 'focus_recall': recall, 'focus_precision': precision},
+                  **check_outputs(root, truth, objects))
+    return rows, checks
+
+def failed_checks(checks, args):
+    """Names of the checks outside their tolerances."""
+    limits = {'focus_recall': lambda value: value >= args.min_focus_recall,
+              'focus_precision': lambda value: value >= args.min_focus_precision,
+              'segment_maps_exact': lambda value: value == 1,
+              'max_area_exact': lambda value: value == 1,
+              'in_focus_objects': lambda value: value > 0,
+              'area_relative_error_max': lambda value: value <= args.area_tolerance,
+              'axis_relative_error_max': lambda value: value <= args.area_tolerance,
+              'eccentricity_error_max': lambda value: value <= args.eccentricity_tolerance,
+              'pool_means_exact': lambda value: value == 1}
+    return [name for name, within in limits.items() if not within(checks[name])]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the 2D morphology protocol on synthetic data.')
+    parser.add_argument('--root', default='./benchmark_2d_morphology', help='Scratch directory.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 4, 16],
+                        help='Pools per experiment and species at every scale.')
+    parser.add_argument('--experiments', nargs='+', default=['exp1', 'exp2'], help='Experiment names.')
+    parser.add_argument('--species', nargs='+', default=['cr', 'cs'], help='Species.')
+    parser.add_argument('--frames', type=int, default=60, help='Frames per pool stack.')
+    parser.add_argument('--size', type=int, default=192, help='Width and height of the pool stacks in pixels.')
+    parser.add_argument('--cells', type=float, default=3, help='Mean number of cells per pool.')
+    parser.add_argument('--size-scale', type=float, default=1.0, help='Factor on the cell sizes of every species.')
+    parser.add_argument('--drift-amplitude', type=float, default=3.0, help='Amplitude of the focus drift.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--min-focus-recall', type=float, default=0.8,
+                        help='Smallest accepted recall of the focal sequences.')
+    parser.add_argument('--min-focus-precision', type=float, default=0.8,
+                        help='Smallest accepted precision of the focal sequences.')
+    parser.add_argument('--area-tolerance', type=float, default=0.08,
+                        help='Largest accepted relative area and axis length error of in-focus objects.')
+    parser.add_argument('--eccentricity-tolerance', type=float, default=0.1,
+                        help='Largest accepted eccentricity error of elongated in-focus objects.')
+    parser.add_argument('--output', default='benchmark_2d_report.csv', help='CSV of the stage timings.')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch directory.')
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    # The scratch directory is deleted afterwards, so only a new or empty directory is used
+    if os.path.isdir(root) and os.listdir(root):
+        parser.error(f"{root} is not empty; remove it or give another --root.")
+    all_rows, all_checks = [], []
+    # Every scale gets its own directory in root, so a scale given twice is run once
+    for n_pools in dict.fromkeys(args.scales):
+        rows, checks = run_scale(os.path.join(root, f'pools_{n_pools}'), n_pools, args)
+        all_rows.extend(rows)
+        all_checks.append(checks)
+    if not args.keep:
+        shutil.rmtree(root)
+
+    report = pd.DataFrame(all_rows)
+    report['items_per_s'] = report['items'] / report['wall_s']
+    checks = pd.DataFrame(all_checks)
+    checks['failed'] = [', '.join(failed_checks(row, args)) for row in all_checks]
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(report.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+        print()
+        print(checks.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+    report.to_csv(args.output, index=False)
+    checks.to_csv(os.path.splitext(args.output)[0] + '_checks.csv', index=False)
+
+    if (checks['failed'] != '').any():
+        print("Some outputs differ from the ground truth.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
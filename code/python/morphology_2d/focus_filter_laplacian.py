@@ -13,12 +13,16 @@ organized by experiment and species, in an output directory.
 
 # Import required libraries
 import os
+import sys
 import numpy as np
 import cv2
 import tifffile
 from skimage import io
 from itertools import groupby, count
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented, stage
+
 # Compute focus measure using the variance of Laplacian
 def compute_focus_measure(frame):
     return cv2.Laplacian(frame, cv2.CV_64F).var()
@@ -64,6 +68,7 @@ def process_tif_stack(stack_path, percentile, exclude_start=4, exclude_end=4):
     return original_stack, all_relevant_frames
 
 # Process directories and TIF files within them
+@instrumented('focus_filter_laplacian')
 def process_directory(root_directory, percentile):
     # Check if root directory exists
     if not os.path.exists(root_directory):
@@ -92,13 +97,16 @@ def process_directory(root_directory, percentile):
                         os.makedirs(output_root)
 
                     try:
-                        # Process TIF files and save output
-                        stack, all_relevant_frames = process_tif_stack(input_path, percentile)
-                        sequences = find_consecutive_sequences(all_relevant_frames)
-
-                        for seq_num, sequence in enumerate(sequences, start=1):
-                            output_path = os.path.join(output_root, f"{base_name}_seq{seq_num}_f{sequence[0]}to{sequence[-1]}.tif")
-                            tifffile.imwrite(output_path, stack[sequence])
+                        # Process TIF files and save output, recording the time and memory of every stack
+                        with stage('focus_filter_laplacian.stack', file=input_path) as record:
+                            stack, all_relevant_frames = process_tif_stack(input_path, percentile)
+                            sequences = find_consecutive_sequences(all_relevant_frames)
+
+                            for seq_num, sequence in enumerate(sequences, start=1):
+                                output_path = os.path.join(output_root, f"{base_name}_seq{seq_num}_f{sequence[0]}to{sequence[-1]}.tif")
+                                tifffile.imwrite(output_path, stack[sequence])
+                            record['items'] = len(stack)
+                            record['frames_kept'] = len(all_relevant_frames)
                     except Exception as e:
                         print(f"An error occurred while processing {filename}: {e}")
 
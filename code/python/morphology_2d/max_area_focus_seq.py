@@ -10,7 +10,12 @@ This Python script reads multiple CSV files located in a directory structure
 import shutil
 import os
 import pandas as pd
+import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented
+
+@instrumented('max_area_focus_seq')
 def extract_max_area_object(base_directory):
     """Extracts and saves the object with the maximal area for each unique sequence in each CSV file."""
 
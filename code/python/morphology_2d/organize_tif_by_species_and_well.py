@@ -1,62 +1,255 @@
 """
 This Python code scans through subdirectories under a `base_directory` labeled as
 `./experiments` to find files in "prob_map" directories with names ending with `.tif`.
-It logs found files and checks if they follow an expected naming format
+It checks if they follow an expected naming format
 (should contain '_seq' and prefixes either 'cr' or 'cs').
 The code then organizes these `.tif` files into new directories
 based on species ('cr' or 'cs') and pool ID.
+
+All placements are planned from one scan of the prob_maps directories and then
+carried out by a pool of threads. Instead of copying, a file is placed as a hard
+link by default (or a reflink or a symbolic link), so the organized tree takes
+no further disk space; where that is not possible, e.g. across file systems, the
+file is copied. Files already in place (the same file, or a copy of the same size
+and modification time) are left alone, so a re-run does no I/O for them. Instead
+of a log line per file, every experiment gets a manifest,
+prob_maps_organized/manifest.csv, listing each file with its destination and
+how it was placed, also on re-runs, or why it was skipped or failed.
 """
 # Import necessary modules
+import argparse  # For the command-line arguments
+import csv  # For writing the manifests
+import errno  # For telling apart the errors links can fail with
 import os  # For file and directory operations
 import shutil  # For file operations like copy
 import logging  # For logging information and warnings
+import sys  # For finding the shared instrumentation module
+import threading  # For temporary file names unique to each thread
+from concurrent.futures import ThreadPoolExecutor  # For placing files in parallel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import stage  # For recording the time and amount of work of the stage
+
+SPECIES_PREFIXES = ['cr', 'cs']
+METHODS = ['hardlink', 'reflink', 'symlink', 'copy']
+MANIFEST_NAME = 'manifest.csv'
+MANIFEST_COLUMNS = ['experiment', 'species', 'pool_id', 'source', 'destination', 'status', 'method', 'bytes']
+# Linux ioctl cloning a file's extents (btrfs, XFS, bcachefs and others with copy-on-write)
+FICLONE = 0x40049409
+
+logger = logging.getLogger(__name__)
+
+def scan_tif_files(directory):
+    """Paths and stats of all .tif files below a directory, from one walk with os.scandir."""
+    found = []
+    pending = [directory]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            elif entry.name.endswith('.tif'):
+                found.append((entry.path, entry.stat()))
+    return sorted(found)
+
+def plan_moves(base_directory='./experiments'):
+    """
+    Plan the placement of every probability map of every experiment in prob_maps_organized/{species}/{pool_id}.
+    Returns one dict per .tif file; files that do not follow the naming format get status 'skipped: ...'.
+    """
+    plan = []
+    destinations = {}
+    experiments = sorted(entry.name for entry in os.scandir(base_directory) if entry.is_dir())
+    for experiment in experiments:
+        prob_maps_directory = os.path.join(base_directory, experiment, 'prob_maps')
+        prob_maps_organized_directory = os.path.join(base_directory, experiment, 'prob_maps_organized')
+        for source, source_stat in scan_tif_files(prob_maps_directory):
+            filename = os.path.basename(source)
+            move = {'experiment': experiment, 'species': None, 'pool_id': None, 'source': source,
+                    'destination': None, 'status': 'planned', 'method': None, 'bytes': source_stat.st_size,
+                    'stat': source_stat}
+            plan.append(move)
+
+            seq_pos = filename.find('_seq')
+            if seq_pos == -1:
+                move['status'] = "skipped: missing '_seq'"
+                continue
+
+            prefix = filename.split('_')[0]
+            if prefix not in SPECIES_PREFIXES:
+                move['status'] = 'skipped: unexpected prefix'
+                continue
+
+            move['species'] = prefix
+            move['pool_id'] = filename[len(prefix)+1:seq_pos]
+            destination = os.path.join(prob_maps_organized_directory, prefix, move['pool_id'], filename)
+            if destination in destinations:
+                move['status'] = f"skipped: same name as {destinations[destination]}"
+                continue
+            destinations[destination] = source
+            move['destination'] = destination
+    return plan
+
+def is_placed(source, source_stat, destination):
+    """Whether destination already is source: the same file (hard or symbolic link), or a copy of equal size and time."""
+    try:
+        destination_stat = os.stat(destination)
+    except OSError:
+        return False
+    if (destination_stat.st_dev, destination_stat.st_ino) == (source_stat.st_dev, source_stat.st_ino):
+        return True
+    return (destination_stat.st_size == source_stat.st_size
+            and destination_stat.st_mtime_ns == source_stat.st_mtime_ns)
+
+def placed_method(source_stat, destination, previous_method=None):
+    """
+    How an existing destination was placed: a symbolic link, a hard link (the same file) or a copy. A reflink cannot
+    be told from a copy by its stat, so a copy keeps the method of the previous manifest if that was 'reflink'.
+    """
+    destination_stat = os.lstat(destination)
+    if os.path.islink(destination):
+        return 'symlink'
+    if (destination_stat.st_dev, destination_stat.st_ino) == (source_stat.st_dev, source_stat.st_ino):
+        return 'hardlink'
+    return 'reflink' if previous_method == 'reflink' else 'copy'
+
+def read_previous_methods(base_directory, experiment):
+    """Method of every destination in the manifest of an earlier run, if there is one."""
+    path = os.path.join(base_directory, experiment, 'prob_maps_organized', MANIFEST_NAME)
+    try:
+        with open(path, newline='') as manifest:
+            return {row['destination']: row['method'] for row in csv.DictReader(manifest) if row.get('method')}
+    except (OSError, KeyError, csv.Error):
+        return {}
 
-# Initialize the logging system to show info-level messages
-logging.basicConfig(level=logging.INFO)
+def reflink(source, destination):
+    """Clone source to destination sharing its data blocks; raises OSError where the file system cannot."""
+    import fcntl
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copystat(source, destination)
 
-# Define the base directory where experiments are located
-base_directory = './experiments'
+def link_or_copy(source, destination, method):
+    """
+    Create destination from source with the given method, falling back to a copy where the method is not
+    possible (another file system, no link support). Returns the method used.
+    """
+    try:
+        if method == 'hardlink':
+            os.link(source, destination)
+        elif method == 'reflink':
+            reflink(source, destination)
+        elif method == 'symlink':
+            os.symlink(os.path.relpath(source, os.path.dirname(destination)), destination)
+        else:
+            shutil.copy2(source, destination)
+        return method
+    except OSError as error:
+        if method == 'copy' or error.errno == errno.ENOSPC:
+            raise
+        if os.path.lexists(destination):
+            os.remove(destination)
+        shutil.copy2(source, destination)
+        return 'copy'
 
-# Get a list of all experiments; os.listdir gives names of all files and directories in the given directory
-# We use os.path.isdir to filter only directories
-experiments = [dir for dir in os.listdir(base_directory) if os.path.isdir(os.path.join(base_directory, dir))]
+def place_file(move, method='hardlink', previous_methods=None):
+    """
+    Carry out one planned move, unless the file is already in place; fills in its status and method. A file that
+    cannot be placed gets status 'error: ...' instead of stopping the other moves.
+    """
+    if move['status'] != 'planned':
+        return move
+    source, destination = move['source'], move['destination']
+    # The file is created under a temporary name and renamed, so an interrupted run leaves no partial file
+    temporary = f"{destination}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        if is_placed(source, move['stat'], destination):
+            move['method'] = placed_method(move['stat'], destination, (previous_methods or {}).get(destination))
+            move['status'] = 'existing'
+            return move
 
-# Loop over each experiment
-for experiment in experiments:
-    # Construct the path to the 'prob_maps' subdirectory inside each experiment
-    prob_maps_directory = os.path.join(base_directory, experiment, 'prob_maps')
-    # Create the new directory path for 'prob_maps_organized'
-    prob_maps_organized_directory = os.path.join(base_directory, experiment, 'prob_maps_organized')
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+        move['method'] = link_or_copy(source, temporary, method)
+        os.replace(temporary, destination)
+        move['status'] = 'placed'
+    except OSError as error:
+        move['method'] = None
+        move['status'] = f"error: {error}"
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+    return move
 
-    # os.walk goes through all subdirectories and files in a directory
-    for dirpath, dirnames, filenames in os.walk(prob_maps_directory):
-        # Loop over each file in the directory
-        for filename in filenames:
-            # Check if the file is a .tif file
-            if filename.endswith(".tif"):
-                logging.info(f"Found .tif file {filename} in {dirpath}")
+def write_manifests(plan, base_directory='./experiments'):
+    """Write the plan of every experiment to prob_maps_organized/manifest.csv; returns the manifest paths."""
+    paths = []
+    for experiment in sorted({move['experiment'] for move in plan}):
+        directory = os.path.join(base_directory, experiment, 'prob_maps_organized')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, MANIFEST_NAME)
+        with open(path, 'w', newline='') as manifest:
+            writer = csv.DictWriter(manifest, fieldnames=MANIFEST_COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(move for move in plan if move['experiment'] == experiment)
+        paths.append(path)
+    return paths
 
-                seq_pos = filename.find('_seq')
-                if seq_pos == -1:
-                    logging.warning(f"Skipping file {filename} in {dirpath} due to missing '_seq'.")
-                    continue
+def organize_prob_maps(base_directory='./experiments', method='hardlink', workers=None):
+    """
+    Place the probability maps of every experiment in prob_maps_organized/{species}/{pool_id} as hard links,
+    reflinks or symbolic links (method), or copies where links are not possible, using a pool of threads.
+    Returns the plan, with the status and method of every file.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method {method}; expected one of {', '.join(METHODS)}.")
+    with stage('organize_tif_by_species_and_well', file=base_directory, method=method) as record:
+        plan = plan_moves(base_directory)
 
-                prefix = filename.split('_')[0]
-                pool_id = filename[len(prefix)+1:seq_pos]
+        # Create every destination directory once, before the threads start
+        for directory in sorted({os.path.dirname(move['destination']) for move in plan if move['destination']}):
+            os.makedirs(directory, exist_ok=True)
+        previous_methods = {}
+        for experiment in sorted({move['experiment'] for move in plan}):
+            previous_methods.update(read_previous_methods(base_directory, experiment))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda move: place_file(move, method, previous_methods), plan))
+        write_manifests(plan, base_directory)
 
-                if prefix not in ['cr', 'cs']:
-                    logging.warning(f"Skipping file {filename} in {dirpath} due to unexpected prefix.")
-                    continue
+        placed = [move for move in plan if move['status'] == 'placed']
+        record['items'] = len(plan)
+        record['bytes_written'] = sum(move['bytes'] for move in placed if move['method'] == 'copy')
 
-                # Create the new directory under 'prob_maps_organized'
-                new_directory = os.path.join(prob_maps_organized_directory, prefix, pool_id)
+    counts = {}
+    for move in plan:
+        if move['status'] in ('placed', 'existing'):
+            status = f"{move['status']} ({move['method']})"
+        else:
+            status = 'error' if move['status'].startswith('error') else move['status']
+        counts[status] = counts.get(status, 0) + 1
+    summary = ', '.join(f"{count} {status}" for status, count in sorted(counts.items()))
+    logger.info(f"Organized {len(plan)} probability maps: {summary or 'none found'}. See {MANIFEST_NAME} "
+                f"in each prob_maps_organized directory.")
+    skipped = sum(move['status'].startswith('skipped') for move in plan)
+    if skipped:
+        logger.warning(f"Skipped {skipped} files that do not follow the naming format; see the manifests.")
+    errors = sum(move['status'].startswith('error') for move in plan)
+    if errors:
+        logger.error(f"Could not place {errors} files; see the manifests for the errors.")
+    return plan
 
-                # Create the directory if it does not exist
-                if not os.path.exists(new_directory):
-                    os.makedirs(new_directory)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Organize probability maps by species and pool ID.')
+    parser.add_argument('--base-directory', default='./experiments', help='Directory of the experiments.')
+    parser.add_argument('--method', choices=METHODS, default='hardlink',
+                        help='How files are placed; copies are made where links are not possible.')
+    parser.add_argument('--workers', type=int, default=None, help='Threads placing the files.')
+    args = parser.parse_args()
 
-                # Copy the file to the new directory under 'prob_maps_organized'
-                shutil.copy(os.path.join(dirpath, filename), os.path.join(new_directory, filename))
-                logging.info(f"Copied {filename} to {new_directory}")
+    # Initialize the logging system to show info-level messages
+    logging.basicConfig(level=logging.INFO)
 
-logging.info("Files reorganized successfully!")
+    # Define the base directory where experiments are located
+    organize_prob_maps(args.base_directory, args.method, args.workers)
@@ -10,7 +10,12 @@ which is saved in the base directory.
 
 import os
 import pandas as pd
+import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented
+
+@instrumented('parse_2d_morphology')
 def compute_area_means(base_directory):
     # Create a list to store the results
     results = []
@@ -24,6 +24,10 @@ from scipy.ndimage import label, find_objects, sum as ndi_sum  # For image proce
 from skimage.io import imread, imsave  # For reading and saving image files
 import pandas as pd  # For data manipulation and analysis
 from skimage.measure import regionprops  # For measuring properties of labeled image regions
+import sys  # For finding the shared instrumentation module
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented, stage  # For recording the time and memory of every stage
 
 # Function to segment cells in an image
 def segment_cells(prob_map_path, threshold=32767.5, min_diameter=3, max_diameter=40):
@@ -134,7 +138,8 @@ def extract_metadata_from_path(path):
     }
 
 # Function to process a directory containing image files
-def process_directory(root_directory):
+@instrumented('segment_chlamy')
+def process_directory(root_directory, threshold=32767.5, min_diameter=3, max_diameter=40):
     # Loop through each sub-directory and file in the root directory
     for root, dirs, files in os.walk(root_directory):
         # Only process directories that contain 'prob_maps_org' in their name
@@ -153,12 +158,15 @@ def process_directory(root_directory):
                     # Create the full path to the output file
                     output_path = os.path.join(output_dir, filename)
 
-                    # Run the cell segmentation function on the input file
-                    binary_map, properties = segment_cells(input_path)
-                    # Save the segmented image
-                    imsave(output_path, binary_map)
-                    # Save the properties of the segmented cells to a CSV file
-                    save_measurements_to_csv(input_path, properties)
+                    with stage('segment_chlamy.file', file=input_path) as record:
+                        # Run the cell segmentation function on the input file
+                        binary_map, properties = segment_cells(input_path, threshold, min_diameter, max_diameter)
+                        # Save the segmented image
+                        imsave(output_path, binary_map)
+                        # Save the properties of the segmented cells to a CSV file
+                        save_measurements_to_csv(input_path, properties)
+                        # Count the segmented cells
+                        record['items'] = len(properties)
 
 # Main function, entry point of the script
 if __name__ == "__main__":
@@ -0,0 +1,312 @@
+"""
+The script writes a synthetic "./experiments" tree for testing and
+benchmarking the 2D morphology protocol without the raw pool recordings.
+For every experiment, species and pool it writes a brightfield "pool"
+stack to experiments/{experiment}/pools_sample/{species}, in which cells
+of known size and shape (ellipses with species-specific semi-axes, random
+orientations and a little texture) move slightly from frame to frame while
+the focal plane drifts through them, so the frames are sharp only around
+the crossings of the focal plane. The number of pools, cells per pool,
+frames, the cell sizes and the amplitude and period of the focus drift are
+all set by arguments.
+
+In place of the Ilastik pixel classification, probability maps are
+rendered from the same ground truth for the frames of the focal sequences,
+one 2-channel 16-bit TIFF per frame named like the Ilastik export
+({pool}_seq{n}_f{first}to{last}_Probabilities_{frame}.tif), and saved to
+prob_maps_organized/{species}/{pool} as organize_tif_by_species_and_well.py
+arranges them (or to prob_maps, unorganized). The probability of a cell
+is its mask blurred by the defocus, so cells shrink out of focus and are
+at their true size in focus. The sequences are either those written by
+focus_filter_laplacian.py to focus_sample, or those the true focus gives.
+segment_chlamy.py, max_area_focus_seq.py and parse_2d_morphology.py then
+write the objects and max_area directories and the per pool means.
+
+The ground truth is saved next to the experiments directory:
+ground_truth_cells.csv (semi-axes, area, eccentricity and perimeter of
+every cell), ground_truth_frames.csv (defocus of every frame),
+ground_truth_positions.csv (cell positions in every frame) and, for the
+probability maps, ground_truth_objects.csv (the area every object has
+after thresholding, which the segmentation should measure exactly).
+"""
+
+import argparse
+import math
+import os
+import re
+import cv2
+import numpy as np
+import pandas as pd
+import tifffile
+
+# Semi-axes in pixels (mean, standard deviation) of the cells of each species
+SPECIES = {
+    'cr': {'semi_major': (6.0, 0.6), 'semi_minor': (4.8, 0.5)},
+    'cs': {'semi_major': (7.2, 0.7), 'semi_minor': (5.4, 0.5)},
+}
+BACKGROUND = 150
+CELL_INTENSITY = 90
+PROBABILITY_THRESHOLD = 32767.5
+
+def pool_name(species, pool_id):
+    """Base name of a pool stack, e.g. cr_pools_A1."""
+    return f"{species}_pools_{pool_id}"
+
+def pool_ids(n_pools):
+    """Well-like pool ids A1, B1, .. H1, A2, .., which pandas keeps as strings."""
+    return [f"{'ABCDEFGH'[index % 8]}{index // 8 + 1}" for index in range(n_pools)]
+
+def ellipse_perimeter(a, b):
+    """Ramanujan's approximation of the perimeter of an ellipse with semi-axes a and b."""
+    h = ((a - b) / (a + b)) ** 2
+    return math.pi * (a + b) * (1 + 3 * h / (10 + math.sqrt(4 - 3 * h)))
+
+def defocus_profile(n_frames, rng, amplitude=3.0, period=(20, 40), offset=0.5):
+    """Distance of the focal plane from the cells in every frame: a sine of random period and phase plus an offset."""
+    frames = np.arange(n_frames)
+    frame_period = rng.uniform(*period)
+    phase = rng.uniform(0, 2 * np.pi)
+    return amplitude * np.sin(2 * np.pi * frames / frame_period + phase) + rng.uniform(-offset, offset)
+
+def cell_mask(cell):
+    """Mask of a cell around its centre, on a patch of odd size."""
+    half = int(math.ceil(cell['semi_major'])) + 2
+    yy, xx = np.mgrid[-half:half + 1, -half:half + 1].astype(float)
+    xx -= cell['subpixel_x']
+    yy -= cell['subpixel_y']
+    angle = math.radians(cell['angle'])
+    u = xx * math.cos(angle) + yy * math.sin(angle)
+    v = -xx * math.sin(angle) + yy * math.cos(angle)
+    return (u / cell['semi_major']) ** 2 + (v / cell['semi_minor']) ** 2 <= 1
+
+def cell_patch(cell, rng):
+    """Brightfield intensities of a textured cell around its centre, NaN outside the cell."""
+    mask = cell_mask(cell)
+    texture = cv2.GaussianBlur(rng.normal(0, 25, mask.shape), (0, 0), 1.0)
+    return np.where(mask, CELL_INTENSITY + texture, np.nan).astype(np.float32)
+
+def place_cells(n_cells, size, species, rng, size_scale=1.0):
+    """Cells on a jittered grid with room to move; returns the cells and the grid spacing."""
+    params = SPECIES[species]
+    max_semi_major = (params['semi_major'][0] + 4 * params['semi_major'][1]) * size_scale
+    spacing = 2 * int(math.ceil(max_semi_major)) + 20
+    slots_per_side = max(1, (size - 8) // spacing)
+    slots = rng.permutation(slots_per_side ** 2)[:min(n_cells, slots_per_side ** 2)]
+
+    cells = []
+    for cell_id, slot in enumerate(slots, start=1):
+        semi_major = max(rng.normal(*params['semi_major']) * size_scale, 2.5)
+        semi_minor = min(max(rng.normal(*params['semi_minor']) * size_scale, 2.0), semi_major)
+        cells.append({
+            'cell_id': cell_id,
+            'home_x': 4 + (slot % slots_per_side) * spacing + spacing // 2 + int(rng.integers(-2, 3)),
+            'home_y': 4 + (slot // slots_per_side) * spacing + spacing // 2 + int(rng.integers(-2, 3)),
+            'subpixel_x': rng.uniform(-0.5, 0.5),
+            'subpixel_y': rng.uniform(-0.5, 0.5),
+            'semi_major': semi_major,
+            'semi_minor': semi_minor,
+            'angle': rng.uniform(0, 180),
+        })
+    return cells, spacing
+
+def cell_tracks(n_cells, n_frames, rng, max_offset=4):
+    """Integer offsets of every cell from its home position in every frame, a random walk kept within max_offset."""
+    steps = rng.integers(-1, 2, size=(n_cells, n_frames, 2))
+    steps[:, 0] = 0
+    offsets = np.zeros_like(steps)
+    for frame in range(1, n_frames):
+        offsets[:, frame] = np.clip(offsets[:, frame - 1] + steps[:, frame], -max_offset, max_offset)
+    return offsets
+
+def paste(image, patch, x, y, combine):
+    """Combine a patch centred on (x, y) into an image, leaving out the parts of the patch outside the image."""
+    top, left = y - patch.shape[0] // 2, x - patch.shape[1] // 2
+    y0, x0 = max(top, 0), max(left, 0)
+    y1, x1 = min(top + patch.shape[0], image.shape[0]), min(left + patch.shape[1], image.shape[1])
+    window = image[y0:y1, x0:x1]
+    window[...] = combine(window, patch[y0 - top:y1 - top, x0 - left:x1 - left])
+
+def render_brightfield(patches, positions, defocus, size, rng, blur=1.0, noise=2.0):
+    """8-bit brightfield frame of cells at the given positions, blurred by the defocus, with camera noise."""
+    frame = np.full((size, size), BACKGROUND, dtype=np.float32)
+    for patch, (x, y) in zip(patches, positions):
+        # Cells are darker than the background; fmin ignores the NaN around them
+        paste(frame, patch, x, y, np.fmin)
+    frame = cv2.GaussianBlur(frame, (0, 0), 0.4 + blur * abs(defocus))
+    frame += rng.normal(0, noise, frame.shape).astype(np.float32)
+    return np.clip(np.rint(frame), 0, 255).astype(np.uint8)
+
+def probability_patch(mask, defocus, blur=1.0, depth_of_field=0.5):
+    """16-bit cell probability of a mask, blurred by the defocus beyond the depth of field."""
+    sigma = blur * max(abs(defocus) - depth_of_field, 0)
+    probability = mask.astype(np.float32)
+    if sigma > 0.05:
+        margin = int(math.ceil(3 * sigma)) + 1
+        probability = cv2.GaussianBlur(np.pad(probability, margin), (0, 0), sigma)
+    return np.rint(probability * 65535).astype(np.uint16)
+
+def generate_dataset(root, experiments=('exp1', 'exp2'), species=('cr', 'cs'), n_pools=4, n_frames=60, size=192,
+                     cells_per_pool=3, size_scale=1.0, drift_amplitude=3.0, drift_period=(20, 40), seed=0):
+    """
+    Write the pool stacks to root/experiments/{experiment}/pools_sample/{species} and the ground truth tables to
+    root. n_pools pools are written per experiment and species, each with a Poisson number of cells (at least one)
+    of mean cells_per_pool. Returns the ground truth as a dict of DataFrames (cells, frames, positions).
+    """
+    rng = np.random.default_rng(seed)
+    cell_rows, frame_rows, position_tables = [], [], []
+    for experiment in experiments:
+        for species_name in species:
+            directory = os.path.join(root, 'experiments', experiment, 'pools_sample', species_name)
+            os.makedirs(directory, exist_ok=True)
+            for pool_id in pool_ids(n_pools):
+                n_cells = max(1, int(rng.poisson(cells_per_pool)))
+                cells, spacing = place_cells(n_cells, size, species_name, rng, size_scale)
+                defocus = defocus_profile(n_frames, rng, drift_amplitude, drift_period)
+                offsets = cell_tracks(len(cells), n_frames, rng)
+                patches = [cell_patch(cell, rng) for cell in cells]
+
+                stack = np.empty((n_frames, size, size), dtype=np.uint8)
+                for frame in range(n_frames):
+                    positions = [(cell['home_x'] + offsets[index, frame, 0], cell['home_y'] + offsets[index, frame, 1])
+                                 for index, cell in enumerate(cells)]
+                    stack[frame] = render_brightfield(patches, positions, defocus[frame], size, rng)
+                tifffile.imwrite(os.path.join(directory, pool_name(species_name, pool_id) + '.tif'), stack)
+
+                keys = {'experiment': experiment, 'species': species_name, 'pool_id': pool_id}
+                for cell in cells:
+                    a, b = cell['semi_major'], cell['semi_minor']
+                    cell_rows.append(dict(keys, **cell, area=math.pi * a * b, eccentricity=math.sqrt(1 - (b / a) ** 2),
+                                          perimeter=ellipse_perimeter(a, b), major_axis_length=2 * a,
+                                          minor_axis_length=2 * b))
+                frame_rows.append(pd.DataFrame(dict(keys, frame=np.arange(n_frames), defocus=defocus)))
+                cell_ids = np.array([cell['cell_id'] for cell in cells])
+                position_tables.append(pd.DataFrame(dict(
+                    keys, cell_id=np.repeat(cell_ids, n_frames), frame=np.tile(np.arange(n_frames), len(cells)),
+                    x=(np.array([cell['home_x'] for cell in cells])[:, None] + offsets[:, :, 0]).ravel(),
+                    y=(np.array([cell['home_y'] for cell in cells])[:, None] + offsets[:, :, 1]).ravel())))
+
+    truth = {'cells': pd.DataFrame(cell_rows), 'frames': pd.concat(frame_rows, ignore_index=True),
+             'positions': pd.concat(position_tables, ignore_index=True)}
+    for name, table in truth.items():
+        table.to_csv(os.path.join(root, f'ground_truth_{name}.csv'), index=False)
+    return truth
+
+def load_ground_truth(root):
+    """The ground truth tables written by generate_dataset."""
+    return {name: pd.read_csv(os.path.join(root, f'ground_truth_{name}.csv'), dtype={'pool_id': str})
+            for name in ('cells', 'frames', 'positions')}
+
+def find_consecutive_sequences(frames):
+    """Runs of consecutive frame numbers in a sorted list."""
+    sequences = []
+    for frame in frames:
+        if sequences and frame == sequences[-1][-1] + 1:
+            sequences[-1].append(frame)
+        else:
+            sequences.append([frame])
+    return sequences
+
+def true_focus_sequences(frames, percentile=95, exclude_start=4, exclude_end=4, adjacent=3):
+    """
+    The focal sequences the true focus gives, selected like focus_filter_laplacian.py selects them from the
+    measured focus: frames sharper than the percentile, with adjacent frames. Returns {(experiment, species,
+    pool_id): [(first, last), ..]}.
+    """
+    sequences = {}
+    for key, pool in frames.groupby(['experiment', 'species', 'pool_id'], sort=False):
+        sharpness = -np.abs(pool.sort_values('frame')['defocus'].to_numpy())
+        n_frames = len(sharpness)
+        inner = sharpness[exclude_start:n_frames - exclude_end]
+        in_focus = np.where(inner > np.percentile(inner, percentile))[0] + exclude_start
+        selected = sorted({frame for index in in_focus
+                           for frame in range(max(0, index - adjacent), min(n_frames, index + adjacent + 1))})
+        sequences[key] = [(sequence[0], sequence[-1]) for sequence in find_consecutive_sequences(selected)]
+    return sequences
+
+def read_focus_sequences(root):
+    """The focal sequences focus_filter_laplacian.py wrote to experiments/*/focus_sample, in the same form."""
+    sequences = {}
+    pattern = re.compile(r'^(?P<species>[^_]+)_pools_(?P<pool_id>.+)_seq(?P<seq>\d+)_f(?P<first>\d+)to(?P<last>\d+)\.tif$')
+    experiments_directory = os.path.join(root, 'experiments')
+    for experiment in sorted(os.listdir(experiments_directory)):
+        focus_directory = os.path.join(experiments_directory, experiment, 'focus_sample')
+        for dirpath, _, filenames in os.walk(focus_directory):
+            for filename in filenames:
+                match = pattern.match(filename)
+                if match:
+                    key = (experiment, match['species'], match['pool_id'])
+                    sequences.setdefault(key, []).append((int(match['seq']), int(match['first']), int(match['last'])))
+    return {key: [(first, last) for _, first, last in sorted(values)] for key, values in sequences.items()}
+
+def write_probability_maps(root, truth, sequences, size, organized=True):
+    """
+    Render the Ilastik-like probability map of every frame of every focal sequence, and return the objects
+    each map holds: one row per map and cell with the area the cell has above the threshold of segment_chlamy.py.
+    """
+    cells = truth['cells'].set_index(['experiment', 'species', 'pool_id'])
+    defocus = truth['frames'].set_index(['experiment', 'species', 'pool_id', 'frame'])['defocus']
+    positions = truth['positions'].set_index(['experiment', 'species', 'pool_id', 'frame'])
+
+    objects = []
+    for key, pool_sequences in sequences.items():
+        experiment, species, pool_id = key
+        name = pool_name(species, pool_id)
+        if organized:
+            directory = os.path.join(root, 'experiments', experiment, 'prob_maps_organized', species, f"pools_{pool_id}")
+        else:
+            directory = os.path.join(root, 'experiments', experiment, 'prob_maps')
+        os.makedirs(directory, exist_ok=True)
+        pool_cells = cells.loc[[key]].reset_index()
+        masks = [cell_mask(cell) for cell in pool_cells.to_dict('records')]
+
+        for seq_number, (first, last) in enumerate(pool_sequences, start=1):
+            for index, frame in enumerate(range(first, last + 1)):
+                frame_defocus = defocus.loc[key + (frame,)]
+                frame_positions = positions.loc[[key + (frame,)]].set_index('cell_id')
+                probability = np.zeros((size, size), dtype=np.uint16)
+                image = f"{name}_seq{seq_number}_f{first}to{last}_Probabilities_{index}.tif"
+                for cell, mask in zip(pool_cells.to_dict('records'), masks):
+                    patch = probability_patch(mask, frame_defocus)
+                    x, y = frame_positions.loc[cell['cell_id'], ['x', 'y']]
+                    paste(probability, patch, int(x), int(y), np.maximum)
+                    objects.append({'experiment': experiment, 'species': species, 'pool_id': pool_id,
+                                    'sequence': seq_number, 'frames': f"{first}to{last}", 'frame': frame,
+                                    'Image': image, 'cell_id': cell['cell_id'], 'defocus': frame_defocus,
+                                    'area_px': int((patch > PROBABILITY_THRESHOLD).sum())})
+                tifffile.imwrite(os.path.join(directory, image), np.stack([probability, 65535 - probability], axis=-1),
+                                 photometric='minisblack', planarconfig='contig')
+
+    objects = pd.DataFrame(objects)
+    objects.to_csv(os.path.join(root, 'ground_truth_objects.csv'), index=False)
+    return objects
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic experiments tree for the 2D morphology protocol.')
+    parser.add_argument('--root', default='.', help='Directory in which "experiments" and the ground truth are written.')
+    parser.add_argument('--experiments', nargs='+', default=['exp1', 'exp2'], help='Experiment names.')
+    parser.add_argument('--species', nargs='+', default=['cr', 'cs'], choices=sorted(SPECIES), help='Species.')
+    parser.add_argument('--pools', type=int, default=4, help='Pools per experiment and species.')
+    parser.add_argument('--frames', type=int, default=60, help='Frames per pool stack.')
+    parser.add_argument('--size', type=int, default=192, help='Width and height of the pool stacks in pixels.')
+    parser.add_argument('--cells', type=float, default=3, help='Mean number of cells per pool.')
+    parser.add_argument('--size-scale', type=float, default=1.0, help='Factor on the cell sizes of every species.')
+    parser.add_argument('--drift-amplitude', type=float, default=3.0, help='Amplitude of the focus drift.')
+    parser.add_argument('--drift-period', type=float, nargs=2, default=[20, 40],
+                        help='Range of the period of the focus drift in frames.')
+    parser.add_argument('--unorganized', action='store_true',
+                        help='Write the probability maps to prob_maps instead of prob_maps_organized.')
+    parser.add_argument('--no-probability-maps', action='store_true', help='Only write the pool stacks.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    truth = generate_dataset(args.root, args.experiments, args.species, args.pools, args.frames, args.size,
+                             args.cells, args.size_scale, args.drift_amplitude, tuple(args.drift_period), args.seed)
+    print(f"Wrote {truth['frames'].groupby(['experiment', 'species', 'pool_id']).ngroups} pool stacks with "
+          f"{len(truth['cells'])} cells to {os.path.join(args.root, 'experiments')}")
+    if not args.no_probability_maps:
+        objects = write_probability_maps(args.root, truth, true_focus_sequences(truth['frames']), args.size,
+                                         not args.unorganized)
+        print(f"Wrote {objects['Image'].nunique()} probability maps")
+
+if __name__ == "__main__":
+    main()
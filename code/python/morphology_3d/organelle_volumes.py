@@ -0,0 +1,146 @@
+"""
+The script computes cell volumes and organelle to cell volume ratios
+from the dimensions of segmented cells, as the R notebooks
+ellipsoid_volume_v4.ipynb and organelle_ratio_v4.ipynb do. Every cell
+is treated as an ellipsoid with the measured width, height and depth as
+axes; its volume, semi-axes and eccentricity are computed for all cells at
+once, and the mitochondria and chloroplast volumes, when given, are divided
+by the cell volume. The cells are filtered like in the notebook (width
+above 6.0 and a chloroplast ratio of at most 1) and summarized per species
+in one groupby pass, with bootstrapped confidence intervals of the means
+computed for thousands of resamples as one matrix product per batch.
+
+New cells can be added to an existing cell table without recomputing the
+cells already in it, and the summaries are recomputed from the table in a
+fraction of a second.
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+CELL_COLUMNS = ['Filename', 'depth', 'height', 'width', 'species', 'volume', 'mito_volume', 'mito_cell_ratio',
+                'chlor_volume', 'chlor_cell_ratio', 'a', 'b', 'c', 'eccentricity']
+ORGANELLES = {'mito_volume': 'mito_cell_ratio', 'chlor_volume': 'chlor_cell_ratio'}
+MEASUREMENTS = ['volume', 'mito_volume', 'chlor_volume', 'mito_cell_ratio', 'chlor_cell_ratio', 'eccentricity']
+
+def ellipsoid_volume(width, height, depth):
+    """Volume of ellipsoids with the given axes (full lengths, not semi-axes)."""
+    return (4 / 3) * np.pi * (np.asarray(width) / 2) * (np.asarray(height) / 2) * (np.asarray(depth) / 2)
+
+def compute_cell_table(dimensions, organelles=None):
+    """
+    One row per cell with its ellipsoid volume, semi-axes, eccentricity and organelle ratios.
+
+    Input:
+    - dimensions (DataFrame): Filename, depth, height, width and species of every cell, as in
+      output_dimensions_mito_both.csv. Organelle volume columns (mito_volume, chlor_volume) are used if present.
+    - organelles (DataFrame): Optional Filename and organelle volumes, merged on Filename.
+    Output:
+    - DataFrame with the columns of output_cell_volume_mito_chlor.csv (organelle columns only where known).
+    """
+    cells = dimensions.copy()
+    if organelles is not None:
+        columns = ['Filename'] + [column for column in ORGANELLES if column in organelles.columns]
+        cells = cells.drop(columns=[column for column in columns[1:] if column in cells.columns])
+        cells = cells.merge(organelles[columns], on='Filename', how='left')
+
+    axes = cells[['width', 'height', 'depth']].to_numpy(dtype=float)
+    cells['volume'] = ellipsoid_volume(axes[:, 0], axes[:, 1], axes[:, 2])
+    for volume_column, ratio_column in ORGANELLES.items():
+        if volume_column in cells.columns:
+            cells[ratio_column] = cells[volume_column] / cells['volume']
+
+    # Semi-axes and eccentricity as the notebook computes them from the longest and shortest axes
+    cells['a'] = axes.max(axis=1) / 2
+    cells['b'] = axes.min(axis=1) / 2
+    cells['c'] = np.sqrt(cells['a'] ** 2 - cells['b'] ** 2)
+    cells['eccentricity'] = np.sqrt(1 - cells['c'] ** 2 / cells['a'] ** 2)
+
+    columns = [column for column in CELL_COLUMNS if column in cells.columns]
+    return cells[columns + [column for column in cells.columns if column not in columns]]
+
+def update_cell_table(cells, new_dimensions, new_organelles=None):
+    """Add a batch of new cells to a cell table; cells already in it (same Filename) are replaced."""
+    new_cells = compute_cell_table(new_dimensions, new_organelles)
+    combined = pd.concat([cells[~cells['Filename'].isin(new_cells['Filename'])], new_cells], ignore_index=True)
+    return combined
+
+def filter_cells(cells, min_width=6.0, max_chlor_ratio=1.0):
+    """
+    Cells wider than min_width (a reasonable limit on the size of Chlamydomonas) whose chloroplast ratio
+    is at most max_chlor_ratio (larger ratios indicate poor mitochondria signal, from which the cell masks come).
+    """
+    keep = cells['width'] > min_width
+    if 'chlor_cell_ratio' in cells.columns:
+        keep &= cells['chlor_cell_ratio'] <= max_chlor_ratio
+    return cells[keep].reset_index(drop=True)
+
+def bootstrap_ci(values, n_resamples=10000, ci=0.95, seed=0, batch_size=None):
+    """
+    Bootstrap confidence intervals of the mean of each column of an (n, k) sample. A batch of
+    resamples is turned into a (batch, n) matrix of how often each row was drawn, and the means of
+    every resample come from one matrix product with the values. Returns (low, high) arrays of length k.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    n, k = values.shape
+    rng = np.random.default_rng(seed)
+    batch_size = batch_size or max(1, 10_000_000 // max(n, 1))
+
+    means = np.empty((n_resamples, k))
+    for start in range(0, n_resamples, batch_size):
+        stop = min(start + batch_size, n_resamples)
+        draws = rng.integers(0, n, size=(stop - start, n)) + n * np.arange(stop - start)[:, None]
+        counts = np.bincount(draws.ravel(), minlength=(stop - start) * n).reshape(stop - start, n).astype(float)
+        means[start:stop] = counts @ values / n
+
+    low, high = np.percentile(means, [100 * (1 - ci) / 2, 100 * (1 + ci) / 2], axis=0)
+    return low, high
+
+def summarize_species(cells, measurements=None, n_resamples=10000, ci=0.95, seed=0):
+    """
+    Per species and measurement: count, mean, std, median and a bootstrapped CI of the mean.
+    Missing values are left out of each measurement separately.
+    """
+    measurements = [m for m in (measurements or MEASUREMENTS) if m in cells.columns]
+    long = cells.melt(id_vars='species', value_vars=measurements, var_name='measurement').dropna()
+    summary = long.groupby(['species', 'measurement'], sort=True)['value'].agg(
+        count='count', mean='mean', std='std', median='median').reset_index()
+
+    intervals = []
+    for (species, measurement), group in long.groupby(['species', 'measurement'], sort=True):
+        low, high = bootstrap_ci(group['value'].to_numpy(), n_resamples, ci, seed)
+        intervals.append((low[0], high[0]))
+    summary[['mean_ci_low', 'mean_ci_high']] = np.array(intervals).reshape(-1, 2)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Ellipsoid cell volumes and organelle ratios per species.')
+    parser.add_argument('dimensions', help='Cell dimensions, e.g. code/R/data/output_dimensions_mito_both.csv, '
+                                           'or a table that already has the organelle volumes.')
+    parser.add_argument('--organelles', default=None, help='Optional table of Filename, mito_volume, chlor_volume.')
+    parser.add_argument('--add', nargs='*', default=[], help='Dimension tables of new cells to add.')
+    parser.add_argument('--output-directory', default='.', help='Where the tables are written.')
+    parser.add_argument('--min-width', type=float, default=6.0, help='Cells must be wider than this.')
+    parser.add_argument('--resamples', type=int, default=10000, help='Bootstrap resamples.')
+    args = parser.parse_args()
+
+    organelles = pd.read_csv(args.organelles) if args.organelles else None
+    cells = compute_cell_table(pd.read_csv(args.dimensions), organelles)
+    for path in args.add:
+        cells = update_cell_table(cells, pd.read_csv(path), organelles)
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    name = 'output_cell_volume_mito_chlor.csv' if 'mito_cell_ratio' in cells.columns else 'output_cell_volume.csv'
+    cells.to_csv(os.path.join(args.output_directory, name), index=False)
+    filtered = filter_cells(cells, args.min_width)
+    filtered.to_csv(os.path.join(args.output_directory, 'filtered_output_ratio_mito_chloro.csv'), index=False)
+    summary = summarize_species(filtered, n_resamples=args.resamples)
+    summary.to_csv(os.path.join(args.output_directory, 'organelle_ratio_summary.csv'), index=False)
+    print(summary.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+The script processes the multichannel z-stacks of the 3D morphology
+protocol in one pass per stack, in place of the Fiji macros
+ND2-Split-BS-v5.ijm, Batch_Merge_2-channel_v2.ijm and ZProj-contrast-v2.ijm.
+Every stack is split into one TIF z-stack per channel (TIF_Output/C<n>),
+the background of the fluorescence channels is subtracted slice by slice
+with a rolling ball (or a faster top-hat) and saved (BGSub_Output/C<n>),
+two channels are merged into a composite hyperstack (Merged), and the
+maximum (or mean) Z-projection of every channel is saved with a merged RGB
+projection of the two channels (MIPs), in the same directory layout and
+file names as the macros.
+
+TIFF stacks are read a few slices at a time, through a memory map or, for
+compressed and tiled TIFFs, page by page, and .nd2 files through the
+optional nd2 package. All processing is in float32 and
+the outputs are written slice by slice, so memory use does not grow with
+the stack. Stacks are processed in parallel in a process pool.
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import tifffile
+
+def stacking_axes(axes):
+    """Axes of a TIFF series, with another stacking axis (I, T, Q) taken as Z when there is no Z axis."""
+    if 'Z' not in axes:
+        for axis in 'ITQ':
+            if axis in axes:
+                return axes.replace(axis, 'Z', 1)
+    return axes
+
+def reduce_axes(data, axes):
+    """An array without its axes other than Z, C, Y and X (taken at index 0), in that order; returns (data, axes)."""
+    for position, axis in reversed(list(enumerate(axes))):
+        if axis not in 'ZCYX':
+            data = data[(slice(None),) * position + (0,)]
+            axes = axes[:position] + axes[position + 1:]
+    order = ''.join(axis for axis in 'ZCYX' if axis in axes)
+    return data.transpose([axes.index(axis) for axis in order]), order
+
+def to_zcyx(data, axes):
+    """An array with axes (Z, C, Y, X); other axes are taken at index 0 and missing Z and C axes are added."""
+    data, axes = reduce_axes(data, axes)
+    return data.reshape([data.shape[axes.index(axis)] if axis in axes else 1 for axis in 'ZCYX'])
+
+def open_stack(path):
+    """
+    Open a stack with axes (Z, C, Y, X) for reading a few slices at a time. Returns its shape, its dtype, a function
+    read_slices(start, stop) returning slices start to stop of every channel as an array, and a function closing
+    the file. Contiguous TIFFs are memory-mapped, other TIFFs (compressed or tiled) are decoded page by page, and
+    .nd2 files are read lazily through the nd2 package, so a stack is never read whole.
+    """
+    if path.lower().endswith('.nd2'):
+        try:
+            import nd2
+        except ImportError as error:
+            raise ImportError("Reading .nd2 files needs the nd2 package (pip install nd2)") from error
+        # A lazy dask array, so only the slices being processed are read
+        data = nd2.imread(path, dask=True, xarray=True)
+        for axis in ('Z', 'C'):
+            if axis not in data.dims:
+                data = data.expand_dims(axis)
+        extra = [dim for dim in data.dims if dim not in 'ZCYX']
+        data = data.isel({dim: 0 for dim in extra}).transpose('Z', 'C', 'Y', 'X').data
+        return data.shape, np.dtype(data.dtype), lambda start, stop: np.asarray(data[start:stop]), lambda: None
+
+    tif = tifffile.TiffFile(path)
+    series = tif.series[0]
+    axes = stacking_axes(series.axes)
+    if series.dataoffset is not None:
+        data = np.memmap(path, dtype=np.dtype(tif.byteorder + series.dtype.char), mode='r',
+                         offset=series.dataoffset, shape=series.shape)
+        tif.close()
+        data = to_zcyx(data, axes)
+        return data.shape, data.dtype, lambda start, stop: np.asarray(data[start:stop]), lambda: None
+
+    # The leading axes of the series run over the pages, the others lie within a page (Y, X, and e.g. C when the
+    # channels are stored as samples)
+    n_stacking = len(series.shape)
+    while n_stacking > 0 and np.prod(series.shape[n_stacking - 1:]) <= series.keyframe.size:
+        n_stacking -= 1
+    page_shape = series.shape[n_stacking:]
+    pages, page_axes = reduce_axes(np.arange(int(np.prod(series.shape[:n_stacking]))).reshape(
+        series.shape[:n_stacking]), axes[:n_stacking])
+    plane, plane_axes = reduce_axes(np.broadcast_to(np.zeros((), dtype=series.dtype), page_shape), axes[n_stacking:])
+
+    def read_slices(start, stop):
+        selected = pages[start:stop] if 'Z' in page_axes else pages
+        planes = np.empty(selected.shape + plane.shape, dtype=series.dtype)
+        for index in np.ndindex(selected.shape):
+            page = series.pages[int(selected[index])].asarray().reshape(page_shape)
+            planes[index] = reduce_axes(page, axes[n_stacking:])[0]
+        return to_zcyx(planes, page_axes + plane_axes)
+
+    shape = to_zcyx(np.broadcast_to(plane, pages.shape + plane.shape), page_axes + plane_axes).shape
+    return shape, series.dtype, read_slices, tif.close
+
+def shrink_factor(radius):
+    """Factor the image is shrunk by before the ball is rolled, as in ImageJ's Subtract Background."""
+    if radius <= 10:
+        return 1
+    if radius <= 30:
+        return 2
+    if radius <= 100:
+        return 4
+    return 8
+
+def estimate_background(plane, radius=300, method="rolling_ball", presmooth=True):
+    """
+    Background of a float32 slice: the image is shrunk by taking the minimum of blocks, smoothed,
+    opened with a ball ("rolling_ball") or a flat disk ("tophat") and enlarged back by interpolation.
+    """
+    factor = shrink_factor(radius)
+    height, width = plane.shape
+    padded_height, padded_width = -(-height // factor) * factor, -(-width // factor) * factor
+    small = np.pad(plane, ((0, padded_height - height), (0, padded_width - width)), mode='edge')
+    small = small.reshape(padded_height // factor, factor, padded_width // factor, factor).min(axis=(1, 3))
+    if presmooth:
+        small = cv2.blur(small, (3, 3), borderType=cv2.BORDER_REPLICATE)
+
+    small_radius = radius / factor
+    if method == "rolling_ball":
+        from skimage.restoration import rolling_ball
+        background = rolling_ball(small, radius=small_radius).astype(np.float32)
+    elif method == "tophat":
+        size = 2 * int(round(small_radius)) + 1
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+        background = cv2.morphologyEx(small, cv2.MORPH_OPEN, kernel, borderType=cv2.BORDER_REPLICATE)
+    else:
+        raise ValueError(f"method must be 'rolling_ball' or 'tophat', not {method!r}")
+
+    if factor > 1:
+        background = cv2.resize(background, (padded_width, padded_height), interpolation=cv2.INTER_LINEAR)
+    # The background never lies above the image itself
+    return np.minimum(background[:height, :width], plane)
+
+def subtract_background(plane, radius=300, method="rolling_ball", presmooth=True):
+    """Background-subtracted float32 slice."""
+    plane = plane.astype(np.float32)
+    return plane - estimate_background(plane, radius, method, presmooth)
+
+def to_dtype(values, dtype):
+    """Round and clip float32 values to an integer dtype, as ImageJ stores processed 8- and 16-bit slices."""
+    if np.issubdtype(dtype, np.integer):
+        limits = np.iinfo(dtype)
+        return np.clip(np.rint(values), limits.min, limits.max).astype(dtype)
+    return values.astype(dtype)
+
+def display_range(image, saturated=0.35):
+    """Display range with saturated percent of the pixels outside it, split over both ends, like Enhance Contrast."""
+    low, high = np.percentile(image, [saturated / 2, 100 - saturated / 2])
+    return float(low), float(max(high, low + 1e-6))
+
+def merge_rgb(green, magenta, saturated=0.35):
+    """8-bit RGB image of two channels, the first green and the second magenta, each contrast-enhanced."""
+    channels = []
+    for image in (green, magenta):
+        low, high = display_range(image, saturated)
+        channels.append(np.clip((image - low) * (255.0 / (high - low)), 0, 255))
+    rgb = np.stack([channels[1], channels[0], channels[1]], axis=-1)
+    return np.rint(rgb).astype(np.uint8)
+
+def process_stack(path, output_directory, radius=300, method="rolling_ball", background_channels=(2, 3),
+                  merge_channels=(2, 3), projection="max", chunk_size=4, presmooth=True):
+    """
+    Split, background-subtract, merge and project one stack. Channels are numbered from 1, like C1 .. C3
+    in the macros. Returns the paths of the written files.
+    """
+    if projection not in ("max", "mean"):
+        raise ValueError(f"projection must be 'max' or 'mean', not {projection!r}")
+    print("Processing: " + path)
+    shape, dtype, read_slices, close = open_stack(path)
+    n_slices, n_channels = shape[:2]
+    base_name = os.path.splitext(os.path.basename(path))[0]
+    background_channels = [c for c in background_channels if c <= n_channels]
+    merge_channels = [c for c in merge_channels if c <= n_channels]
+
+    paths = {}
+    for channel in range(1, n_channels + 1):
+        paths[('split', channel)] = os.path.join(output_directory, 'TIF_Output', f'C{channel}',
+                                                 f'{base_name}_C{channel}.tif')
+    for channel in background_channels:
+        paths[('bgsub', channel)] = os.path.join(output_directory, 'BGSub_Output', f'C{channel}',
+                                                 f'{base_name}_C{channel}_BGSub.tif')
+    if len(merge_channels) == 2:
+        paths[('merged', 0)] = os.path.join(output_directory, 'Merged', f'Merged_{base_name}.tif')
+    for file_path in paths.values():
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    # The single-channel stacks are created at full size as z-stacks (axes ZYX, so that Fiji opens them with
+    # slices, not channels) and filled through memory maps; the merged hyperstack is appended slice by slice
+    plane_dtype = np.dtype(dtype.char)
+    stacks = {key: tifffile.memmap(file_path, shape=(n_slices,) + tuple(shape[2:]), dtype=plane_dtype, imagej=True,
+                                   metadata={'axes': 'ZYX'})
+              for key, file_path in paths.items() if key[0] != 'merged'}
+    writers = {key: tifffile.TiffWriter(file_path, imagej=True) for key, file_path in paths.items()
+               if key[0] == 'merged'}
+    accumulator = np.full((n_channels,) + tuple(shape[2:]), -np.inf if projection == "max" else 0.0,
+                          dtype=np.float32)
+    try:
+        for start in range(0, n_slices, chunk_size):
+            # Read a few slices of every channel at once
+            chunk = read_slices(start, start + chunk_size)
+            for index, planes in enumerate(chunk, start):
+                processed = {}
+                for channel in range(1, n_channels + 1):
+                    plane = planes[channel - 1]
+                    stacks[('split', channel)][index] = plane
+                    values = plane.astype(np.float32)
+                    if channel in background_channels:
+                        values = subtract_background(values, radius, method, presmooth)
+                        stacks[('bgsub', channel)][index] = to_dtype(values, dtype)
+                    processed[channel] = values
+                    if projection == "max":
+                        np.maximum(accumulator[channel - 1], values, out=accumulator[channel - 1])
+                    else:
+                        accumulator[channel - 1] += values
+                if ('merged', 0) in writers:
+                    writers[('merged', 0)].write(np.stack([to_dtype(processed[c], dtype) for c in merge_channels]),
+                                                 contiguous=True, metadata={'mode': 'composite'})
+    finally:
+        for stack in stacks.values():
+            stack.flush()
+        del stacks
+        for writer in writers.values():
+            writer.close()
+        close()
+
+    if projection == "mean":
+        accumulator /= np.float32(n_slices)
+    mip_directory = os.path.join(output_directory, 'MIPs')
+    os.makedirs(mip_directory, exist_ok=True)
+    prefix = 'MAX' if projection == "max" else 'AVG'
+    projection_path = os.path.join(mip_directory, f'{prefix}_{base_name}.tif')
+    tifffile.imwrite(projection_path, to_dtype(accumulator, dtype) if projection == "max" else accumulator,
+                     imagej=True, metadata={'axes': 'CYX'})
+    written = list(paths.values()) + [projection_path]
+    if len(merge_channels) == 2:
+        rgb_path = os.path.join(mip_directory, f'Merged_{prefix}_{base_name}.tif')
+        tifffile.imwrite(rgb_path, merge_rgb(accumulator[merge_channels[0] - 1], accumulator[merge_channels[1] - 1]),
+                         photometric='rgb')
+        written.append(rgb_path)
+    return written
+
+def _process_stack_job(job):
+    return process_stack(*job)
+
+def process_directory(input_directory, output_directory=None, suffix=(".nd2", ".tif"), radius=300,
+                      method="rolling_ball", background_channels=(2, 3), merge_channels=(2, 3), projection="max",
+                      workers=None):
+    """Process every stack of a directory, one stack per worker process; returns the paths of the written files."""
+    output_directory = output_directory or input_directory
+    stacks = sorted(name for name in os.listdir(input_directory) if name.lower().endswith(tuple(suffix)))
+    jobs = [(os.path.join(input_directory, name), output_directory, radius, method, tuple(background_channels),
+             tuple(merge_channels), projection) for name in stacks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [path for written in executor.map(_process_stack_job, jobs) for path in written]
+
+def main():
+    parser = argparse.ArgumentParser(description='Split channels, subtract background, merge and project z-stacks.')
+    parser.add_argument('input_directory', help='Directory with the .nd2 or .tif z-stacks.')
+    parser.add_argument('--output-directory', default=None, help='Where the outputs go (default: input directory).')
+    parser.add_argument('--suffix', nargs='+', default=['.nd2', '.tif'], help='File suffixes of the stacks.')
+    parser.add_argument('--radius', type=float, default=300, help='Rolling ball radius in pixels.')
+    parser.add_argument('--method', choices=['rolling_ball', 'tophat'], default='rolling_ball',
+                        help='Rolling ball (as in Fiji) or flat top-hat (faster) background.')
+    parser.add_argument('--background-channels', type=int, nargs='*', default=[2, 3],
+                        help='Channels (from 1) whose background is subtracted.')
+    parser.add_argument('--merge-channels', type=int, nargs=2, default=[2, 3],
+                        help='Channels merged in green and magenta.')
+    parser.add_argument('--projection', choices=['max', 'mean'], default='max', help='Z-projection.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes.')
+    args = parser.parse_args()
+
+    written = process_directory(args.input_directory, args.output_directory, args.suffix, args.radius, args.method,
+                                args.background_channels, args.merge_channels, args.projection, args.workers)
+    print(f"Saved {len(written)} files")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+The script benchmarks masking of the object list on synthetic data.
+It writes a scratch "./experiments" tree with multi-page focus stacks,
+binary max-area masks and an object_image_list_angles.csv in which many
+rows point into the same stack. It then masks every row twice: once with
+the previous row-by-row approach, which reopens and seeks the focus stack
+for each row, and once with image_mask.mask_objects, which opens each stack
+once. For both it reports the total runtime and the number of times a
+stack file is opened, counted by wrapping builtins.open in a sequential
+pass, and checks that the masked images are identical.
+"""
+
+import argparse
+import builtins
+import contextlib
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import tifffile
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from image_mask import build_mask_jobs, mask_objects, mask_stack
+
+def generate_dataset(base_directory, n_stacks=20, frames_per_stack=60, rows_per_stack=40, size=128, seed=0):
+    """Write focus stacks, masks and the object list; returns the object list."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for stack_index in range(n_stacks):
+        experiment = f"exp{stack_index % 2 + 1}"
+        species = ['cr', 'cs'][stack_index % 2]
+        pool_id = f"A{stack_index:02d}"
+        focus_pool_id = f"{species}_pools_{pool_id}"
+        image_stack = f"{focus_pool_id}_seq1_f0to{frames_per_stack - 1}"
+
+        stack_directory = os.path.join(base_directory, experiment, 'focus', species, focus_pool_id)
+        os.makedirs(stack_directory, exist_ok=True)
+        stack = rng.integers(0, 65535, (frames_per_stack, size, size), dtype=np.uint16)
+        tifffile.imwrite(os.path.join(stack_directory, f"{image_stack}.tif"), stack)
+
+        mask_directory = os.path.join(base_directory, experiment, 'max_area', species, pool_id)
+        os.makedirs(mask_directory, exist_ok=True)
+        for frame in rng.choice(frames_per_stack, rows_per_stack, replace=False):
+            image_name = f"{image_stack}_Probabilities_{frame}.tif"
+            yy, xx = np.ogrid[:size, :size]
+            center_x, center_y, radius = rng.uniform(20, size - 20, 2).tolist() + [rng.uniform(5, 15)]
+            mask = (((xx - center_x) ** 2 + (yy - center_y) ** 2) <= radius ** 2).astype(np.uint8) * 255
+            Image.fromarray(mask).save(os.path.join(mask_directory, image_name))
+            rows.append({'metadata_experiment': experiment, 'metadata_species': species,
+                         'metadata_pool_id': pool_id, 'seq_frame': int(frame),
+                         'well_name': f"{focus_pool_id}.tif", 'Image': image_name})
+    df = pd.DataFrame(rows)
+    df.to_csv(os.path.join(base_directory, 'object_image_list_angles.csv'), index=False)
+    return df
+
+def mask_row_by_row(df, base_directory):
+    """The previous approach: reopen and seek the focus stack for every row."""
+    jobs = build_mask_jobs(df, base_directory)
+    for _, row in jobs.iterrows():
+        os.makedirs(os.path.dirname(row['output_path']), exist_ok=True)
+        mask = Image.open(row['mask_path']).convert("L")
+        image_stack = Image.open(row['image_path'])
+        image_stack.seek(row['seq_frame'])
+        masked_image_array = np.where(np.array(mask) == 255, np.array(image_stack), 0)
+        Image.fromarray(masked_image_array.astype("uint16")).save(row['output_path'])
+
+def mask_per_stack(df, base_directory):
+    """The grouped engine of mask_objects, one stack after the other in this process."""
+    jobs = build_mask_jobs(df, base_directory)
+    for image_path, rows in jobs.groupby('image_path', sort=False):
+        mask_stack(image_path, rows)
+
+@contextlib.contextmanager
+def count_opens(paths):
+    """Count the calls of builtins.open (used by PIL, tifffile and numpy) on any of the given files."""
+    paths = {os.path.abspath(path) for path in paths}
+    counter = {'opens': 0}
+    original_open = builtins.open
+
+    def counting_open(file, *args, **kwargs):
+        if isinstance(file, (str, bytes, os.PathLike)) and os.path.abspath(os.fsdecode(file)) in paths:
+            counter['opens'] += 1
+        return original_open(file, *args, **kwargs)
+
+    builtins.open = counting_open
+    try:
+        yield counter
+    finally:
+        builtins.open = original_open
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image masking on synthetic focus stacks.')
+    parser.add_argument('--root', default='./benchmark_image_mask', help='Scratch directory.')
+    parser.add_argument('--stacks', type=int, default=20, help='Number of focus stacks.')
+    parser.add_argument('--frames', type=int, default=60, help='Frames per focus stack.')
+    parser.add_argument('--rows-per-stack', type=int, default=40, help='Object list rows pointing into each stack.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes for the grouped engine.')
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    # The scratch directory is deleted afterwards, so only a new or empty directory is used
+    if os.path.isdir(root) and os.listdir(root):
+        parser.error(f"{root} is not empty; remove it or give another --root.")
+    base_directory = os.path.join(root, 'experiments')
+    df = generate_dataset(base_directory, args.stacks, args.frames, args.rows_per_stack)
+    jobs = build_mask_jobs(df, base_directory)
+
+    stack_paths = jobs['image_path'].unique()
+
+    start = time.perf_counter()
+    mask_row_by_row(df, base_directory)
+    time_before = time.perf_counter() - start
+    reference = [tifffile.imread(path) for path in jobs['output_path']]
+    with count_opens(stack_paths) as opens_before:
+        mask_row_by_row(df, base_directory)
+    for path in jobs['output_path']:
+        os.remove(path)
+
+    start = time.perf_counter()
+    mask_objects(df, base_directory, workers=args.workers)
+    time_after = time.perf_counter() - start
+    identical = all(np.array_equal(expected, tifffile.imread(path))
+                    for expected, path in zip(reference, jobs['output_path']))
+    # The worker processes of mask_objects cannot be counted from here, so the opens of the same engine are
+    # counted in this process
+    with contextlib.redirect_stdout(None), count_opens(stack_paths) as opens_after:
+        mask_per_stack(df, base_directory)
+
+    print(f"{len(df)} rows in {args.stacks} stacks")
+    print(f"row by row : {opens_before['opens']:6d} stack opens  {time_before:8.2f} s")
+    print(f"per stack  : {opens_after['opens']:6d} stack opens  {time_after:8.2f} s  ({time_before / time_after:.1f}x)")
+    print(f"Outputs identical: {identical}")
+    shutil.rmtree(root)
+    if not identical:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
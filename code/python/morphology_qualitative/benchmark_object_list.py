@@ -0,0 +1,133 @@
+"""
+The script benchmarks building the object list and its frame links on
+synthetic data. It writes a scratch "./experiments" tree of max_area_data.csv
+files holding, by default, a million rows in total, with image names in the
+format produced by segment_chlamy.py. It then builds object_image_list.csv and
+object_image_list_frames.csv twice: once with the previous per-row approach
+(lambdas and a regex per row, a concat inside the directory walk) and once
+with frames_for_angle.object_list_frames. It reports the runtime of both, end to
+end and for the column derivation alone on the loaded rows (most of the
+end-to-end time is CSV parsing and writing), and checks that the two pairs
+of CSV files are identical.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from frames_for_angle import add_frame_links, generate_image_names, object_list_frames
+from max_area_image_object_list import add_object_list_columns, load_max_area_data
+
+def generate_dataset(base_directory, n_rows=1000000, n_files=200, frames_per_sequence=200, seed=0):
+    """Write max_area_data.csv files with n_rows rows in total spread over n_files pools."""
+    rng = np.random.default_rng(seed)
+    rows_per_file = np.full(n_files, n_rows // n_files)
+    rows_per_file[:n_rows % n_files] += 1
+
+    for file_index, n in enumerate(rows_per_file):
+        experiment = f"exp{file_index % 3 + 1}"
+        species = ['cr', 'cs', 'ci'][file_index % 3]
+        pool_id = f"{'ABCDEFGH'[file_index % 8]}{file_index:03d}"
+        sequence = rng.integers(1, 10000, n)
+        first_frame = sequence * frames_per_sequence
+        frames = np.char.add(np.char.add(first_frame.astype(str), "to"),
+                             (first_frame + frames_per_sequence - 1).astype(str))
+        # Some frame numbers are zero-padded to exercise the width handling
+        frame = rng.integers(0, frames_per_sequence, n).astype(str)
+        padded = rng.random(n) < 0.1
+        frame[padded] = np.char.zfill(frame[padded], 4)
+        image = (f"{species}_pools_{pool_id}_seq" + pd.Series(sequence.astype(str)) + "_f" + frames
+                 + "_Probabilities_" + frame + ".tif")
+
+        directory = os.path.join(base_directory, experiment, 'max_area', species, pool_id)
+        os.makedirs(directory, exist_ok=True)
+        pd.DataFrame({
+            'Image': image,
+            'Area': rng.integers(50, 400, n),
+            'metadata_experiment': experiment,
+            'metadata_species': species,
+            'metadata_pool_id': pool_id,
+            'metadata_frames': frames,
+            'metadata_sequence': sequence,
+        }).to_csv(os.path.join(directory, 'max_area_data.csv'), index=False)
+
+def add_columns_row_by_row(df):
+    """The previous per-row derivation of the object list columns and frame links."""
+    df = df.copy()
+    df['seq_frame'] = df['Image'].apply(lambda x: x.split("_")[-1].split(".")[0])
+    df['first_seq_frame'] = df['metadata_frames'].apply(lambda x: x.split("to")[0])
+    df['image_frame'] = df['seq_frame'].astype(int) + df['first_seq_frame'].astype(int)
+    df['well_name'] = df['Image'].apply(lambda x: x.split("_seq")[0] + ".tif")
+    df['previous_image'], df['next_image'] = zip(*df['Image'].apply(generate_image_names))
+    return df
+
+def object_list_row_by_row(base_directory):
+    """The previous approach: per-row lambdas, a concat per file and a regex per row."""
+    all_data = pd.DataFrame()
+    for root, dirs, files in os.walk(base_directory):
+        if '/max_area/' in root and 'max_area_data.csv' in files:
+            df = pd.read_csv(os.path.join(root, 'max_area_data.csv'))
+            df['seq_frame'] = df['Image'].apply(lambda x: x.split("_")[-1].split(".")[0])
+            df['first_seq_frame'] = df['metadata_frames'].apply(lambda x: x.split("to")[0])
+            df['image_frame'] = df['seq_frame'].astype(int) + df['first_seq_frame'].astype(int)
+            df['well_name'] = df['Image'].apply(lambda x: x.split("_seq")[0] + ".tif")
+            all_data = pd.concat([all_data, df], ignore_index=True)
+    all_data.to_csv(os.path.join(base_directory, 'object_image_list.csv'), index=False)
+
+    df = pd.read_csv(os.path.join(base_directory, 'object_image_list.csv'))
+    df['previous_image'], df['next_image'] = zip(*df['Image'].apply(generate_image_names))
+    df.to_csv(os.path.join(base_directory, 'object_image_list_frames.csv'), index=False)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark object list and frame link building on synthetic data.')
+    parser.add_argument('--root', default='./benchmark_object_list', help='Scratch directory.')
+    parser.add_argument('--rows', type=int, default=1000000, help='Total number of max-area rows.')
+    parser.add_argument('--files', type=int, default=200, help='Number of max_area_data.csv files.')
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root)
+    # The scratch directory is deleted afterwards, so only a new or empty directory is used
+    if os.path.isdir(root) and os.listdir(root):
+        parser.error(f"{root} is not empty; remove it or give another --root.")
+    base_directory = os.path.join(root, 'experiments')
+    generate_dataset(base_directory, args.rows, args.files)
+    outputs = ['object_image_list.csv', 'object_image_list_frames.csv']
+
+    start = time.perf_counter()
+    object_list_row_by_row(base_directory)
+    time_before = time.perf_counter() - start
+    reference = [pd.read_csv(os.path.join(base_directory, name)) for name in outputs]
+
+    start = time.perf_counter()
+    object_list_frames(base_directory)
+    time_after = time.perf_counter() - start
+    identical = all(expected.equals(pd.read_csv(os.path.join(base_directory, name)))
+                    for expected, name in zip(reference, outputs))
+
+    # Column derivation alone, on rows already in memory
+    loaded = load_max_area_data(base_directory)
+    start = time.perf_counter()
+    add_columns_row_by_row(loaded)
+    columns_before = time.perf_counter() - start
+    start = time.perf_counter()
+    add_frame_links(add_object_list_columns(loaded))
+    columns_after = time.perf_counter() - start
+
+    print(f"{args.rows} rows in {args.files} files")
+    print(f"             end to end        columns only")
+    print(f"row by row : {time_before:8.2f} s        {columns_before:8.2f} s")
+    print(f"vectorized : {time_after:8.2f} s ({time_before / time_after:4.1f}x) "
+          f"{columns_after:8.2f} s ({columns_before / columns_after:4.1f}x)")
+    print(f"Outputs identical: {identical}")
+    shutil.rmtree(root)
+    if not identical:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,10 @@ tasks—specifically, cropping, rotating, and thresholding—on masked
 images. Each image is first cropped to a 49x49 pixel area, rotated
 based on a given angle, and then converted to a binary image.
 The major axis orientation of the binary object within the image is
-computed, and the image is rotated again based on this orientation.
-The processed images are saved to a specified output directory,
-which is created if it doesn't already exist. The script employs
-various libraries like pandas, PIL, NumPy, OpenCV, and skimage for
- these tasks.
+computed from its image moments, and the image is rotated again based on
+this orientation. The processed images are saved to a specified output
+directory, which is created if it doesn't already exist. The script
+employs pandas, PIL, NumPy and OpenCV for these tasks.
 """
 
 import os
@@ -17,20 +16,100 @@ import pandas as pd
 from PIL import Image
 import numpy as np
 import cv2
-import math
-import numpy.linalg as linalg
-from skimage import measure
-from skimage.draw import line
 
 def get_major_axis_orientation(binary_image):
-    labeled_image = measure.label(binary_image)
-    properties = measure.regionprops(labeled_image)
-    if not properties:
+    # Assuming the object of interest is the largest by area
+    orientation = major_axis_orientations(binary_image[None])[0]
+    if np.isnan(orientation):
         return None
+    return orientation  # This is in radians
+
+def major_axis_orientations(binary_tiles):
+    """
+    Orientation in radians of the largest object in each binary tile of an (N, H, W) batch,
+    with the same convention as regionprops' orientation. Empty tiles give NaN.
+    The largest component comes from cv2.connectedComponentsWithStats and the orientation
+    from its central image moments, computed for the whole batch at once.
+    """
+    binary_tiles = np.asarray(binary_tiles, dtype=np.uint8)
+    largest = np.zeros(binary_tiles.shape, dtype=bool)
+    for i, tile in enumerate(binary_tiles):
+        # 8-connectivity, as measure.label uses for 2D images
+        n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(tile, connectivity=8)
+        if n_labels > 1:
+            largest[i] = labels == 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+
+    rows = np.arange(binary_tiles.shape[1], dtype=float)[None, :, None]
+    cols = np.arange(binary_tiles.shape[2], dtype=float)[None, None, :]
+    m00 = largest.sum(axis=(1, 2)).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_row = (largest * rows).sum(axis=(1, 2)) / m00
+        mean_col = (largest * cols).sum(axis=(1, 2)) / m00
+        d_row = rows - mean_row[:, None, None]
+        d_col = cols - mean_col[:, None, None]
+        # Normalised central moments
+        mu_rr = (largest * d_row ** 2).sum(axis=(1, 2)) / m00
+        mu_cc = (largest * d_col ** 2).sum(axis=(1, 2)) / m00
+        mu_rc = (largest * d_row * d_col).sum(axis=(1, 2)) / m00
+
+    # Inertia tensor [[a, b], [b, c]] as used by regionprops
+    a, b, c = mu_cc, -mu_rc, mu_rr
+    orientation = 0.5 * np.arctan2(-2 * b, c - a)
+    orientation = np.where(a - c == 0, np.where(b < 0, np.pi / 4, -np.pi / 4), orientation)
+    return np.where(m00 > 0, orientation, np.nan)
+
+def crop_tile(image_array, x, y, size=49):
+    """
+    Crop a size x size tile centred on (x, y) from an array, zero-filling outside the image.
+    The box is rounded the same way PIL's Image.crop rounds it.
+    """
+    half = size // 2
+    left, upper = int(round(x - half)), int(round(y - half))
+    right, lower = int(round(x + half + 1)), int(round(y + half + 1))
+    tile = np.zeros((lower - upper, right - left), dtype=image_array.dtype)
+    src_top, src_left = max(upper, 0), max(left, 0)
+    src_bottom, src_right = min(lower, image_array.shape[0]), min(right, image_array.shape[1])
+    if src_bottom > src_top and src_right > src_left:
+        tile[src_top - upper:src_bottom - upper, src_left - left:src_right - left] = \
+            image_array[src_top:src_bottom, src_left:src_right]
+    return tile
+
+def orient_tiles(cropped_tiles, angles):
+    """
+    Rotate a batch of cropped tiles by their swim angles into 49 x 49 tiles, then again so the
+    major axis of each object is vertical. Tiles may differ by a pixel in size where PIL's
+    rounding of the crop box does. Returns the oriented uint16 tiles and the major axis
+    orientations in radians; tiles without an object get NaN and are only rotated by the
+    swim angle.
+    """
+    rotated = np.empty((len(cropped_tiles), 49, 49), dtype=np.uint16)
+    for i, (tile, angle) in enumerate(zip(cropped_tiles, angles)):
+        # Rotate using OpenCV
+        M = cv2.getRotationMatrix2D((24, 24), -angle, 1)
+        rotated[i] = cv2.warpAffine(tile, M, (49, 49), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+    # Convert to 8-bit and threshold non-zero pixels, for the whole batch in one call
+    rotated_8bit = cv2.convertScaleAbs(rotated.reshape(-1, rotated.shape[-1]), alpha=(255.0/65535.0))
+    binary_tiles = (rotated_8bit > 1).reshape(rotated.shape)
 
-    # Assuming the object of interest is the largest by area
-    largest_object = max(properties, key=lambda x: x.area)
-    return largest_object.orientation  # This is in radians
+    # Get major axis orientation in radians
+    orientations = major_axis_orientations(binary_tiles)
+
+    # Rotate the images again; empty tiles are left as they are
+    oriented = np.empty(rotated.shape, dtype=np.uint16)
+    for i, (tile, orientation) in enumerate(zip(rotated, orientations)):
+        if np.isnan(orientation):
+            oriented[i] = tile
+            continue
+        M = cv2.getRotationMatrix2D((24, 24), -np.degrees(orientation), 1)
+        oriented[i] = cv2.warpAffine(tile, M, (49, 49), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+    return oriented, orientations
+
+def orient_tile(cropped_49_np, angle):
+    """Single-tile version of orient_tiles."""
+    oriented, _ = orient_tiles(cropped_49_np[None], [angle])
+    return oriented[0]
 
 def crop_and_rotate(image, x, y, angle, output_path):
     # Crop to 49 x 49 pixels
@@ -39,86 +118,57 @@ def crop_and_rotate(image, x, y, angle, output_path):
     cropped_49_np = np.array(cropped_49)
     #save_intermediate_image(cropped_49_np, output_path, "cropped49")
 
-    # Rotate using OpenCV
-    M = cv2.getRotationMatrix2D((24, 24), -angle, 1)
-    rotated_np = cv2.warpAffine(cropped_49_np, M, (49, 49), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
-    #save_intermediate_image(rotated_np, output_path, "rotated")
-
-    # Convert to 8-bit grayscale for thresholding
-    rotated_8bit = cv2.convertScaleAbs(rotated_np, alpha=(255.0/65535.0))
-    #save_intermediate_image(rotated_8bit, output_path, "convert")
-
-    # Threshold the 8-bit image (Converting non-zero pixels to 255)
-    _, thresholded = cv2.threshold(rotated_8bit, 1, 255, cv2.THRESH_BINARY)
-    #save_intermediate_image(thresholded, output_path, "thresholded")
-
-    # Convert thresholded image to binary
-    binary_image = thresholded // 255
-
-    # Get major axis orientation in radians
-    orientation = get_major_axis_orientation(binary_image)
-
-    # Convert orientation to degrees
-    orientation_degrees = np.degrees(orientation)
-
-    # Rotate the image again
-    M = cv2.getRotationMatrix2D((24, 24), -orientation_degrees, 1)
-    rotated_again_np = cv2.warpAffine(rotated_np, M, (49, 49), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
-    #save_intermediate_image(rotated_again_np, output_path, "rotated_again")
-
-    # To visualize the major axis, let's draw a line on the image
-    #rr, cc = line(24, 24, int(24 + 24 * np.sin(orientation)), int(24 + 24 * np.cos(orientation)))
-    #rotated_again_np[rr, cc] = 65535  # Max pixel value for a 16-bit image
-    # save_intermediate_image(rotated_again_np, output_path, "major_axis")
+    rotated_again_np = orient_tile(cropped_49_np, angle)
 
     # Convert back to PIL Image for saving
-    rotated_again = Image.fromarray(rotated_again_np.astype(np.uint16), 'I;16')
+    rotated_again = Image.fromarray(rotated_again_np, 'I;16')
 
     return rotated_again
 
-# Read the CSV file into a pandas DataFrame
-df = pd.read_csv("./experiments/object_image_list_obj_stats.csv")
-
-# Loop through each row in the DataFrame
-for index, row in df.iterrows():
-    metadata_experiment = row['metadata_experiment']
-    metadata_species = row['metadata_species']
-    metadata_pool_id = row['metadata_pool_id']
-    image_frame = row['image_frame']
-    mean_object = row['mean_object']
-    well_name = row['well_name']
-    Image_name = row['Image']
-    center_x = row['Center_X']
-    center_y = row['Center_Y']
-    angle = row['Angle_with_Y_Axis']
-
-     # Skip rows with NaN values
-    if pd.isna(center_x) or pd.isna(center_y) or pd.isna(angle):
-        print(f"Skipping row {index} due to NaN values.")
-        continue
-
-    # Only process rows where mean_object < 1.1
-    if mean_object >= 1.1:
-        print(f"Skipping row {index} as mean_object is {mean_object} which is >= 1.1")
-        continue
-
-    # Construct the file paths
-    mask_path = f"./experiments/{metadata_experiment}/masked/{metadata_species}/{metadata_pool_id}/{Image_name}_mask.tif"
-    output_path = f"./experiments/{metadata_experiment}/oriented_major/{metadata_species}/{metadata_pool_id}/{Image_name}_orient.tif"
-
-    # Ensure output directory exists
-    output_dir = os.path.dirname(output_path)
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Read the masked image
-    masked_image = Image.open(mask_path)
-
-    print("Initial image mode:", masked_image.mode)
-
-    # Crop and rotate the image
-    cropped_and_rotated = crop_and_rotate(masked_image, center_x, center_y, angle, output_path)
-
-    # Save the cropped and rotated image
-    cropped_and_rotated.save(output_path)
-
-    print(f"Saved cropped and rotated image to {output_path}")
+def orient_objects(df, base_directory="./experiments"):
+    # Loop through each row in the DataFrame
+    for index, row in df.iterrows():
+        metadata_experiment = row['metadata_experiment']
+        metadata_species = row['metadata_species']
+        metadata_pool_id = row['metadata_pool_id']
+        mean_object = row['mean_object']
+        Image_name = row['Image']
+        center_x = row['Center_X']
+        center_y = row['Center_Y']
+        angle = row['Angle_with_Y_Axis']
+
+        # Skip rows with NaN values
+        if pd.isna(center_x) or pd.isna(center_y) or pd.isna(angle):
+            print(f"Skipping row {index} due to NaN values.")
+            continue
+
+        # Only process rows where mean_object < 1.1
+        if mean_object >= 1.1:
+            print(f"Skipping row {index} as mean_object is {mean_object} which is >= 1.1")
+            continue
+
+        # Construct the file paths
+        mask_path = f"{base_directory}/{metadata_experiment}/masked/{metadata_species}/{metadata_pool_id}/{Image_name}_mask.tif"
+        output_path = f"{base_directory}/{metadata_experiment}/oriented_major/{metadata_species}/{metadata_pool_id}/{Image_name}_orient.tif"
+
+        # Ensure output directory exists
+        output_dir = os.path.dirname(output_path)
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Read the masked image
+        masked_image = Image.open(mask_path)
+
+        print("Initial image mode:", masked_image.mode)
+
+        # Crop and rotate the image
+        cropped_and_rotated = crop_and_rotate(masked_image, center_x, center_y, angle, output_path)
+
+        # Save the cropped and rotated image
+        cropped_and_rotated.save(output_path)
+
+        print(f"Saved cropped and rotated image to {output_path}")
+
+if __name__ == "__main__":
+    # Read the CSV file into a pandas DataFrame
+    df = pd.read_csv("./experiments/object_image_list_obj_stats.csv")
+    orient_objects(df, "./experiments")
@@ -4,13 +4,18 @@ defines a function `generate_image_names` to calculate the previous
 and next image names based on the frame number found in the original image name,
 applies this function to populate new columns for 'previous_image'
 and 'next_image', and then saves the modified DataFrame back to a new CSV file.
+
+`frame_links` derives the previous and next names for a whole column at once
+with vectorized string operations, and `object_list_frames` builds the object
+list (max_area_image_object_list.py) and its frame links in one call.
 """
 
-import pandas as pd
+import os
 import re
+import numpy as np
+import pandas as pd
 
-# Load the existing CSV file into a DataFrame
-df = pd.read_csv("./experiments/object_image_list.csv")
+from max_area_image_object_list import build_object_list
 
 # Function to create previous and next image names
 def generate_image_names(image_name):
@@ -40,8 +45,68 @@ def generate_image_names(image_name):
     else:
         return None, None
 
-# Apply the function to each row in the DataFrame to populate the new columns
-df['previous_image'], df['next_image'] = zip(*df['Image'].apply(generate_image_names))
+def _pad_frame_numbers(numbers, widths):
+    # Left-pad with zeros to the width of the original frame number
+    padded = numbers.astype(str)
+    zeros = np.array(['0' * n for n in range(int(widths.max()) + 1)], dtype=object)
+    prefix = pd.Series(zeros[np.maximum(widths - padded.str.len(), 0)], index=padded.index)
+    return prefix.astype(padded.dtype) + padded
+
+def frame_links(images):
+    """
+    Previous and next image names for a Series of image names, as generate_image_names
+    gives them but computed for the whole column at once. Returns a DataFrame with
+    previous_image and next_image; names without a frame number or with frame 0 get NaN.
+    """
+    images = images.astype(str)
+
+    # The frame number is the number between the last "_" and ".tif"
+    has_frame = images.str.contains(r'_\d+\.tif$', regex=True)
+    named = images[has_frame]
+    frame_number_str = named.str.replace(r'^.*_', '', regex=True).str.slice(0, -4)
+    frame_number = frame_number_str.astype(np.int64)
+
+    # Skip processing if the frame number is 0
+    linked = frame_number != 0
+    stem = named[linked].str.replace(r'_\d+\.tif$', '', regex=True)
+    frame_number = frame_number[linked]
+    if stem.empty:
+        return pd.DataFrame({'previous_image': None, 'next_image': None}, index=images.index, dtype=object)
+    widths = frame_number_str[linked].str.len()
+
+    return pd.DataFrame({
+        'previous_image': stem + "_" + _pad_frame_numbers(frame_number - 1, widths) + ".tif",
+        'next_image': stem + "_" + _pad_frame_numbers(frame_number + 1, widths) + ".tif",
+    }).reindex(images.index)
+
+def add_frame_links(df):
+    """Return a copy of the object list with previous_image and next_image columns."""
+    df = df.copy()
+    links = frame_links(df['Image'])
+    df['previous_image'] = links['previous_image']
+    df['next_image'] = links['next_image']
+    return df
+
+def object_list_frames(base_directory="./experiments", save=True):
+    """
+    Build the object list from every max_area_data.csv and add the frame links in one call.
+    With save, object_image_list.csv and object_image_list_frames.csv are written as the two
+    separate scripts would write them.
+    """
+    objects = build_object_list(base_directory)
+    if save:
+        objects.to_csv(os.path.join(base_directory, 'object_image_list.csv'), index=False)
+    frames = add_frame_links(objects) if not objects.empty else objects
+    if save:
+        frames.to_csv(os.path.join(base_directory, 'object_image_list_frames.csv'), index=False)
+    return frames
+
+if __name__ == "__main__":
+    # Load the existing CSV file into a DataFrame
+    df = pd.read_csv("./experiments/object_image_list.csv")
+
+    # Populate the previous_image and next_image columns for all rows at once
+    df = add_frame_links(df)
 
-# Save the modified DataFrame back to the same CSV file (or to a new file, if you prefer)
-df.to_csv("./experiments/object_image_list_frames.csv", index=False)
+    # Save the modified DataFrame back to the same CSV file (or to a new file, if you prefer)
+    df.to_csv("./experiments/object_image_list_frames.csv", index=False)
@@ -0,0 +1,160 @@
+"""
+The script renders galleries of the oriented cells in the stacks written by
+save_stack.py (or mask_crop_orient_stack.py). The <stack>_index.csv next to a
+stack is joined with a measurement table, by default
+object_image_list_obj_stats.csv, so the cells can be ordered by any of its
+columns, e.g. Area, Eccentricity or Swim_Angle. The ordered cells are laid out
+as pages of rows x columns tiles and every page is saved as an 8-bit PNG
+montage.
+
+Only the tiles on a requested page are read from the stack, through a
+memory map when the stack is stored contiguously. Pages are rendered in a
+thread pool and cached on disk under a key made of the stack file, the
+ordering and the layout, so asking for a page again returns the cached file
+without reading the stack.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import tifffile
+from PIL import Image
+
+OBJECT_KEYS = ['metadata_experiment', 'metadata_species', 'metadata_pool_id', 'Image']
+
+def load_gallery_table(stack_path, measurements=None, sort_by=None, ascending=True):
+    """
+    The pages of a stack joined with their measurements, in gallery order.
+    Rows without a page (missing or rejected cells) are dropped; cells without a value
+    in the sort column are placed last.
+    """
+    index = pd.read_csv(os.path.splitext(stack_path)[0] + "_index.csv")
+    index = index[index['page'].notna()].astype({'page': int})
+    if measurements is not None:
+        measurements = measurements.drop_duplicates(OBJECT_KEYS)
+        extra = [column for column in measurements.columns if column not in index.columns or column in OBJECT_KEYS]
+        index = index.merge(measurements[extra], on=OBJECT_KEYS, how='left')
+    if sort_by is not None:
+        if sort_by not in index.columns:
+            raise ValueError(f"Cannot sort by {sort_by!r}; available columns: {', '.join(index.columns)}")
+        index = index.sort_values(sort_by, ascending=ascending, kind='stable', na_position='last')
+    return index.reset_index(drop=True)
+
+def read_pages(stack_path, pages):
+    """Read only the given pages of a stack, in the given order."""
+    pages = np.asarray(pages, dtype=int)
+    with tifffile.TiffFile(stack_path) as tif:
+        series = tif.series[0]
+        if series.dataoffset is not None:
+            stack = np.memmap(stack_path, dtype=np.dtype(tif.byteorder + series.dtype.char), mode='r',
+                              offset=series.dataoffset, shape=series.shape)
+            stack = stack.reshape((-1,) + stack.shape[-2:])
+            return np.array(stack[pages])
+        return np.stack([tif.pages[int(page)].asarray() for page in pages])
+
+def montage(tiles, columns, gap=2, display_range=None):
+    """Lay out (N, H, W) tiles row by row in an 8-bit image, scaled to display_range (default: 0.5-99.5 %)."""
+    n, height, width = tiles.shape
+    rows = max(1, -(-n // columns))
+    if display_range is None:
+        nonzero = tiles[tiles > 0]
+        display_range = np.percentile(nonzero, [0.5, 99.5]) if nonzero.size else (0, 1)
+    low, high = float(display_range[0]), float(display_range[1])
+    scaled = np.clip((tiles.astype(np.float32) - low) * (255.0 / max(high - low, 1e-6)), 0, 255).astype(np.uint8)
+
+    canvas = np.zeros((rows * (height + gap) + gap, columns * (width + gap) + gap), dtype=np.uint8)
+    for i, tile in enumerate(scaled):
+        top = gap + (i // columns) * (height + gap)
+        left = gap + (i % columns) * (width + gap)
+        canvas[top:top + height, left:left + width] = tile
+    return canvas
+
+def cache_key(stack_path, sort_by, ascending, rows, columns, page, display_range, measurements_path):
+    """Key that changes whenever the stack, the measurements or the layout of a page does."""
+    parts = {'stack': os.path.abspath(stack_path), 'sort_by': sort_by, 'ascending': ascending,
+             'rows': rows, 'columns': columns, 'page': page,
+             'range': None if display_range is None else [float(v) for v in display_range]}
+    for name, path in (('stack_stat', stack_path), ('measurements_stat', measurements_path)):
+        if path is not None:
+            stat = os.stat(path)
+            parts[name] = [stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:16]
+
+def page_path(stack_path, page, rows=10, columns=10, cache_dir=None, display_range=None,
+              sort_by=None, ascending=True, measurements_path=None):
+    """Path of the cached PNG of a gallery page."""
+    cache_dir = cache_dir or os.path.join(os.path.dirname(stack_path) or ".", "gallery_cache")
+    stack_name = os.path.splitext(os.path.basename(stack_path))[0]
+    key = cache_key(stack_path, sort_by, ascending, rows, columns, page, display_range, measurements_path)
+    return os.path.join(cache_dir, f"{stack_name}_p{page:04d}_{key}.png")
+
+def render_page(stack_path, table, page, output_path, rows=10, columns=10, display_range=None):
+    """Render one gallery page of the ordered table to output_path, with a CSV of the cells on it."""
+    per_page = rows * columns
+    selected = table.iloc[page * per_page:(page + 1) * per_page]
+    if selected.empty:
+        raise IndexError(f"Page {page} is past the end of {stack_path} ({len(table)} cells)")
+    tiles = read_pages(stack_path, selected['page'])
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    selected.to_csv(os.path.splitext(output_path)[0] + ".csv", index=False)
+    # Write under a temporary name so a cached page is never half written
+    temporary_path = output_path + ".tmp"
+    Image.fromarray(montage(tiles, columns, display_range=display_range)).save(temporary_path, format="PNG")
+    os.replace(temporary_path, output_path)
+    return output_path
+
+def render_gallery(stack_path, measurements_path=None, sort_by=None, ascending=True, rows=10, columns=10,
+                   pages=None, cache_dir=None, display_range=None, workers=None):
+    """
+    Render the requested pages (all by default) in a thread pool and return their PNG paths.
+    Pages already in the cache are returned without reading the stack or the measurements.
+    """
+    if pages is None:
+        index = pd.read_csv(os.path.splitext(stack_path)[0] + "_index.csv", usecols=['page'])
+        pages = range(-(-int(index['page'].notna().sum()) // (rows * columns)))
+    paths = [page_path(stack_path, page, rows, columns, cache_dir, display_range, sort_by, ascending,
+                       measurements_path) for page in pages]
+    missing = [(page, path) for page, path in zip(pages, paths) if not os.path.exists(path)]
+    if not missing:
+        return paths
+
+    measurements = pd.read_csv(measurements_path) if measurements_path else None
+    table = load_gallery_table(stack_path, measurements, sort_by, ascending)
+    if display_range is None and len(table):
+        # One display range for the whole gallery, from a sample of its cells, so pages can be compared
+        sample = read_pages(stack_path, np.sort(table['page'].sample(min(len(table), 500), random_state=0)))
+        nonzero = sample[sample > 0]
+        display_range = tuple(np.percentile(nonzero, [0.5, 99.5])) if nonzero.size else (0, 1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda job: render_page(stack_path, table, job[0], job[1], rows, columns, display_range),
+                          missing))
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Render galleries of the oriented cells in a stack.')
+    parser.add_argument('stack', help='Stack written by save_stack.py, e.g. ./experiments/exp1_230509_cr.tif')
+    parser.add_argument('--measurements', default='./experiments/object_image_list_obj_stats.csv',
+                        help='Table with a row per object to join and sort by.')
+    parser.add_argument('--sort-by', default=None, help='Column to order the cells by, e.g. Area or Swim_Angle.')
+    parser.add_argument('--descending', action='store_true', help='Largest values first.')
+    parser.add_argument('--rows', type=int, default=10, help='Rows of cells per page.')
+    parser.add_argument('--columns', type=int, default=10, help='Columns of cells per page.')
+    parser.add_argument('--page', type=int, nargs='*', default=None, help='Pages to render (default: all).')
+    parser.add_argument('--cache-dir', default=None, help='Where pages are written (default: next to the stack).')
+    parser.add_argument('--range', type=float, nargs=2, default=None, help='Display range of the 8-bit pages.')
+    parser.add_argument('--workers', type=int, default=None, help='Rendering threads.')
+    args = parser.parse_args()
+
+    measurements_path = args.measurements if os.path.exists(args.measurements) else None
+    for path in render_gallery(args.stack, measurements_path, args.sort_by, not args.descending, args.rows,
+                               args.columns, args.page, args.cache_dir, args.range, args.workers):
+        print(f"Saved gallery page to {path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,24 @@
 """
 The script reads metadata and image information from a CSV file using
-the pandas library and iterates over each row to perform image masking.
+the pandas library and masks the frame of every listed object.
 For each row, it constructs file paths for mask and image files,
-reads them using the PIL library, and applies a mask where the mask
-value is 255. The masked images are then saved to a specified output
-directory, which is created if it doesn't already exist. The script
-also includes utility functions to extract specific text substrings
-from the image names for further processing.
+and applies a mask where the mask value is 255. The masked images are
+then saved to a specified output directory, which is created if it
+doesn't already exist. The script also includes utility functions to
+extract specific text substrings from the image names for further processing.
+
+Rows are grouped by their source focus stack so that each stack is opened
+once; the frames needed for a stack are read through tifffile (memory-mapped
+when the file layout allows it), all of its masks are applied in one
+vectorized pass, and stacks are processed in parallel.
 """
 
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from PIL import Image
 import numpy as np
+import tifffile
 
 def get_text_before_probab(input_string):
     index = input_string.find("_Probab")
@@ -28,46 +34,73 @@ def get_text_before_seq(input_string):
     else:
         return "String does not contain '_seq'"
 
-
-# Read the CSV file into a pandas DataFrame
-df = pd.read_csv("./experiments/object_image_list_angles.csv")
-
-# Loop through each row in the DataFrame
-for index, row in df.iterrows():
-    metadata_experiment = row['metadata_experiment']
-    metadata_species = row['metadata_species']
-    image_frame = row['seq_frame']
-    well_name = row['well_name']
-    Image_name = row['Image']
-    image_stack = get_text_before_probab(Image_name)
-    metadata_pool_id = row['metadata_pool_id']
-    focus_pool_id = get_text_before_seq(Image_name)
+def build_mask_jobs(df, base_directory="./experiments"):
+    """Add mask_path, image_path and output_path columns to the object list."""
+    jobs = df.copy()
+    image_stack = jobs['Image'].map(get_text_before_probab)
+    focus_pool_id = jobs['Image'].map(get_text_before_seq)
+    prefix = base_directory + "/" + jobs['metadata_experiment'].astype(str)
 
     # Construct the file paths
-    mask_path = f"./experiments/{metadata_experiment}/max_area/{metadata_species}/{metadata_pool_id}/{Image_name}"
-    image_path = f"./experiments/{metadata_experiment}/focus/{metadata_species}/{focus_pool_id}/{image_stack}.tif"
-    output_path = f"./experiments/{metadata_experiment}/masked/{metadata_species}/{metadata_pool_id}/{Image_name}_mask.tif"
+    jobs['mask_path'] = (prefix + "/max_area/" + jobs['metadata_species'].astype(str) + "/"
+                         + jobs['metadata_pool_id'].astype(str) + "/" + jobs['Image'])
+    jobs['image_path'] = (prefix + "/focus/" + jobs['metadata_species'].astype(str) + "/"
+                          + focus_pool_id + "/" + image_stack + ".tif")
+    jobs['output_path'] = (prefix + "/masked/" + jobs['metadata_species'].astype(str) + "/"
+                           + jobs['metadata_pool_id'].astype(str) + "/" + jobs['Image'] + "_mask.tif")
+    return jobs
+
+def read_stack_frames(image_path, frames):
+    """Read the given frames of a multi-page TIFF with a single open of the file."""
+    frames = np.asarray(frames, dtype=int)
+    # tifffile and the memory map share one file handle
+    with open(image_path, 'rb') as file_handle:
+        with tifffile.TiffFile(file_handle) as tif:
+            series = tif.series[0]
+            if series.dataoffset is not None:
+                # Contiguous, uncompressed stacks are memory-mapped so only the requested pages are touched
+                stack = np.memmap(file_handle, dtype=np.dtype(tif.byteorder + series.dtype.char), mode='r',
+                                  offset=series.dataoffset, shape=series.shape)
+                stack = stack.reshape((-1,) + stack.shape[-2:])
+                return np.array(stack[frames])
 
-    # Ensure output directory exists
-    output_dir = os.path.dirname(output_path)
-    os.makedirs(output_dir, exist_ok=True)
+            # Otherwise decode only the pages that are needed
+            unique_frames, inverse = np.unique(frames, return_inverse=True)
+            pages = np.stack([tif.pages[int(frame)].asarray() for frame in unique_frames])
+            return pages[inverse]
 
-    # Read the mask and image
-    mask = Image.open(mask_path).convert("L")
-    image_stack = Image.open(image_path)
+def mask_stack(image_path, rows):
+    """Mask every row that points into one focus stack. Returns the number of rows written."""
     print("Processing image " + image_path)
-    print("Processing frame " + str(image_frame))
-    image_stack.seek(image_frame)  # Navigate to the frame we care about
+    frames = read_stack_frames(image_path, rows['seq_frame'].to_numpy())
 
-    # Perform masking
-    mask_array = np.array(mask)
-    image_array = np.array(image_stack)
+    # Read the masks for every object of this stack
+    masks = np.stack([np.array(Image.open(path).convert("L")) for path in rows['mask_path']])
 
     # Here 255 is the value representing the mask. Change accordingly if your mask uses a different value.
-    masked_image_array = np.where(mask_array == 255, image_array, 0)
+    masked = np.where(masks == 255, frames, 0).astype("uint16")
+
+    # Write all masked images of the stack in one batch
+    for output_path in rows['output_path'].unique():
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    for output_path, masked_image in zip(rows['output_path'], masked):
+        tifffile.imwrite(output_path, masked_image)
+    return len(rows)
+
+def _mask_stack_job(job):
+    return mask_stack(*job)
+
+def mask_objects(df, base_directory="./experiments", workers=None):
+    """Mask every object in the list, one task per source stack. Returns the number of rows and stacks."""
+    jobs = build_mask_jobs(df, base_directory)
+    tasks = [(image_path, rows) for image_path, rows in jobs.groupby('image_path', sort=False)]
 
-    # Save the masked image
-    masked_image = Image.fromarray(masked_image_array.astype("uint16"))
-    masked_image.save(output_path)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        n_rows = sum(executor.map(_mask_stack_job, tasks))
+    print(f"Saved {n_rows} masked images from {len(tasks)} stacks")
+    return n_rows, len(tasks)
 
-    print(f"Saved masked image to {output_path}")
+if __name__ == "__main__":
+    # Read the CSV file into a pandas DataFrame
+    df = pd.read_csv("./experiments/object_image_list_angles.csv")
+    mask_objects(df, "./experiments")
@@ -0,0 +1,124 @@
+"""
+The script runs the masking, cropping/orienting and stacking steps
+(image_mask.py, crop_orient_major.py and save_stack.py) as one streaming
+pipeline. Each object in object_image_list_obj_stats.csv is taken from its
+frame in the focus stack to a masked, cropped and oriented 49x49 tile in
+memory, and the tile is written straight into a preallocated, memory-mapped
+ImageJ stack per experiment and species. Objects are processed in parallel,
+one task per source focus stack, with a bounded number of tasks in flight so
+that peak memory does not grow with the size of the experiment. The
+intermediate _mask.tif and _orient.tif files can optionally still be written.
+A <stack>_index.csv like the one of save_stack.py maps each page to its object,
+with the focus stack it was taken from as the source.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import tifffile
+from PIL import Image
+
+from image_mask import build_mask_jobs, read_stack_frames
+from crop_orient_major import crop_tile, orient_tiles
+from save_stack import INDEX_COLUMNS
+
+TILE_SIZE = 49
+
+def plan_tiles(df, base_directory="./experiments"):
+    """
+    Select the objects that crop_orient_major.py would process, attach their file paths
+    and assign each one a page in the stack of its experiment and species.
+    """
+    # Skip rows with NaN values and only process rows where mean_object < 1.1
+    keep = df[['Center_X', 'Center_Y', 'Angle_with_Y_Axis']].notna().all(axis=1) & (df['mean_object'] < 1.1)
+    print(f"Skipping {(~keep).sum()} rows with NaN values or mean_object >= 1.1")
+    jobs = build_mask_jobs(df[keep], base_directory)
+
+    # Check the inputs exist with one directory listing per folder
+    listings = {}
+    def exists(path):
+        directory, name = os.path.split(path)
+        if directory not in listings:
+            listings[directory] = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        return name in listings[directory]
+    found = jobs['mask_path'].map(exists) & jobs['image_path'].map(exists)
+    for path in jobs.loc[~found, 'mask_path']:
+        print(f"Inputs for {path} not found. Skipping.")
+    jobs = jobs[found].copy()
+
+    # Key for image stack and position of each object within it
+    jobs['stack_key'] = jobs['metadata_experiment'].astype(str) + "_" + jobs['metadata_species'].astype(str)
+    jobs['page'] = jobs.groupby('stack_key', sort=False).cumcount()
+    jobs['orient_path'] = (base_directory + "/" + jobs['metadata_experiment'].astype(str) + "/oriented_major/"
+                           + jobs['metadata_species'].astype(str) + "/" + jobs['metadata_pool_id'].astype(str)
+                           + "/" + jobs['Image'] + "_orient.tif")
+    return jobs
+
+def process_source_stack(image_path, rows, write_intermediates=False):
+    """Produce the oriented tiles of every object in one focus stack."""
+    frames = read_stack_frames(image_path, rows['seq_frame'].to_numpy())
+    masks = np.stack([np.array(Image.open(path).convert("L")) for path in rows['mask_path']])
+
+    # Here 255 is the value representing the mask
+    masked = np.where(masks == 255, frames, 0).astype("uint16")
+
+    cropped = [crop_tile(masked_frame, x, y, TILE_SIZE)
+               for masked_frame, x, y in zip(masked, rows['Center_X'], rows['Center_Y'])]
+    tiles, _ = orient_tiles(cropped, rows['Angle_with_Y_Axis'].to_numpy())
+
+    if write_intermediates:
+        for paths, images in ((rows['output_path'], masked), (rows['orient_path'], tiles)):
+            for path, image in zip(paths, images):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tifffile.imwrite(path, image)
+
+    return rows['stack_key'].to_numpy(), rows['page'].to_numpy(), tiles
+
+def _process_source_stack_job(job):
+    return process_source_stack(*job)
+
+def run_pipeline(df, base_directory="./experiments", workers=None, write_intermediates=False, max_in_flight=None):
+    """Write one ImageJ stack per experiment and species; returns the planned objects with their pages."""
+    jobs = plan_tiles(df, base_directory)
+
+    # Preallocate every output stack on disk
+    stacks = {}
+    for stack_key, n_pages in jobs.groupby('stack_key', sort=False).size().items():
+        stack_file_path = os.path.join(base_directory, f"{stack_key}.tif")
+        stacks[stack_key] = tifffile.memmap(stack_file_path, shape=(n_pages, TILE_SIZE, TILE_SIZE),
+                                            dtype=np.uint16, imagej=True)
+
+    tasks = ((image_path, rows, write_intermediates) for image_path, rows in jobs.groupby('image_path', sort=False))
+    max_in_flight = max_in_flight or 2 * (workers or os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        def drain_one():
+            keys, pages, tiles = pending.popleft().result()
+            for stack_key, page, tile in zip(keys, pages, tiles):
+                stacks[stack_key][page] = tile
+
+        # Only a bounded number of source stacks are in flight at any time
+        for task in tasks:
+            pending.append(executor.submit(_process_source_stack_job, task))
+            if len(pending) >= max_in_flight:
+                drain_one()
+        while pending:
+            drain_one()
+
+    for stack_key, stack in stacks.items():
+        stack.flush()
+        print(f"Saved image stack to {os.path.join(base_directory, f'{stack_key}.tif')}")
+    stacks.clear()
+
+    # Index mapping each page back to its object, as save_stack.py writes it
+    index = jobs.assign(source_path=jobs['image_path'], height=TILE_SIZE, width=TILE_SIZE, status="ok")
+    for stack_key, rows in index.groupby('stack_key', sort=False):
+        rows[INDEX_COLUMNS].to_csv(os.path.join(base_directory, f"{stack_key}_index.csv"), index=False)
+    return jobs
+
+if __name__ == "__main__":
+    df = pd.read_csv("./experiments/object_image_list_obj_stats.csv")
+    run_pipeline(df, "./experiments", write_intermediates=False)
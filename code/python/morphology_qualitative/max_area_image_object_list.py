@@ -7,37 +7,60 @@ performs several column calculations based on existing columns,
 and then appends this processed data to an overall DataFrame.
 Finally, the script saves the aggregated DataFrame into a new CSV file
 called `object_image_list.csv` in the `base_directory`.
+
+The CSV files are collected first and combined with a single concat, and the
+derived columns are computed with vectorized string operations on the
+combined DataFrame. Regex replacements are used rather than split, since
+they stay vectorized for pyarrow-backed string columns.
 """
 import os
 import pandas as pd
 
-def object_list(base_directory):
-    # Create an empty DataFrame to store all the results
-    all_data = pd.DataFrame()
+def load_max_area_data(base_directory):
+    """Read every max_area/.../max_area_data.csv under base_directory into one DataFrame."""
+    frames = []
 
-    # Walk through the base directory and process the CSV files in subdirectories
+    # Walk through the base directory and collect the CSV files in subdirectories
     for root, dirs, files in os.walk(base_directory):
         if '/max_area/' in root and 'max_area_data.csv' in files:
             csv_path = os.path.join(root, 'max_area_data.csv')
-            df = pd.read_csv(csv_path)
+            frames.append(pd.read_csv(csv_path))
+
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
 
-            # Calculate the 'seq_frame' column based on the 'Image' column
-            df['seq_frame'] = df['Image'].apply(lambda x: x.split("_")[-1].split(".")[0])
+def add_object_list_columns(df):
+    """Add seq_frame, first_seq_frame, image_frame and well_name, computed for all rows at once."""
+    df = df.copy()
+    if df.empty:
+        return df
+    images = df['Image'].astype(str)
 
-            # Calculate the 'first_seq_frame' column based on the 'metadata_frames' column
-            df['first_seq_frame'] = df['metadata_frames'].apply(lambda x: x.split("to")[0])
+    # Calculate the 'seq_frame' column based on the 'Image' column
+    # (the part after the last "_", up to its first ".")
+    df['seq_frame'] = images.str.replace(r'^.*_', '', regex=True).str.replace(r'\..*$', '', regex=True)
 
-            # Calculate the 'image_frame' column based on 'seq_frame' and 'first_seq_frame'
-            df['image_frame'] = df['seq_frame'].astype(int) + df['first_seq_frame'].astype(int)
+    # Calculate the 'first_seq_frame' column based on the 'metadata_frames' column
+    df['first_seq_frame'] = df['metadata_frames'].astype(str).str.replace(r'to.*$', '', regex=True)
 
-            # Calculate the 'well_name' column based on the 'Image' column
-            df['well_name'] = df['Image'].apply(lambda x: x.split("_seq")[0] + ".tif")
+    # Calculate the 'image_frame' column based on 'seq_frame' and 'first_seq_frame'
+    df['image_frame'] = df['seq_frame'].astype(int) + df['first_seq_frame'].astype(int)
 
-            # Append the data to the overall DataFrame
-            all_data = pd.concat([all_data, df], ignore_index=True)
+    # Calculate the 'well_name' column based on the 'Image' column
+    df['well_name'] = images.str.replace(r'_seq.*$', '', regex=True) + ".tif"
+    return df
+
+def build_object_list(base_directory):
+    """Return the object list of every max_area_data.csv under base_directory."""
+    return add_object_list_columns(load_max_area_data(base_directory))
+
+def object_list(base_directory):
+    all_data = build_object_list(base_directory)
 
     # Save the aggregated DataFrame to a new CSV file
     all_data.to_csv(os.path.join(base_directory, 'object_image_list.csv'), index=False)
+    return all_data
 
 #Entry point
 if __name__ == "__main__":
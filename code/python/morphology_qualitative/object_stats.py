@@ -7,47 +7,92 @@ column. It also extracts specific metadata. The computed statistics and
 metadata are then merged with an existing CSV file, and the result is
 saved as a new CSV file in the base directory. The function is executed
 for a specific base directory defined as "./experiments".
+
+The measurement tables are read in parallel, only the columns that are
+needed, into one DataFrame (or from a single Parquet dataset), and all
+statistics are computed in one groupby pass over it, one group per
+measurement file. Quantiles of Object_ID and statistics of the number of
+objects per frame can be added on top without reading anything again.
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
-def compute_object_stats(base_directory):
-    # Create a list to store the results
-    results = []
+METADATA_COLUMNS = ["metadata_experiment", "metadata_pool_id", "metadata_species"]
 
-    # Walk through the base directory and process the CSV files in subdirectories
+def find_measurement_files(base_directory):
+    """Paths of every objects/.../object_measurements.csv under base_directory, in walk order."""
+    paths = []
     for root, dirs, files in os.walk(base_directory):
         if '/objects/' in root and 'object_measurements.csv' in files:
-            csv_path = os.path.join(root, 'object_measurements.csv')
-            df = pd.read_csv(csv_path)
-
-            # Compute the mean measurements for this CSV
-            mean_object = df['Object_ID'].mean()
-            max_object = df['Object_ID'].max()
-            mode_object = df['Object_ID'].mode()[0]  # Mode returns a Series, take the first element
-            std_object = df['Object_ID'].std()
-            median_object = df['Object_ID'].median()
-
-            # Extract metadata_species and metadata_pool_id from the CSV
-            species = df['metadata_species'].iloc[0]
-            pool_id = df['metadata_pool_id'].iloc[0]
-            experiment_value = df['metadata_experiment'].iloc[0]
-
-            # Append the data to the results list
-            results.append({
-                "metadata_experiment": experiment_value,
-                "metadata_pool_id": pool_id,
-                "metadata_species": species,
-                "mean_object": mean_object,
-                "max_object": max_object,
-                "mode_object": mode_object,
-                "std_object": std_object,
-                "median_object": median_object
-            })
-
-    # Convert the results list to a DataFrame
-    results_df = pd.DataFrame(results)
+            paths.append(os.path.join(root, 'object_measurements.csv'))
+    return paths
+
+def load_measurements(source, columns=None, workers=None):
+    """
+    Read the measurement tables into one DataFrame with a 'source' column numbering the
+    table each row came from. `source` is a base directory, whose object_measurements.csv
+    files are read in parallel, or a Parquet file or dataset that already has a 'source' column.
+    """
+    if not os.path.isdir(source) or source.endswith('.parquet'):
+        # pandas raises a helpful ImportError itself if pyarrow is not installed
+        return pd.read_parquet(source, columns=None if columns is None else ['source'] + list(columns))
+
+    paths = find_measurement_files(source)
+    if not paths:
+        return pd.DataFrame(columns=['source'] + list(columns or []))
+
+    def read(indexed_path):
+        index, path = indexed_path
+        df = pd.read_csv(path, usecols=columns)
+        df.insert(0, 'source', index)
+        return df
+
+    # The CSV parser spends most of its time outside the interpreter, so threads are enough
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return pd.concat(executor.map(read, enumerate(paths)), ignore_index=True)
+
+def summarize_objects(measurements, quantiles=(), per_frame=False, extra=None):
+    """
+    One row per measurement table with its metadata and the mean, max, mode, std and
+    median of Object_ID. Optionally adds Object_ID quantiles (quantile_object_<q>),
+    the mean, max and median number of objects per frame (image), and any further
+    {column name: aggregation} of Object_ID accepted by pandas' agg.
+    """
+    grouped = measurements.groupby('source')['Object_ID']
+    aggregations = {
+        "mean_object": "mean",
+        "max_object": "max",
+        "std_object": "std",
+        "median_object": "median",
+    }
+    aggregations.update(extra or {})
+    stats = grouped.agg(**aggregations)
+
+    # Mode: the most frequent Object_ID of each table, the smallest one on ties
+    counts = measurements.groupby(['source', 'Object_ID']).size().rename('count').reset_index()
+    counts = counts.sort_values(['source', 'count', 'Object_ID'], ascending=[True, False, True])
+    stats.insert(2, "mode_object", counts.drop_duplicates('source').set_index('source')['Object_ID'])
+
+    for q in quantiles:
+        stats[f"quantile_object_{q:g}"] = grouped.quantile(q)
+
+    if per_frame:
+        objects_per_frame = measurements.groupby(['source', 'Image']).size().groupby('source')
+        stats["mean_objects_per_frame"] = objects_per_frame.mean()
+        stats["max_objects_per_frame"] = objects_per_frame.max()
+        stats["median_objects_per_frame"] = objects_per_frame.median()
+
+    # Extract metadata from the first row of each table
+    metadata = measurements.drop_duplicates('source').set_index('source')[METADATA_COLUMNS]
+    return metadata.join(stats).reset_index(drop=True)
+
+def compute_object_stats(base_directory, source=None, quantiles=(), per_frame=False, extra=None, workers=None):
+    # Read only the columns the statistics need
+    columns = ['Object_ID'] + METADATA_COLUMNS + (['Image'] if per_frame else [])
+    measurements = load_measurements(source or base_directory, columns, workers)
+    results_df = summarize_objects(measurements, quantiles, per_frame, extra)
 
     # Load the existing CSV file into another DataFrame
     existing_df_path = os.path.join(base_directory, 'object_image_list_angles.csv')
@@ -58,11 +103,12 @@ def compute_object_stats(base_directory):
         existing_df,
         results_df,
         how="left",
-        on=["metadata_experiment", "metadata_pool_id", "metadata_species"]
+        on=METADATA_COLUMNS
     )
 
     # Save the merged DataFrame to a new CSV file
     merged_df.to_csv(os.path.join(base_directory, 'object_image_list_obj_stats.csv'), index=False)
+    return merged_df
 
 #Entry point
 if __name__ == "__main__":
@@ -6,63 +6,119 @@ of experiment and species metadata. Finally, the script saves
 these stacks as TIFF files, after ensuring all images in a stack
 have the same shape. The image stacks are saved in the
 "./experiments" directory.
+
+Each image is appended to its ImageJ stack as soon as it is read, using
+tifffile's contiguous writing, so memory use stays at one image whatever
+the size of the stack. The first image of a stack fixes its shape; a later
+image with a different shape is centre padded (or cropped) to it, or
+rejected on its own with mismatch="reject", instead of the whole stack
+being skipped. Next to every stack a <stack>_index.csv maps each page back
+to the object it came from and records images that were padded, rejected or
+missing.
 """
 
 import os
-import pandas as pd
-from PIL import Image
 import numpy as np
-from tifffile import imwrite
+import pandas as pd
+import tifffile
 
-# Initialize a dictionary to hold image stacks
-image_stacks = {}
+INDEX_COLUMNS = ['page', 'metadata_experiment', 'metadata_species', 'metadata_pool_id', 'Image',
+                 'source_path', 'height', 'width', 'status']
 
-# Read the CSV file into a pandas DataFrame
-df = pd.read_csv("./experiments/object_image_list_obj_stats.csv")
+def fit_tile(tile, shape):
+    """Centre a tile in a zero canvas of the given shape, cropping it where it is larger."""
+    canvas = np.zeros(shape, dtype=tile.dtype)
+    height, width = min(tile.shape[0], shape[0]), min(tile.shape[1], shape[1])
+    src_top, src_left = (tile.shape[0] - height) // 2, (tile.shape[1] - width) // 2
+    dst_top, dst_left = (shape[0] - height) // 2, (shape[1] - width) // 2
+    canvas[dst_top:dst_top + height, dst_left:dst_left + width] = \
+        tile[src_top:src_top + height, src_left:src_left + width]
+    return canvas
 
-# Loop through each row in the DataFrame
-for index, row in df.iterrows():
-    metadata_experiment = row['metadata_experiment']
-    metadata_species = row['metadata_species']
-    metadata_pool_id = row['metadata_pool_id']
-    Image_name = row['Image']
+def append_tile(stack, tile, mismatch="pad"):
+    """
+    Append one image to an open stack (a dict with its path, writer, shape, dtype and page count).
+    Returns the page it was written to, or None if it was rejected, and its status.
+    """
+    if stack['writer'] is None:
+        # The first image fixes the shape and dtype of the stack
+        stack['writer'] = tifffile.TiffWriter(stack['path'], imagej=True)
+        stack['shape'], stack['dtype'] = tile.shape, tile.dtype
 
-    # Key for image stack
-    stack_key = f"{metadata_experiment}_{metadata_species}"
+    status = "ok"
+    if tile.dtype != stack['dtype']:
+        if mismatch != "pad" or not np.can_cast(tile.dtype, stack['dtype'], casting="safe"):
+            return None, "rejected"
+        tile = tile.astype(stack['dtype'])
+        status = "padded"
+    if tile.shape != stack['shape']:
+        if mismatch != "pad" or tile.ndim != len(stack['shape']):
+            return None, "rejected"
+        tile = fit_tile(tile, stack['shape'])
+        status = "padded"
 
-    # Initialize list if key does not exist
-    if stack_key not in image_stacks:
-        image_stacks[stack_key] = []
+    stack['writer'].write(tile, contiguous=True)
+    stack['pages'] += 1
+    return stack['pages'] - 1, status
 
-    # Construct the file paths
-    mask_path = f"./experiments/{metadata_experiment}/oriented_major/{metadata_species}/{metadata_pool_id}/{Image_name}_orient.tif"
+def save_stacks(df, base_directory="./experiments", mismatch="pad"):
+    """Write one ImageJ stack and index per experiment and species; returns the combined index."""
+    if mismatch not in ("pad", "reject"):
+        raise ValueError(f"mismatch must be 'pad' or 'reject', not {mismatch!r}")
 
+    # Open stacks and the index rows of each, keyed by experiment and species
+    stacks = {}
+    index = {}
     try:
-        # Try to read the oriented image
-        oriented_image = Image.open(mask_path)
-    except FileNotFoundError:
-        print(f"File {mask_path} not found. Skipping.")
-        continue
-
-    oriented_image_array = np.array(oriented_image)
-
-    # Append to the corresponding list in the dictionary
-    image_stacks[stack_key].append(oriented_image_array)
+        # Loop through each row in the DataFrame
+        for row in df.itertuples(index=False):
+            # Key for image stack
+            stack_key = f"{row.metadata_experiment}_{row.metadata_species}"
+            if stack_key not in stacks:
+                stacks[stack_key] = {'path': os.path.join(base_directory, f"{stack_key}.tif"),
+                                     'writer': None, 'shape': None, 'dtype': None, 'pages': 0}
+                index[stack_key] = []
 
-# Save the image stacks as TIFF files
-base_directory = "./experiments"
-for stack_key, image_list in image_stacks.items():
-    stack_file_path = os.path.join(base_directory, f"{stack_key}.tif")
+            # Construct the file paths
+            mask_path = (f"{base_directory}/{row.metadata_experiment}/oriented_major/{row.metadata_species}/"
+                         f"{row.metadata_pool_id}/{row.Image}_orient.tif")
+            record = {'page': None, 'metadata_experiment': row.metadata_experiment,
+                      'metadata_species': row.metadata_species, 'metadata_pool_id': row.metadata_pool_id,
+                      'Image': row.Image, 'source_path': mask_path, 'height': None, 'width': None}
 
-    # Check that all images have the same shape
-    unique_shapes = {img.shape for img in image_list}
-    if len(unique_shapes) > 1:
-        print(f"Skipping {stack_key}: Inconsistent image shapes {unique_shapes}")
-        continue
+            try:
+                # Try to read the oriented image
+                oriented_image_array = tifffile.imread(mask_path)
+            except FileNotFoundError:
+                print(f"File {mask_path} not found. Skipping.")
+                index[stack_key].append(dict(record, status="missing"))
+                continue
 
-    # Convert list of arrays to single 3D array
-    image_stack_array = np.stack(image_list, axis=0)
+            record['height'], record['width'] = oriented_image_array.shape[:2]
+            page, status = append_tile(stacks[stack_key], oriented_image_array, mismatch)
+            if status != "ok":
+                print(f"{row.Image}: {oriented_image_array.shape} {oriented_image_array.dtype} does not match "
+                      f"{stacks[stack_key]['shape']} {stacks[stack_key]['dtype']} of {stack_key}, {status}.")
+            index[stack_key].append(dict(record, page=page, status=status))
+    finally:
+        for stack in stacks.values():
+            if stack['writer'] is not None:
+                stack['writer'].close()
 
-    imwrite(stack_file_path, image_stack_array, imagej=True)
+    # Save the index next to each stack
+    tables = []
+    for stack_key, records in index.items():
+        table = pd.DataFrame(records, columns=INDEX_COLUMNS).astype({'page': 'Int64', 'height': 'Int64',
+                                                                      'width': 'Int64'})
+        if stacks[stack_key]['pages']:
+            print(f"Saved image stack to {stacks[stack_key]['path']}")
+            table.to_csv(os.path.splitext(stacks[stack_key]['path'])[0] + "_index.csv", index=False)
+        else:
+            print(f"Skipping {stack_key}: no images found")
+        tables.append(table.assign(stack=stack_key))
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=INDEX_COLUMNS + ['stack'])
 
-    print(f"Saved image stack to {stack_file_path}")
+if __name__ == "__main__":
+    # Read the CSV file into a pandas DataFrame
+    df = pd.read_csv("./experiments/object_image_list_obj_stats.csv")
+    save_stacks(df, "./experiments")
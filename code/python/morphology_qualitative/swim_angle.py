@@ -5,97 +5,99 @@ sequence, it calculates the angle between consecutive vectors formed by the
 object's coordinates in three images. Finally, it adds these calculated angles,
 along with some other information like coordinates for the "next" image and
 angles with the Y-axis, as new columns to the DataFrame and saves it as a
-new CSV file."""
+new CSV file.
+
+The coordinates of the previous, current and next image are looked up for all
+rows at once from the measurements indexed by image name, and the angles are
+computed as array operations. Only images containing exactly one object are
+used; frames where any of the three images has zero or several objects get
+empty angle columns."""
 
 import os
 import pandas as pd
 import numpy as np
-import math
 
 # Function to calculate angle between two vectors
 def calculate_angle(vec1, vec2):
-    dot_product = np.dot(vec1, vec2)
-    magnitude_vec1 = np.linalg.norm(vec1)
-    magnitude_vec2 = np.linalg.norm(vec2)
-
-    angle = np.arccos(dot_product / (magnitude_vec1 * magnitude_vec2))
-    return math.degrees(angle)
-
-
-# Initialize an empty DataFrame to store all data
-all_data = pd.DataFrame()
-
-# Define the base directory
-base_directory = "./experiments"
-
-# Load object_measurement data
-for root, dirs, files in os.walk(base_directory):
-    if '/objects/' in root and 'object_measurements.csv' in files:
-        csv_path = os.path.join(root, 'object_measurements.csv')
-        data = pd.read_csv(csv_path)
-
-        print(f"Columns in loaded DataFrame from {csv_path}: {data.columns}")
-        print("Sample data:", data.head())
-
-        all_data = pd.concat([all_data, data])
-
-# Check if all_data is empty
-if all_data.empty:
-    print("all_data DataFrame is empty.")
-
-# Read the object_image_list CSV file into a DataFrame
-object_image_list_path = "./experiments/object_image_list_frames.csv"  # <-- Correct this path
-object_image_list = pd.read_csv(object_image_list_path)
-
-# ... (previous code for imports, function definition, and DataFrame loading)
-
-# Initialize lists to store angles and coordinates
-angles = []
-coords_next_x = []
-coords_next_y = []
-angles_with_y_axis = []
-
-# Loop through object_image_list to get the frames
-for index, row in object_image_list.iterrows():
-    prev_image = row['previous_image']
-    current_image = row['Image']
-    next_image = row['next_image']
-
-    # Get coordinates for these frames from all_data
-    coords_prev = all_data[all_data['Image'] == prev_image][['Center_X', 'Center_Y']].values
-    coords_current = all_data[all_data['Image'] == current_image][['Center_X', 'Center_Y']].values
-    coords_next = all_data[all_data['Image'] == next_image][['Center_X', 'Center_Y']].values
-
-    # Check if coordinates are available for all frames and that each frame has exactly one object
-    if len(coords_prev) == 1 and len(coords_current) == 1 and len(coords_next) == 1:
-        # Calculate vectors
-        vec1 = coords_current - coords_prev
-        vec2 = coords_next - coords_current
-
-        # Calculate angle
-        angle = calculate_angle(vec1[0], vec2[0])  # As there's only one row, we can directly use vec1[0] and vec2[0]
-        angles.append(angle)
-
-        # Store the coordinates from coords_next
-        coords_next_x.append(coords_next[0][0])
-        coords_next_y.append(coords_next[0][1])
-
-        # Calculate angle with positive Y-axis
-        angle_with_y_axis = math.degrees(math.atan2(vec2[0][0], vec2[0][1]))
-        angles_with_y_axis.append(angle_with_y_axis)
-
-    else:
-        print(f"Skipping angle calculation for frames: {prev_image}, {current_image}, {next_image} due to multiple objects.")
-        angles.append(None)
-        coords_next_x.append(None)
-        coords_next_y.append(None)
-        angles_with_y_axis.append(None)
-
-# Add angles and coordinates as new columns to object_image_list
-object_image_list['Swim_Angle'] = angles
-object_image_list['coords_next_X'] = coords_next_x
-object_image_list['coords_next_Y'] = coords_next_y
-object_image_list['Angle_with_Y_Axis'] = angles_with_y_axis
-
-# Save the updated DataFrame as a new CSV file
-object_image_list.to_csv("./experiments/object_image_list_angles.csv", index=False)
+    """Angle in degrees between row vectors of two (N, 2) arrays; NaN where either vector has zero length."""
+    vec1 = np.atleast_2d(vec1)
+    vec2 = np.atleast_2d(vec2)
+    dot_product = np.einsum('ij,ij->i', vec1, vec2)
+    magnitude_vec1 = np.linalg.norm(vec1, axis=1)
+    magnitude_vec2 = np.linalg.norm(vec2, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos_angle = dot_product / (magnitude_vec1 * magnitude_vec2)
+    return np.degrees(np.arccos(np.clip(cos_angle, -1.0, 1.0)))
+
+def load_object_measurements(base_directory):
+    """Read every objects/.../object_measurements.csv under base_directory into one DataFrame."""
+    frames = []
+    for root, dirs, files in os.walk(base_directory):
+        if '/objects/' in root and 'object_measurements.csv' in files:
+            frames.append(pd.read_csv(os.path.join(root, 'object_measurements.csv')))
+
+    if not frames:
+        print("all_data DataFrame is empty.")
+        return pd.DataFrame(columns=['Image', 'Center_X', 'Center_Y'])
+    # A single concat instead of growing the frame inside the walk
+    return pd.concat(frames, ignore_index=True)
+
+def compute_swim_angles(object_image_list, all_data):
+    """
+    Add Swim_Angle, coords_next_X, coords_next_Y and Angle_with_Y_Axis to object_image_list.
+    """
+    # Index the measurements by image; images with several objects are kept out of the lookup
+    object_counts = all_data.groupby('Image').size()
+    single_objects = all_data[all_data['Image'].map(object_counts) == 1].set_index('Image')[['Center_X', 'Center_Y']]
+
+    # Look up previous, current and next coordinates for all rows at once
+    coords_prev = single_objects.reindex(object_image_list['previous_image']).to_numpy(dtype=float)
+    coords_current = single_objects.reindex(object_image_list['Image']).to_numpy(dtype=float)
+    coords_next = single_objects.reindex(object_image_list['next_image']).to_numpy(dtype=float)
+
+    # Rows where each of the three frames has exactly one object
+    valid = ~(np.isnan(coords_prev).any(axis=1) | np.isnan(coords_current).any(axis=1) | np.isnan(coords_next).any(axis=1))
+
+    # Report frames skipped because an image has zero or several objects
+    n_objects = pd.DataFrame({
+        column: object_image_list[column].map(object_counts).fillna(0).astype(int)
+        for column in ['previous_image', 'Image', 'next_image']
+    })
+    multiple = (~valid & (n_objects > 1).any(axis=1)).sum()
+    missing = (~valid).sum() - multiple
+    print(f"Skipping angle calculation for {multiple} frames due to multiple objects "
+          f"and {missing} frames with missing objects.")
+
+    # Calculate vectors
+    vec1 = coords_current - coords_prev
+    vec2 = coords_next - coords_current
+
+    result = object_image_list.copy()
+    result['Swim_Angle'] = np.where(valid, calculate_angle(vec1, vec2), np.nan)
+    result['coords_next_X'] = np.where(valid, coords_next[:, 0], np.nan)
+    result['coords_next_Y'] = np.where(valid, coords_next[:, 1], np.nan)
+    # Calculate angle with positive Y-axis
+    result['Angle_with_Y_Axis'] = np.where(valid, np.degrees(np.arctan2(vec2[:, 0], vec2[:, 1])), np.nan)
+    return result
+
+def add_swim_angles(base_directory="./experiments"):
+    """Add the swim angles to object_image_list_frames.csv and save the list as object_image_list_angles.csv."""
+    # Load object_measurement data
+    all_data = load_object_measurements(base_directory)
+
+    # Read the object_image_list CSV file into a DataFrame
+    object_image_list = pd.read_csv(os.path.join(base_directory, "object_image_list_frames.csv"))
+
+    # Add angles and coordinates as new columns to object_image_list
+    object_image_list = compute_swim_angles(object_image_list, all_data)
+
+    # Save the updated DataFrame as a new CSV file
+    object_image_list.to_csv(os.path.join(base_directory, "object_image_list_angles.csv"), index=False)
+    return object_image_list
+
+if __name__ == "__main__":
+    # Define the base directory
+    base_directory = "./experiments"
+
+    add_swim_angles(base_directory)
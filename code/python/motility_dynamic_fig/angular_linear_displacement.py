@@ -4,9 +4,15 @@ import csv
 import re
 import math
 import sys
+import logging
 from itertools import groupby
 from operator import itemgetter
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented, setup_logging, stage
+
+logger = logging.getLogger(__name__)
+
 # Summary:
 # This script processes images, identifies contours, and computes both angular and linear displacements
 # between contours in consecutive frames. The results are saved to a CSV file.
@@ -84,7 +90,7 @@ def compute_angle_between_three_frames(previous_frame_path, current_frame_path,
     centroid_next = find_closest_contour_to_point(next_frame_path, centroid_curr)
 
     if not all([centroid_prev, centroid_curr, centroid_next]):
-        print("Missing centroids for one of the frames.")
+        logger.info("Missing centroids for one of the frames.")
         return None, None
 
     # Compute vectors between centroids
@@ -97,7 +103,7 @@ def compute_angle_between_three_frames(previous_frame_path, current_frame_path,
 
     # If vectors are zero, return None
     if magnitude_AB == 0 or magnitude_BC == 0:
-        print("Zero vector magnitude detected.")
+        logger.info("Zero vector magnitude detected.")
         return None, None
 
     # Compute the dot product of vectors
@@ -106,7 +112,7 @@ def compute_angle_between_three_frames(previous_frame_path, current_frame_path,
     cos_theta = max(-1.0, min(1.0, cos_theta))
 
     angle = math.degrees(math.acos(cos_theta))
-    print(f"Computed angle: {angle}")
+    logger.info(f"Computed angle: {angle}")
     return angle
 
 def compute_linear_displacement_between_two_frames(current_frame_path, next_frame_path):
@@ -124,34 +130,35 @@ def compute_linear_displacement_between_two_frames(current_frame_path, next_fram
 
     return linear_displacement
 
+@instrumented('angular_linear_displacement')
 def main():
     """
     Entry point of the script.
     """
     csv_file_path = "experiments/centroids_displacements.csv"
 
-    # Redirect all print statements to a log file for tracking
-    original_stdout = sys.stdout
-    with open('log.txt', 'a') as f:
-        sys.stdout = f
-        print("Starting to process images...")
+    # Log all messages to log.txt, and only warnings and errors to the console
+    setup_logging('log.txt', console_level=logging.WARNING)
 
-        with open(csv_file_path, 'w', newline='') as csvfile:
-            csv_writer = csv.writer(csvfile)
+    logger.info("Starting to process images...")
 
-            # Add a new column for 'linear_displacement'
-            csv_writer.writerow(['experiment', 'species', 'pool_ID', 'seq_number', 'file_name', 'seq_frame', 'centroid_x', 'centroid_y', 'file_path', 'angular_displacement', 'linear_displacement'])
+    with open(csv_file_path, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
 
-            # Walk through all directories and files under the 'experiments' directory
-            for root, _, files in os.walk('./experiments/'):
-                # Split the directory path into its individual parts
-                path_parts = root.split(os.sep)
+        # Add a new column for 'linear_displacement'
+        csv_writer.writerow(['experiment', 'species', 'pool_ID', 'seq_number', 'file_name', 'seq_frame', 'centroid_x', 'centroid_y', 'file_path', 'angular_displacement', 'linear_displacement'])
 
-                # Check if the current directory is the 'final_transformed_images' sub-directory and has the expected structure
-                if len(path_parts) == 6 and path_parts[3] == 'final_transformed_images':
-                    _, _, experiment, _, species, pool_ID = path_parts
-                    print(f"Processing images in directory: {root}")
+        # Walk through all directories and files under the 'experiments' directory
+        for root, _, files in os.walk('./experiments/'):
+            # Split the directory path into its individual parts
+            path_parts = root.split(os.sep)
 
+            # Check if the current directory is the 'final_transformed_images' sub-directory and has the expected structure
+            if len(path_parts) == 6 and path_parts[3] == 'final_transformed_images':
+                _, _, experiment, _, species, pool_ID = path_parts
+                logger.info(f"Processing images in directory: {root}")
+
+                with stage('angular_linear_displacement.directory', file=root, items=len(files)):
                     # List to store data extracted from filenames
                     files_data = []
                     for file_name in files:
@@ -169,7 +176,7 @@ def main():
 
                         for index, data in enumerate(group_list):
                             experiment, species, pool_ID, seq_number, file_name, seq_frame, file_path = data
-                            print(f"  Processing file: {file_name}")
+                            logger.info(f"  Processing file: {file_name}")
 
                             angle, linear_disp = None, None
 
@@ -191,10 +198,7 @@ def main():
                             if centroid:
                                 csv_writer.writerow([experiment, species, pool_ID, seq_number, file_name, seq_frame, centroid[0], centroid[1], file_path, angle, linear_disp])
 
-            print("Processing complete.")
-
-        # Return standard output back to its original value
-        sys.stdout = original_stdout
+        logger.info("Processing complete.")
 
 if __name__ == "__main__":
     main()
@@ -18,6 +18,11 @@ Entry Point:
 
 import csv
 import numpy as np
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import stage
 
 def read_csv(file_path):
     """
@@ -51,33 +56,46 @@ def determine_bin_category(value, bins):
             return i + 1
     return len(bins) - 1
 
-# Entry point of the script
-if __name__ == "__main__":
-    # Define input and output paths
-    input_path = "experiments/sampled_unbinned_data.csv"
-    output_path = "experiments/sampled_binned_data.csv"
-
-    # Read data from input CSV
-    data = read_csv(input_path)
+def bin_sampled_data(input_path, output_path, n_bins=18):
+    """
+    Assign every row a bin of its 'avg_displacement', out of n_bins equal bins, and save the rows with their bin.
 
-    # Extract all 'avg_displacement' values and convert them to float
-    avg_displacements = [float(row['avg_displacement']) for row in data]
+    Args:
+        input_path (str): Path to the input CSV file.
+        output_path (str): Path to the output CSV file.
+        n_bins (int): Number of bins between the smallest and largest average displacement.
+    """
+    with stage('bin_sampled_data', file=input_path) as record:
+        # Read data from input CSV
+        data = read_csv(input_path)
 
-    # Determine the bin edges for 18 bins
-    bin_edges = np.linspace(min(avg_displacements), max(avg_displacements), 19)
+        # Extract all 'avg_displacement' values and convert them to float
+        avg_displacements = [float(row['avg_displacement']) for row in data]
 
-    # Assign each row a bin number based on its 'avg_displacement' value
-    for row in data:
-        value = float(row['avg_displacement'])
-        bin_number = determine_bin_category(value, bin_edges)
-        row['bin'] = bin_number
+        # Determine the bin edges of n_bins equal bins
+        bin_edges = np.linspace(min(avg_displacements), max(avg_displacements), n_bins + 1)
 
-    # Write the binned data to a new CSV file
-    with open(output_path, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=data[0].keys())
-        writer.writeheader()
+        # Assign each row a bin number based on its 'avg_displacement' value
         for row in data:
-            writer.writerow(row)
+            value = float(row['avg_displacement'])
+            bin_number = determine_bin_category(value, bin_edges)
+            row['bin'] = bin_number
+
+        # Write the binned data to a new CSV file
+        with open(output_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=data[0].keys())
+            writer.writeheader()
+            for row in data:
+                writer.writerow(row)
+
+        # Print the path to the saved binned data
+        print(f"Binned data saved to {output_path}")
+        record['items'] = len(data)
+
+# Entry point of the script
+if __name__ == "__main__":
+    # Define input and output paths
+    input_path = "experiments/sampled_unbinned_data.csv"
+    output_path = "experiments/sampled_binned_data.csv"
 
-    # Print the path to the saved binned data
-    print(f"Binned data saved to {output_path}")
+    bin_sampled_data(input_path, output_path)
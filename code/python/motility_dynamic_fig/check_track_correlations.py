@@ -0,0 +1,104 @@
+"""
+The script checks track_correlations.py against plain per-track loops on
+synthetic tracks. The tracks have random lengths, some shorter than the
+lags asked for and all shorter than the largest lags (the default lags of
+track_correlations.py reach 100 frames), and missing values. The pooled
+autocorrelations of every species and the joint histograms of every
+species and lag must agree with the loops; the script exits with an error
+if they do not.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from track_correlations import joint_histograms, track_autocorrelation
+
+def synthetic_tracks(n_tracks=200, max_length=60, missing=0.05, seed=0):
+    """One row per frame of n_tracks tracks of 1 to max_length frames, in shuffled order."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, max_length + 1, n_tracks)
+    cell = np.repeat(np.arange(n_tracks), lengths)
+    df = pd.DataFrame({'cell': cell, 'species': np.where(cell % 2, 'cr', 'cs'),
+                       'frame': np.concatenate([np.arange(length) for length in lengths]),
+                       'velocity': rng.gamma(4, 15, len(cell)),
+                       'angular_velocity': rng.gamma(2, 40, len(cell))})
+    for column in ('velocity', 'angular_velocity'):
+        df.loc[rng.random(len(df)) < missing, column] = np.nan
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+def loop_autocorrelation(df, column, max_lag):
+    """Pooled autocorrelation per species, centred on the species mean, from a loop over tracks and lags."""
+    result = {}
+    for species, tracks in df.groupby('species'):
+        mean = tracks[column].mean()
+        products = np.zeros(max_lag + 1)
+        for _, track in tracks.groupby('cell'):
+            values = track.sort_values('frame')[column].to_numpy() - mean
+            for lag in range(min(max_lag, len(values) - 1) + 1):
+                products[lag] += np.nansum(values[:len(values) - lag] * values[lag:])
+        result[species] = products / products[0]
+    return result
+
+def loop_joint_histograms(df, lags, bins, lims):
+    """Joint histograms per species and lag from a loop over tracks and lags."""
+    x_edges = np.linspace(lims[0], lims[1], bins[0] + 1)
+    y_edges = np.linspace(lims[2], lims[3], bins[1] + 1)
+    result = {}
+    for species, tracks in df.groupby('species'):
+        counts = np.zeros((len(lags), bins[0], bins[1]), dtype=int)
+        for _, track in tracks.groupby('cell'):
+            track = track.sort_values('frame')
+            x, y = track['velocity'].to_numpy(), track['angular_velocity'].to_numpy()
+            for lag_index, lag in enumerate(lags):
+                if lag >= len(x):
+                    continue
+                first, second = x[:len(x) - lag], y[lag:]
+                present = ~np.isnan(first) & ~np.isnan(second)
+                counts[lag_index] += np.histogram2d(first[present], second[present],
+                                                    bins=[x_edges, y_edges])[0].astype(int)
+        result[species] = counts
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Check track_correlations.py against per-track loops.')
+    parser.add_argument('--tracks', type=int, default=200, help='Number of synthetic tracks.')
+    parser.add_argument('--max-length', type=int, default=60, help='Frames of the longest track.')
+    parser.add_argument('--max-lag', type=int, default=100, help='Largest lag of the autocorrelations.')
+    parser.add_argument('--lags', type=int, nargs='+', default=[0, 10, 20, 50, 100, 500],
+                        help='Lags of the joint histograms.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    df = synthetic_tracks(args.tracks, args.max_length, seed=args.seed)
+    bins, lims = (70, 100), (0, 140, 0, 200)
+    failures = []
+
+    correlations = track_autocorrelation(df, ['velocity'], ['cell'], 'frame', ['species'], args.max_lag)
+    pooled = correlations['pooled']
+    for species, expected in loop_autocorrelation(df, 'velocity', args.max_lag).items():
+        computed = pooled.loc[pooled['species'] == species, 'acf'].to_numpy()
+        if not np.allclose(computed, expected, atol=1e-9, equal_nan=True):
+            failures.append(f"autocorrelation of {species}")
+
+    histograms = joint_histograms(df, 'velocity', 'angular_velocity', args.lags, ['cell'], 'frame', ['species'],
+                                  bins, lims)
+    expected = loop_joint_histograms(df, args.lags, bins, lims)
+    for group_index, species in enumerate(histograms['groups']['species']):
+        for lag_index, lag in enumerate(args.lags):
+            if not np.array_equal(histograms['counts'][group_index, lag_index], expected[species][lag_index]):
+                failures.append(f"joint histogram of {species} at lag {lag}")
+
+    print(f"{args.tracks} tracks of up to {args.max_length} frames, autocorrelations to lag {args.max_lag}, "
+          f"joint histograms at lags {', '.join(map(str, args.lags))}")
+    if failures:
+        print("Differences from the per-track loops: " + "; ".join(failures))
+        sys.exit(1)
+    print("Autocorrelations and joint histograms agree with the per-track loops.")
+
+if __name__ == "__main__":
+    main()
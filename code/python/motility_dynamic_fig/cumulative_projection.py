@@ -0,0 +1,185 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tifffile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented, stage
+
+# Summary:
+# This script computes cumulative projections, also known as tracks, of every movie in a directory, in Python
+# instead of with the Fiji macro batch_sequential_avg_projection.ijm. For each frame f = 2 .. frames it writes the
+# projection of frames 1 .. f as "<movie>_std_f<f>.tif", with the display range that "Enhance Contrast"
+# (saturated=0.35) sets, like the macro does. Each movie is read once, frame by frame from a memory map, and the
+# running projection is updated in float32 accumulators: a running sum for the average projection, which gives the
+# same values as ImageJ's "Average Intensity" projection, and Welford updates of the mean and sum of squared
+# deviations for the standard deviation projection. Movies are processed in parallel in a process pool.
+
+def iter_frames(movie_path):
+    """
+    Yield the frames of a movie one at a time.
+
+    Input:
+    - movie_path (str): Path to a (multi-page) TIFF movie.
+    Output:
+    - frames (2D numpy arrays), memory-mapped when the file is stored contiguously.
+    """
+    with tifffile.TiffFile(movie_path) as tif:
+        series = tif.series[0]
+        if series.dataoffset is not None:
+            stack = np.memmap(movie_path, dtype=np.dtype(tif.byteorder + series.dtype.char), mode='r',
+                              offset=series.dataoffset, shape=series.shape)
+            for frame in stack.reshape((-1,) + stack.shape[-2:]):
+                yield frame
+        else:
+            for page in tif.pages:
+                yield page.asarray()
+
+def enhance_contrast_range(image, saturated=0.35):
+    """
+    Display range that ImageJ's "Enhance Contrast" sets on a 32-bit image, without normalizing the pixels.
+
+    Input:
+    - image (2D numpy array): Projection image.
+    - saturated (float): Percentage of pixels allowed to saturate, split over both ends of the histogram.
+    Output:
+    - (min, max) display range.
+    """
+    values = image.astype(np.float64).ravel()
+    hist_min, hist_max = values.min(), values.max()
+    if hist_max == hist_min:
+        return float(hist_min), float(hist_max)
+
+    # 256-bin histogram from the image minimum to maximum, binned the way ImageJ's FloatStatistics bins it
+    n_bins = 256
+    bin_size = (hist_max - hist_min) / n_bins
+    indices = np.minimum(((n_bins / (hist_max - hist_min)) * (values - hist_min)).astype(np.int64), n_bins - 1)
+    histogram = np.bincount(indices, minlength=n_bins)
+
+    threshold = int(values.size * saturated / 200.0)
+    cumulative = np.cumsum(histogram)
+    hmin = min(int(np.argmax(cumulative > threshold)), n_bins - 1)
+    reverse_cumulative = np.cumsum(histogram[::-1])
+    hmax = max(n_bins - 1 - int(np.argmax(reverse_cumulative > threshold)), 0)
+
+    if hmax < hmin:
+        return float(hist_min), float(hist_max)
+    low, high = hist_min + hmin * bin_size, hist_min + hmax * bin_size
+    if low == high:
+        return float(hist_min), float(hist_max)
+    return float(low), float(high)
+
+def cumulative_projections(movie_path, projection="mean"):
+    """
+    Yield the cumulative projections of a movie in a single pass over its frames.
+
+    Input:
+    - movie_path (str): Path to the movie.
+    - projection (str): "mean" for ImageJ's "Average Intensity" projection, "std" for "Standard Deviation".
+    Output:
+    - (f, image) for f = 2 .. frames, where image (float32) is the projection of frames 1 .. f.
+    """
+    total = None
+    mean = None
+    squared_deviations = None
+    for index, frame in enumerate(iter_frames(movie_path)):
+        f = index + 1
+        values = frame.astype(np.float32)
+        if projection == "mean":
+            # Running float32 sum divided by the frame count, as ImageJ's Average Intensity projection computes it
+            if total is None:
+                total = np.zeros(frame.shape, dtype=np.float32)
+            total += values
+            image = total / np.float32(f)
+        else:
+            # Welford update of the running mean and sum of squared deviations
+            if mean is None:
+                mean = np.zeros(frame.shape, dtype=np.float32)
+                squared_deviations = np.zeros(frame.shape, dtype=np.float32)
+            delta = values - mean
+            mean += delta / np.float32(f)
+            squared_deviations += delta * (values - mean)
+            # ImageJ's Standard Deviation projection uses the n - 1 estimator
+            image = np.sqrt(np.maximum(squared_deviations, 0) / np.float32(max(f - 1, 1)))
+        if f >= 2:
+            yield f, image
+
+def project_movie(movie_path, output_directory, projection="mean", saturated=0.35, as_stack=False):
+    """
+    Write the cumulative projections of one movie.
+
+    Input:
+    - movie_path (str): Path to the movie.
+    - output_directory (str): Directory where the projections are saved.
+    - projection (str): "mean" or "std".
+    - saturated (float): Saturation of the display range, as in "Enhance Contrast".
+    - as_stack (bool): Write all projections of the movie into one ImageJ stack "<movie>_std.tif" instead of a
+      file per frame.
+    Output:
+    - number of projections written.
+    """
+    print("Processing: " + movie_path)
+    base_name = os.path.basename(movie_path)
+    base_name = base_name[:base_name.index(".tif")] if ".tif" in base_name else os.path.splitext(base_name)[0]
+
+    with stage('cumulative_projection.movie', file=movie_path) as record:
+        if as_stack:
+            with tifffile.TiffWriter(os.path.join(output_directory, f"{base_name}_std.tif"), imagej=True) as tif:
+                for f, image in cumulative_projections(movie_path, projection):
+                    tif.write(image, contiguous=True)
+                    record['items'] += 1
+        else:
+            for f, image in cumulative_projections(movie_path, projection):
+                display_min, display_max = enhance_contrast_range(image, saturated)
+                tifffile.imwrite(os.path.join(output_directory, f"{base_name}_std_f{f}.tif"), image, imagej=True,
+                                 metadata={'min': display_min, 'max': display_max})
+                record['items'] += 1
+    return record['items']
+
+def _project_movie_job(job):
+    return project_movie(*job)
+
+def project_directory(input_directory, output_directory, suffix=".tif", projection="mean", saturated=0.35,
+                      as_stack=False, workers=None):
+    """
+    Write the cumulative projections of every movie in a directory, one movie per worker process.
+
+    Input:
+    - input_directory (str): Directory with the movies.
+    - output_directory (str): Directory where the projections are saved.
+    - suffix (str): Only files ending with this suffix are processed.
+    Output:
+    - total number of projections written.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    movies = sorted(name for name in os.listdir(input_directory) if name.endswith(suffix))
+    jobs = [(os.path.join(input_directory, name), output_directory, projection, saturated, as_stack)
+            for name in movies]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(_project_movie_job, jobs))
+
+@instrumented('cumulative_projection')
+def main():
+    """
+    Entry point of the script. Parses the arguments and projects every movie in the input directory.
+    """
+    parser = argparse.ArgumentParser(description='Cumulative average or standard deviation projections of movies.')
+    parser.add_argument('input', help='Input directory with the movies.')
+    parser.add_argument('output', help='Output directory for the projections.')
+    parser.add_argument('--suffix', default='.tif', help='File suffix of the movies.')
+    parser.add_argument('--projection', choices=['mean', 'std'], default='mean',
+                        help='"mean" matches batch_sequential_avg_projection.ijm; "std" projects the standard deviation.')
+    parser.add_argument('--saturated', type=float, default=0.35, help='Saturated pixels (%%) of the display range.')
+    parser.add_argument('--stack', action='store_true', help='Write one stack of projections per movie.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes.')
+    args = parser.parse_args()
+
+    n_written = project_directory(args.input, args.output, args.suffix, args.projection, args.saturated,
+                                  args.stack, args.workers)
+    print(f"Saved {n_written} projections to {args.output}")
+
+# If this script is run directly, the main function is called
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+import argparse
+import os
+import sys
+import itertools
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented
+
+# Summary:
+# This script computes probability density maps of motility measurements, e.g. velocity against angular velocity,
+# like MASS::kde2d in plot_velocity_prob_density_function of code/R/chlamy_motility_utils.R, and the differences
+# between the maps of two species like plot_diff_prob_density_function. Instead of summing a Gaussian for every
+# sample at every grid point, the samples are linearly binned on the grid, extended by the reach of the kernel, and
+# the bin counts are convolved with the Gaussian kernel by FFT. The cost then depends on the grid size and not on
+# the number of samples times the grid size, and new samples (e.g. new wells) can be added to the bin counts at any
+# time. Bootstrap envelopes resample the samples (or whole tracks) a batch of resamples at a time: every batch is
+# binned with one bincount and convolved with one FFT.
+# A grid is a dict with its axes, bandwidths and bin counts; it works for one or two dimensions, so a 1D density
+# of e.g. the angular velocity bins can be drawn over the histogram of plot_histogram_vector_images.py.
+
+DEFAULT_LIMS = (0, 140, 0, 200)
+
+_kernel_cache = {}
+
+def bandwidth_nrd(x):
+    """
+    Bandwidth of a Gaussian kernel by the normal reference rule, as MASS::bandwidth.nrd computes it
+    (4 times the standard deviation of the kernel).
+    """
+    x = np.asarray(x, dtype=float)
+    quartiles = np.percentile(x, [25, 75])
+    return 4 * 1.06 * min(np.std(x, ddof=1), (quartiles[1] - quartiles[0]) / 1.34) * len(x) ** (-1 / 5)
+
+def density_grid(h, lims=DEFAULT_LIMS, n=300):
+    """
+    Create an empty grid to add samples to.
+
+    Input:
+    - h (float or sequence): Bandwidth per dimension, in the units of MASS::kde2d (4 times the kernel standard
+      deviation). It has to be fixed before samples are added, e.g. with bandwidth_nrd on a reference sample.
+    - lims (sequence): (low, high) of every dimension, flattened, e.g. (0, 140, 0, 200) as in the R notebooks.
+    - n (int or sequence): Grid points per dimension.
+    Output:
+    - grid (dict).
+    """
+    dimensions = len(lims) // 2
+    h = np.broadcast_to(np.asarray(h, dtype=float), (dimensions,)).copy()
+    sizes = np.broadcast_to(np.asarray(n, dtype=int), (dimensions,)).copy()
+    axes = [np.linspace(lims[2 * k], lims[2 * k + 1], sizes[k]) for k in range(dimensions)]
+    steps = np.array([(lims[2 * k + 1] - lims[2 * k]) / (sizes[k] - 1) for k in range(dimensions)])
+    # The grid is extended by 4 kernel standard deviations (h) so samples just outside the limits still count
+    pads = np.ceil(h / steps).astype(int)
+    return {'lims': tuple(lims), 'axes': axes, 'h': h, 'steps': steps, 'pads': pads,
+            'counts': np.zeros(tuple(sizes + 2 * pads)), 'n': 0}
+
+def _linear_bins(grid, samples):
+    """Flat indices and weights of the 2^d extended grid points around every sample, and which samples were binned."""
+    samples = np.atleast_2d(np.asarray(samples, dtype=float).T).T
+    shape = grid['counts'].shape
+    indices, fractions = [], []
+    inside = np.ones(len(samples), dtype=bool)
+    for k in range(samples.shape[1]):
+        position = (samples[:, k] - grid['lims'][2 * k]) / grid['steps'][k] + grid['pads'][k]
+        inside &= (position >= 0) & (position <= shape[k] - 1)
+        index = np.clip(np.floor(position), 0, shape[k] - 2).astype(np.int64)
+        indices.append(index)
+        fractions.append(position - index)
+
+    flat = np.empty((len(samples), 2 ** len(shape)), dtype=np.int64)
+    weights = np.empty(flat.shape)
+    for corner, offsets in enumerate(itertools.product((0, 1), repeat=len(shape))):
+        corner_index = tuple(index + offset for index, offset in zip(indices, offsets))
+        flat[:, corner] = np.ravel_multi_index(corner_index, shape, mode='clip')
+        weights[:, corner] = np.prod([fraction if offset else 1 - fraction
+                                      for fraction, offset in zip(fractions, offsets)], axis=0)
+    return flat[inside], weights[inside], inside
+
+def add_samples(grid, *coordinates, weights=None):
+    """
+    Add samples to the bin counts of a grid, e.g. the frames of a new well, and return the grid.
+    Samples outside the extended grid are counted in the normalization but not binned, where their
+    kernels are negligible, as they would be at the grid points in kde2d.
+    """
+    samples = np.column_stack([np.asarray(c, dtype=float).ravel() for c in coordinates])
+    samples = samples[~np.isnan(samples).any(axis=1)]
+    flat, corner_weights, inside = _linear_bins(grid, samples)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[inside]
+        corner_weights = corner_weights * weights[:, None]
+    grid['counts'] += np.bincount(flat.ravel(), corner_weights.ravel(),
+                                  minlength=grid['counts'].size).reshape(grid['counts'].shape)
+    grid['n'] += len(samples)
+    return grid
+
+def _kernel_fft(grid):
+    """FFT of the Gaussian kernel over every offset of the extended grid, cached per grid shape and bandwidth."""
+    shape = grid['counts'].shape
+    key = (shape, tuple(grid['h']), tuple(grid['steps']))
+    if key not in _kernel_cache:
+        fft_shape = tuple(2 * size for size in shape)
+        kernel = np.ones(fft_shape)
+        for k, size in enumerate(shape):
+            # Offsets 0 .. size - 1 then -(size - 1) .. -1, so the circular convolution does not wrap around
+            offsets = np.fft.ifftshift(np.arange(-size, size)) * grid['steps'][k]
+            sd = grid['h'][k] / 4
+            profile = np.exp(-0.5 * (offsets / sd) ** 2) / (np.sqrt(2 * np.pi) * sd)
+            kernel = kernel * profile.reshape([-1 if axis == k else 1 for axis in range(len(shape))])
+        _kernel_cache[key] = np.fft.rfftn(kernel)
+    return _kernel_cache[key]
+
+def _convolve(grid, counts):
+    """Convolve bin counts (..., extended grid) with the kernel and crop them to the grid."""
+    dimensions = len(grid['axes'])
+    axes = tuple(range(-dimensions, 0))
+    fft_shape = tuple(2 * size for size in grid['counts'].shape)
+    smoothed = np.fft.irfftn(np.fft.rfftn(counts, fft_shape, axes=axes) * _kernel_fft(grid), fft_shape, axes=axes)
+    crop = tuple(slice(pad, pad + len(axis)) for pad, axis in zip(grid['pads'], grid['axes']))
+    # FFT round-off can leave tiny negative values where the density is zero
+    return np.maximum(smoothed[(Ellipsis,) + crop], 0)
+
+def evaluate(grid):
+    """Density of the samples added so far at the grid points, like the z of MASS::kde2d."""
+    return _convolve(grid, grid['counts']) / max(grid['n'], 1)
+
+def kde2d(x, y, h=None, n=300, lims=None):
+    """
+    Binned FFT version of MASS::kde2d.
+
+    Output:
+    - dict with x, y (grid axes) and z (density, x along rows).
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if h is None:
+        h = (bandwidth_nrd(x), bandwidth_nrd(y))
+    if lims is None:
+        lims = (x.min(), x.max(), y.min(), y.max())
+    grid = add_samples(density_grid(h, lims, n), x, y)
+    return {'x': grid['axes'][0], 'y': grid['axes'][1], 'z': evaluate(grid)}
+
+def normalize(z, method="max", dimensions=None):
+    """
+    Scale a density map to a maximum of 1 ("max", as in the R difference plots) or leave it ("pdf").
+    For a batch of maps (..., grid), dimensions is the number of grid dimensions.
+    """
+    if method == "pdf":
+        return z
+    if method == "max":
+        axes = tuple(range(z.ndim - (dimensions or z.ndim), z.ndim))
+        return z / np.maximum(z.max(axis=axes, keepdims=True), np.finfo(float).tiny)
+    raise ValueError(f"method must be 'max' or 'pdf', not {method!r}")
+
+def difference_map(z_1, z_2, method="max", decimals=None):
+    """Difference of two density maps, each normalized first, like plot_diff_prob_density_function."""
+    difference = normalize(z_1, method) - normalize(z_2, method)
+    return difference if decimals is None else np.round(difference, decimals)
+
+def species_densities(df, x='velocity', y='angular_velocity', by='species', h=None, lims=DEFAULT_LIMS, n=300):
+    """
+    Density map of every species (or other group) of a table, e.g. the tracks of motility_tracks.py.
+    Rows with missing values are dropped, as na.omit does in the notebooks. Without h, every group gets
+    its own bandwidth_nrd bandwidths, as kde2d picks them.
+
+    Output:
+    - dict of group -> dict with x, y and z.
+    """
+    df = df[[by, x, y]].dropna()
+    return {group: kde2d(values[x], values[y], h, n, lims) for group, values in df.groupby(by)}
+
+def _bootstrap_maps(grid, samples, n_resamples, groups, method, seed, batch_size):
+    """Yield batches of normalized density maps of bootstrap resamples of the samples (or of whole groups)."""
+    flat, corner_weights, inside = _linear_bins(grid, samples)
+    n = len(samples)
+    rng = np.random.default_rng(seed)
+    if groups is not None:
+        _, codes = np.unique(np.asarray(groups), return_inverse=True)
+        n_units = codes.max() + 1
+    else:
+        codes, n_units = None, n
+    sample_index = np.flatnonzero(inside)
+    size = grid['counts'].size
+    # Batches are limited by the binned samples and by the FFTs of the maps held at once
+    fft_size = int(np.prod([2 * size for size in grid['counts'].shape]))
+    batch_size = batch_size or max(1, min(5_000_000 // max(flat.size, 1), 20_000_000 // fft_size))
+
+    for start in range(0, n_resamples, batch_size):
+        stop = min(start + batch_size, n_resamples)
+        batch = stop - start
+        # How often every sample (or group) is drawn in every resample of the batch
+        draws = rng.integers(0, n_units, size=(batch, n_units)) + n_units * np.arange(batch)[:, None]
+        drawn = np.bincount(draws.ravel(), minlength=batch * n_units).reshape(batch, n_units)
+        if codes is not None:
+            drawn = drawn[:, codes]
+            totals = drawn.sum(axis=1)
+        else:
+            totals = np.full(batch, n)
+        drawn = drawn[:, sample_index].astype(float)
+
+        # One bincount bins every resample of the batch into its own slice of the counts
+        batch_flat = flat[None, :, :] + size * np.arange(batch)[:, None, None]
+        batch_weights = corner_weights[None, :, :] * drawn[:, :, None]
+        counts = np.bincount(batch_flat.ravel(), batch_weights.ravel(), minlength=batch * size)
+        counts = counts.reshape((batch,) + grid['counts'].shape)
+        maps = _convolve(grid, counts) / np.maximum(totals, 1).reshape((batch,) + (1,) * len(grid['axes']))
+        yield normalize(maps, method, len(grid['axes'])).astype(np.float32)
+
+def bootstrap_envelope(x, y, h=None, lims=DEFAULT_LIMS, n=300, n_resamples=200, ci=0.95, groups=None,
+                       method="max", seed=0, batch_size=None):
+    """
+    Pointwise bootstrap envelope of a density map.
+
+    Input:
+    - groups (array): Optional group (e.g. track) of every sample. Whole groups are resampled, which keeps the
+      correlation between the frames of a track.
+    - method (str): Normalization of the resampled maps, "max" or "pdf".
+    Output:
+    - dict with x, y, z (density of the sample, normalized), low and high (envelope).
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    keep = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[keep], y[keep]
+    groups = None if groups is None else np.asarray(groups)[keep]
+    if h is None:
+        h = (bandwidth_nrd(x), bandwidth_nrd(y))
+    grid = add_samples(density_grid(h, lims, n), x, y)
+    maps = np.concatenate(list(_bootstrap_maps(grid, np.column_stack([x, y]), n_resamples, groups, method, seed,
+                                               batch_size)))
+    low, high = np.percentile(maps, [100 * (1 - ci) / 2, 100 * (1 + ci) / 2], axis=0)
+    return {'x': grid['axes'][0], 'y': grid['axes'][1], 'z': normalize(evaluate(grid), method),
+            'low': low, 'high': high}
+
+def bootstrap_difference_envelope(sample_1, sample_2, h=None, lims=DEFAULT_LIMS, n=300, n_resamples=200, ci=0.95,
+                                  groups=(None, None), method="max", seed=0, batch_size=None):
+    """
+    Pointwise bootstrap envelope of the difference between the density maps of two samples, e.g. two species.
+    sample_1 and sample_2 are (x, y) pairs; both are resampled independently in every resample.
+
+    Output:
+    - dict with x, y, z (difference of the samples), low and high (envelope).
+    """
+    samples = []
+    for x, y in (sample_1, sample_2):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        samples.append(np.column_stack([x, y]))
+    keeps = [~np.isnan(sample).any(axis=1) for sample in samples]
+    samples = [sample[keep] for sample, keep in zip(samples, keeps)]
+    groups = [None if group is None else np.asarray(group)[keep] for group, keep in zip(groups, keeps)]
+    hs = [h if h is not None else (bandwidth_nrd(sample[:, 0]), bandwidth_nrd(sample[:, 1])) for sample in samples]
+    grids = [add_samples(density_grid(grid_h, lims, n), sample[:, 0], sample[:, 1])
+             for grid_h, sample in zip(hs, samples)]
+
+    # Both samples are resampled in batches of the same size, so their maps can be subtracted batch by batch
+    fft_size = int(np.prod([2 * size for size in grids[0]['counts'].shape]))
+    batch_size = batch_size or max(1, min(5_000_000 // (4 * max(len(samples[0]), len(samples[1]), 1)),
+                                          20_000_000 // fft_size))
+    differences = [maps_1 - maps_2 for maps_1, maps_2 in zip(
+        _bootstrap_maps(grids[0], samples[0], n_resamples, groups[0], method, seed, batch_size),
+        _bootstrap_maps(grids[1], samples[1], n_resamples, groups[1], method, seed + 1, batch_size))]
+    low, high = np.percentile(np.concatenate(differences), [100 * (1 - ci) / 2, 100 * (1 + ci) / 2], axis=0)
+    return {'x': grids[0]['axes'][0], 'y': grids[0]['axes'][1],
+            'z': difference_map(evaluate(grids[0]), evaluate(grids[1]), method), 'low': low, 'high': high}
+
+def density_table(maps):
+    """
+    Long table of density maps, one row per group and grid point, for the notebooks.
+
+    Input:
+    - maps (dict): group -> dict with x, y, z and optionally low and high.
+    Output:
+    - DataFrame with the columns group, x, y, z (and low, high).
+    """
+    tables = []
+    for group, density in maps.items():
+        x, y = np.meshgrid(density['x'], density['y'], indexing='ij')
+        table = {'group': group, 'x': x.ravel(), 'y': y.ravel(), 'z': density['z'].ravel()}
+        for column in ('low', 'high'):
+            if column in density:
+                table[column] = density[column].ravel()
+        tables.append(pd.DataFrame(table))
+    return pd.concat(tables, ignore_index=True)
+
+@instrumented('density_maps')
+def main():
+    """
+    Entry point of the script. Computes the density map of every species in a track table and the difference
+    between two species, and saves them as long tables.
+    """
+    parser = argparse.ArgumentParser(description='Density maps of velocity against angular velocity per species.')
+    parser.add_argument('tracks', help='Track table written by motility_tracks.py (.csv or .parquet).')
+    parser.add_argument('output', help='Output CSV of the density maps.')
+    parser.add_argument('--x', default='velocity', help='Column on the first axis.')
+    parser.add_argument('--y', default='angular_velocity', help='Column on the second axis.')
+    parser.add_argument('--lims', type=float, nargs=4, default=DEFAULT_LIMS, help='Limits of both axes.')
+    parser.add_argument('--n', type=int, default=300, help='Grid points per axis.')
+    parser.add_argument('--difference', nargs=2, default=None, metavar=('SPECIES_1', 'SPECIES_2'),
+                        help='Also save the max-normalized difference of two species, with a bootstrap envelope.')
+    parser.add_argument('--resamples', type=int, default=200, help='Bootstrap resamples of the difference.')
+    args = parser.parse_args()
+
+    tracks = pd.read_parquet(args.tracks) if args.tracks.endswith('.parquet') else pd.read_csv(args.tracks)
+    maps = species_densities(tracks, args.x, args.y, lims=args.lims, n=args.n)
+    if args.difference:
+        samples = []
+        groups = []
+        for species in args.difference:
+            rows = tracks[tracks['species'] == species]
+            samples.append((rows[args.x], rows[args.y]))
+            groups.append(rows['cell'] if 'cell' in rows else None)
+        # Whole tracks are resampled, as the frames of a track are correlated
+        maps['-'.join(args.difference)] = bootstrap_difference_envelope(
+            samples[0], samples[1], lims=args.lims, n=args.n, n_resamples=args.resamples, groups=tuple(groups))
+    density_table(maps).to_csv(args.output, index=False)
+    print(f"Saved {len(maps)} density maps to {args.output}")
+
+# If this script is run directly, the main function is called
+if __name__ == "__main__":
+    main()
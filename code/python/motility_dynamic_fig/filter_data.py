@@ -15,6 +15,11 @@ Entry Point:
 """
 
 import csv
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import stage
 
 def filter_csv_by_seq_frame(input_csv_path, output_csv_path):
     """
@@ -52,5 +57,6 @@ if __name__ == "__main__":
     input_path = 'experiments/mean_angular_displacements_allowed.csv'
     output_path = 'experiments/filtered_unbinned_data.csv'
 
-    # Call the filter function with the defined paths
-    filter_csv_by_seq_frame(input_path, output_path)
+    with stage('filter_data', file=input_path):
+        # Call the filter function with the defined paths
+        filter_csv_by_seq_frame(input_path, output_path)
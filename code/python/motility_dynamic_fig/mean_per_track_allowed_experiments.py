@@ -1,6 +1,11 @@
 import csv
 from itertools import groupby
 import numpy as np
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import stage
 
 # SUMMARY:
 # This script processes data from a CSV file containing angular displacements from experiments.
@@ -68,6 +73,35 @@ def write_to_csv(data, file_path):
         for row in data:
             writer.writerow(row)
 
+def mean_per_track(csv_path, output_path, allowed_experiments):
+    """
+    Add the mean absolute angular displacement of every track to the rows of the allowed experiments.
+
+    Parameters:
+        - csv_path (str): Path of the centroids and displacements CSV file.
+        - output_path (str): Path where the filtered rows with their average displacements are saved.
+        - allowed_experiments (list): Names of the experiments to keep.
+    """
+    with stage('mean_per_track_allowed_experiments', file=csv_path) as record:
+        # Read the data from the CSV file
+        data = read_csv(csv_path)
+
+        # Filter the data based on allowed experiments
+        filtered_data = filter_data_by_experiment(data, allowed_experiments)
+
+        # Calculate the average displacements for the filtered data
+        avg_displacements = calculate_mean_displacement(filtered_data)
+
+        # Add the average displacements to the filtered data
+        for row in filtered_data:
+            key = (row['experiment'], row['species'], row['pool_ID'], row['seq_number'])
+            row['avg_displacement'] = avg_displacements.get(key, 0)
+
+        # Write the processed data to a new CSV file
+        write_to_csv(filtered_data, output_path)
+        print(f"Processed data saved to {output_path}")
+        record['items'] = len(data)
+
 if __name__ == "__main__":
     # Input and output file paths
     csv_path = "experiments/centroids_displacements.csv"
@@ -76,20 +110,4 @@ if __name__ == "__main__":
     # List of experiments that are allowed
     allowed_experiments = ["exp1_230509", "exp2_230516", "exp4_230523"]
 
-    # Read the data from the CSV file
-    data = read_csv(csv_path)
-
-    # Filter the data based on allowed experiments
-    filtered_data = filter_data_by_experiment(data, allowed_experiments)
-
-    # Calculate the average displacements for the filtered data
-    avg_displacements = calculate_mean_displacement(filtered_data)
-
-    # Add the average displacements to the filtered data
-    for row in filtered_data:
-        key = (row['experiment'], row['species'], row['pool_ID'], row['seq_number'])
-        row['avg_displacement'] = avg_displacements.get(key, 0)
-
-    # Write the processed data to a new CSV file
-    write_to_csv(filtered_data, output_path)
-    print(f"Processed data saved to {output_path}")
+    mean_per_track(csv_path, output_path, allowed_experiments)
@@ -0,0 +1,184 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented
+
+# Summary:
+# This script loads the CellProfiler tracking tables of the motility movies, <directory>/<species>/<cell>/data/
+# chlamy_objchlamy.csv, into one table of tracks, like load_chlamy_motility in code/R/chlamy_motility_utils.R.
+# Every object of a movie with more than experiment_length_cutoff rows is a track. For every track the displacement
+# over a lag of 20 frames is turned into a velocity and an angle, which are smoothed with a box kernel of bandwidth
+# 10 as R's ksmooth does, and the absolute value of the smoothed angle is the angular velocity. The tracks get the
+# same cell names as in R, so the table can replace the list of data frames in the R notebooks.
+# The CSV files are read concurrently, and the lagged differences and the smoothing are computed for all tracks at
+# once on the concatenated columns, with the smoothing windows summed from cumulative sums.
+
+COLUMNS = {
+    'ImageNumber': 'image_number',
+    'ObjectNumber': 'object_number',
+    'Location_Center_X': 'x',
+    'Location_Center_Y': 'y',
+    'AreaShape_Area': 'area',
+    'AreaShape_Eccentricity': 'eccentricity',
+    'AreaShape_MeanRadius': 'radius',
+    'AreaShape_MinorAxisLength': 'minor_axis',
+    'AreaShape_MajorAxisLength': 'major_axis',
+    'AreaShape_Perimeter': 'perimeter',
+}
+
+def find_tracking_files(directory):
+    """
+    List the tracking tables of every cell (movie) of every species, in the order R's list.files gives them.
+
+    Input:
+    - directory (str): Directory with one subdirectory per species, each with one subdirectory per cell.
+    Output:
+    - list of (species, cell name, path to chlamy_objchlamy.csv).
+    """
+    files = []
+    for species in sorted(os.listdir(directory)):
+        species_directory = os.path.join(directory, species)
+        if not os.path.isdir(species_directory):
+            continue
+        for cell in sorted(os.listdir(species_directory)):
+            path = os.path.join(species_directory, cell, 'data', 'chlamy_objchlamy.csv')
+            if os.path.exists(path):
+                # Same unique ID as paste(directory, species, cell, sep = '-') in R
+                files.append((species, '-'.join([directory, species, cell]), path))
+    return files
+
+def box_smooth(values, starts, lengths, bandwidth=10):
+    """
+    Nadaraya-Watson smoother with a box kernel at every frame of every track, as R's
+    ksmooth(1:n, y, kernel = "box", bandwidth) computes it on each track separately.
+
+    Input:
+    - values (1D numpy array): Concatenated values of all tracks, NaN where missing.
+    - starts, lengths (1D numpy arrays): First row and number of rows of every track.
+    - bandwidth (float): Width of the box; frames within bandwidth / 2 of a frame are averaged.
+    Output:
+    - smoothed values (1D numpy array), NaN where the window holds a missing value.
+    """
+    half_width = int(np.floor(bandwidth / 2))
+    track_start = np.repeat(starts, lengths)
+    track_stop = track_start + np.repeat(lengths, lengths)
+    rows = np.arange(len(values))
+    low = np.maximum(rows - half_width, track_start)
+    high = np.minimum(rows + half_width + 1, track_stop)
+
+    # Window sums and counts of missing values from cumulative sums; any missing value makes the window missing
+    missing = np.isnan(values)
+    value_sums = np.concatenate([[0.0], np.cumsum(np.where(missing, 0.0, values))])
+    missing_counts = np.concatenate([[0], np.cumsum(missing)])
+    smoothed = (value_sums[high] - value_sums[low]) / (high - low)
+    smoothed[missing_counts[high] - missing_counts[low] > 0] = np.nan
+    return smoothed
+
+def lagged_displacement(tracks, starts, lengths, lag=20):
+    """
+    Displacement of every frame to the frame lag frames later in the same track, NaN for the last lag frames.
+
+    Output:
+    - dx, dy (1D numpy arrays).
+    """
+    x = tracks['x'].to_numpy(dtype=float)
+    y = tracks['y'].to_numpy(dtype=float)
+    dx = np.full(len(x), np.nan)
+    dy = np.full(len(y), np.nan)
+    position = np.arange(len(x)) - np.repeat(starts, lengths)
+    valid = np.flatnonzero(position + lag < np.repeat(lengths, lengths))
+    dx[valid] = x[valid + lag] - x[valid]
+    dy[valid] = y[valid + lag] - y[valid]
+    return dx, dy
+
+def load_motility_tracks(directory, experiment_length_cutoff=200, lag=20, bandwidth=10, workers=None):
+    """
+    Load the tracks of all cells into one table.
+
+    Input:
+    - directory (str): Directory with one subdirectory per species. As in R, it is pasted into the cell names as
+      given, so pass it the same way (e.g. with a trailing slash).
+    - experiment_length_cutoff (int): Tracks need more rows than this.
+    - lag (int): Frames over which velocity and angle are computed.
+    - bandwidth (float): Bandwidth of the box kernel smoother.
+    - workers (int): Threads reading the CSV files.
+    Output:
+    - DataFrame with the columns of the R data frames (species, cell, image_number, object_number, x, y, area,
+      eccentricity, radius, minor_axis, major_axis, perimeter, velocity, angular_velocity), one row per frame of
+      every track, in the order of R's list of tracks.
+    """
+    files = find_tracking_files(directory)
+    if not files:
+        return pd.DataFrame(columns=['species', 'cell'] + list(COLUMNS.values()) + ['velocity', 'angular_velocity'])
+
+    def read(indexed_file):
+        index, (species, name, path) = indexed_file
+        df = pd.read_csv(path, usecols=list(COLUMNS)).rename(columns=COLUMNS)
+        df.insert(0, 'file', index)
+        return df
+
+    # The CSV parser spends most of its time outside the interpreter, so threads are enough
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = pd.concat(executor.map(read, enumerate(files)), ignore_index=True)
+
+    # split() in R orders the objects of a file by object number and keeps the row order within each object
+    frames = frames.sort_values(['file', 'object_number'], kind='stable', ignore_index=True)
+    new_track = np.ones(len(frames), dtype=bool)
+    new_track[1:] = ((frames['file'].to_numpy()[1:] != frames['file'].to_numpy()[:-1]) |
+                     (frames['object_number'].to_numpy()[1:] != frames['object_number'].to_numpy()[:-1]))
+    all_starts = np.flatnonzero(new_track)
+    all_lengths = np.diff(np.append(all_starts, len(frames)))
+
+    # The R names count every object of a file, kept or not
+    track_file = frames['file'].to_numpy()[all_starts]
+    first_of_file = np.flatnonzero(np.r_[True, track_file[1:] != track_file[:-1]])
+    object_index = np.arange(len(all_starts)) - np.repeat(first_of_file, np.diff(np.append(first_of_file,
+                                                                                          len(all_starts)))) + 1
+
+    keep = all_lengths > experiment_length_cutoff
+    tracks = frames[np.repeat(keep, all_lengths)].reset_index(drop=True)
+    lengths = all_lengths[keep]
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(int)
+
+    dx, dy = lagged_displacement(tracks, starts, lengths, lag)
+    velocity = box_smooth(np.sqrt(dx ** 2 + dy ** 2), starts, lengths, bandwidth)
+    angle = box_smooth(np.arctan2(dy, dx) * (180 / np.pi), starts, lengths, bandwidth)
+
+    species = np.array([species for species, name, path in files], dtype=object)
+    names = np.array([name for species, name, path in files], dtype=object)
+    kept_files = track_file[keep]
+    cell = [f"{name}-{h}" for name, h in zip(names[kept_files], object_index[keep])]
+
+    tracks.insert(0, 'species', np.repeat(species[kept_files], lengths))
+    tracks.insert(1, 'cell', np.repeat(np.array(cell, dtype=object), lengths))
+    tracks['velocity'] = velocity
+    tracks['angular_velocity'] = np.abs(angle)
+    return tracks.drop(columns='file')
+
+@instrumented('motility_tracks')
+def main():
+    """
+    Entry point of the script. Loads the tracks and saves them as a CSV or Parquet file.
+    """
+    parser = argparse.ArgumentParser(description='Load CellProfiler motility tracks with smoothed velocities.')
+    parser.add_argument('directory', help='Directory with one subdirectory per species, e.g. ../data/')
+    parser.add_argument('output', help='Output table, .csv or .parquet.')
+    parser.add_argument('--cutoff', type=int, default=200, help='Minimum number of rows of a track (exclusive).')
+    parser.add_argument('--workers', type=int, default=None, help='Threads reading the CSV files.')
+    args = parser.parse_args()
+
+    tracks = load_motility_tracks(args.directory, args.cutoff, workers=args.workers)
+    if args.output.endswith('.parquet'):
+        tracks.to_parquet(args.output, index=False)
+    else:
+        tracks.to_csv(args.output, index=False)
+    print(f"Saved {tracks['cell'].nunique()} tracks ({len(tracks)} rows) to {args.output}")
+
+# If this script is run directly, the main function is called
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,12 @@ import csv
 import re
 import numpy as np
 import sys
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented, setup_logging, stage
+
+logger = logging.getLogger(__name__)
 
 # Summary:
 # The script processes a set of images, identifies objects in them, calculates their centroids, and
@@ -44,6 +50,7 @@ def find_contours(image_path):
             centroids.append((cX, cY))
     return len(object_areas), object_areas, centroids
 
+@instrumented('object_trajectory_info')
 def main():
     """
     Entry point of the script. Orchestrates the image processing and data extraction.
@@ -55,25 +62,24 @@ def main():
     # Create or ensure debug image directory exists
     os.makedirs("experiments/debug_images", exist_ok=True)
 
-    # Start logging to a file
-    original_stdout = sys.stdout
-    with open('log.txt', 'a') as f:
-        sys.stdout = f
+    # Log all messages to log.txt, and only warnings and errors to the console
+    setup_logging('log.txt', console_level=logging.WARNING)
 
-        print("Starting to process images...")
+    logger.info("Starting to process images...")
 
-        output_rows = []
-        processed_rows = set()
-        total_rows = 0
+    output_rows = []
+    processed_rows = set()
+    total_rows = 0
 
-        # Walk through the image directory structure
-        for root, _, files in os.walk('./experiments/'):
-            path_parts = root.split(os.sep)
+    # Walk through the image directory structure
+    for root, _, files in os.walk('./experiments/'):
+        path_parts = root.split(os.sep)
 
-            # Check directory structure
-            if len(path_parts) == 6 and path_parts[3] == 'objects':
-                _, _, experiment, _, species, pool_ID = path_parts
-                print(f"Processing images in directory: {root}")
+        # Check directory structure
+        if len(path_parts) == 6 and path_parts[3] == 'objects':
+            _, _, experiment, _, species, pool_ID = path_parts
+            logger.info(f"Processing images in directory: {root}")
+            with stage('object_trajectory_info.directory', file=root, items=len(files)):
                 for file_name in files:
                     total_rows += 1
                     file_path = os.path.join(root, file_name)
@@ -83,7 +89,7 @@ def main():
                     seq_frame = re.search(r'_(\d+)\.tif', file_name).group(1) if re.search(r'_(\d+)\.tif', file_name) else 'NA'
                     row_key = (experiment, species, pool_ID, file_name, seq_number, seq_frame)
                     if row_key in processed_rows:
-                        print(f"Skipping duplicate row: {row_key}")
+                        logger.info(f"Skipping duplicate row: {row_key}")
                         continue
                     else:
                         processed_rows.add(row_key)
@@ -97,7 +103,7 @@ def main():
                     # Check for frame 0 as it's compared with frame 3
                     if seq_frame == "0":
                         if len(object_areas) == 0:
-                            print(f"No objects found in {file_path}. Skipping...")
+                            logger.info(f"No objects found in {file_path}. Skipping...")
                             continue
                         largest_object_index = np.argmax(object_areas)
 
@@ -125,20 +131,17 @@ def main():
                     for object_number, (object_area, (cX, cY)) in enumerate(zip(object_areas, centroids), start=1):
                         output_rows.append([experiment, species, pool_ID, file_name, seq_number, seq_frame, object_number, object_area, cX, cY, file_path, angles[object_number - 1] if angles else None])
 
-        # Sort the output rows by the 'file_path' column (index 10)
-        output_rows.sort(key=lambda x: x[10])
-
-        # Write the data to CSV
-        with open(csv_file_path, 'w', newline='') as csvfile:
-            csv_writer = csv.writer(csvfile)
-            csv_writer.writerow(['experiment', 'species', 'pool_ID', 'file_name', 'seq_number', 'seq_frame', 'object_number', 'object_area', 'centroid_x', 'centroid_y', 'file_path', 'angle'])
-            csv_writer.writerows(output_rows)
+    # Sort the output rows by the 'file_path' column (index 10)
+    output_rows.sort(key=lambda x: x[10])
 
-        print(f"Filtered out {total_rows - len(processed_rows)} duplicate entries out of {total_rows} total entries.")
-        print("Processing complete.")
+    # Write the data to CSV
+    with open(csv_file_path, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(['experiment', 'species', 'pool_ID', 'file_name', 'seq_number', 'seq_frame', 'object_number', 'object_area', 'centroid_x', 'centroid_y', 'file_path', 'angle'])
+        csv_writer.writerows(output_rows)
 
-    # Reset standard output to its original value
-    sys.stdout = original_stdout
+    logger.info(f"Filtered out {total_rows - len(processed_rows)} duplicate entries out of {total_rows} total entries.")
+    logger.info("Processing complete.")
 
 # Script entry point
 if __name__ == "__main__":
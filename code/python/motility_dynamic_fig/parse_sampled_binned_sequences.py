@@ -14,12 +14,17 @@ Outputs:
     A new CSV file containing the merged data from the two input CSV files.
 
 Entry Point:
-    The script starts its execution from the `if __name__ == '__main__':` block. It accepts command-line
+    The script starts its execution from the main() function. It accepts command-line
     arguments for the paths of the input and output files.
 """
 
 import pandas as pd
 import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import stage
 
 def filter_and_save_data(sampled_file, centroids_file, output_file):
     """
@@ -46,8 +51,10 @@ def filter_and_save_data(sampled_file, centroids_file, output_file):
     # Save the merged data to a new CSV file
     merged_data.to_csv(output_file, index=False)
 
-# Entry point of the script
-if __name__ == '__main__':
+def main():
+    """
+    Entry point of the script. Parses the command-line arguments and merges the input files.
+    """
     # Initialize argument parser
     parser = argparse.ArgumentParser(description='Merge CSV files based on given columns.')
     parser.add_argument('sampled_file', type=str, help='Path to the sampled data CSV file.')
@@ -57,5 +64,10 @@ if __name__ == '__main__':
     # Parse command-line arguments
     args = parser.parse_args()
 
-    # Call the merge function with the parsed arguments
-    filter_and_save_data(args.sampled_file, args.centroids_file, args.output_file)
+    with stage('parse_sampled_binned_sequences', file=args.sampled_file):
+        # Call the merge function with the parsed arguments
+        filter_and_save_data(args.sampled_file, args.centroids_file, args.output_file)
+
+# Entry point of the script
+if __name__ == '__main__':
+    main()
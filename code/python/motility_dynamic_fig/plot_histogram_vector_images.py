@@ -27,20 +27,28 @@ import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 import os
+import sys
 from itertools import groupby
 from operator import itemgetter
 
-# Logging setup
+# Logging setup; the log file is only opened by main, so importing this module writes nothing
 import logging
-logging.basicConfig(filename='script_log.txt', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented, setup_logging
+
+logger = logging.getLogger(__name__)
 
 def log(message):
     """Utility function to log messages to both the log file and stdout."""
-    logging.info(message)
-    print(message)
-
-def plot_histogram_of_bins(data):
-    """Plot a histogram displaying the frequency of bins by species for seq_frame=0."""
+    logger.info(message)
+
+def plot_histogram_of_bins(data, densities=None):
+    """
+    Plot a histogram displaying the frequency of bins by species for seq_frame=0.
+    densities optionally maps species to a 1D density over the bins, as a (bin axis, density) pair, e.g. the
+    axes[0] and evaluate() of a density_maps.py grid; each is drawn as a line scaled to the frequencies
+    (number of values times bar width).
+    """
     log("Entering plot_histogram_of_bins...")
     species_list = list(set(row['species'] for row in data))
     colors = ['magenta', 'cyan']  # Modify colors if more species are present
@@ -56,6 +64,12 @@ def plot_histogram_of_bins(data):
     for species, color in zip(species_list, colors):
         bins_data_for_species = [row['bin'] for row in data if row['species'] == species and row['seq_frame'] == 0]
         plt.hist(bins_data_for_species, bins=hist_bins, edgecolor="k", alpha=0.7, label=species, color=color)
+        if densities is not None and species in densities:
+            bin_axis, density = densities[species]
+            # A density scaled to counts is multiplied by the number of values and the width of the bars
+            bin_widths = np.diff(hist_bins)[np.clip(np.searchsorted(hist_bins, bin_axis) - 1, 0, len(hist_bins) - 2)]
+            plt.plot(bin_axis, np.asarray(density) * len(bins_data_for_species) * bin_widths, color=color,
+                     linewidth=2)
 
     plt.xticks(unique_bins)  # Set x-ticks to be the unique bin values
     plt.title("Frequency of Bins by Species for seq_frame = 0", color='white')
@@ -149,8 +163,10 @@ def plot_and_save_vectors(data, bin_categories, avg_velocities):
             plt.close()
     log("Exiting plot_and_save_vectors...")
 
+@instrumented('plot_histogram_vector_images')
 def main():
     """Main function to orchestrate the visualization tasks."""
+    setup_logging('script_log.txt')
     log("Entering main...")
     try:
         # Read the CSV
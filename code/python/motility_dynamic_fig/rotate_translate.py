@@ -2,9 +2,15 @@ import csv
 import cv2
 import os
 import sys
+import logging
 import numpy as np
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import setup_logging, stage
+
+logger = logging.getLogger(__name__)
+
 # Summary:
 # This script processes images based on data in a CSV file. It rotates, translates, and crops each image based on
 # the movement direction of a detected object. The processed images are then saved in new directories, ".../final_transformed_images/...".
@@ -57,14 +63,14 @@ def rotate_and_translate_images(group_data):
 
     # If no suitable anchor row is found, print an error message and exit this function
     if anchor_row is None:
-        print("No anchor object found.")
+        logger.info("No anchor object found.")
         return
 
     # Try to extract the rotation angle from the anchor row
     try:
         angle_from_csv = float(anchor_row['angle'])
     except ValueError:
-        print(f"Could not convert angle to float: {anchor_row['angle']}")
+        logger.info(f"Could not convert angle to float: {anchor_row['angle']}")
         return
 
     # Calculate the actual rotation angle based on the extracted value
@@ -110,23 +116,20 @@ def main():
     # Define the path to the input CSV file
     csv_file_path = "experiments/image_data_with_upward_angles.csv"
 
-    # Begin logging all print statements to a file named 'log.txt'
-    original_stdout = sys.stdout
-    with open('log.txt', 'a') as f:
-        sys.stdout = f
+    # Log all messages to log.txt, and only warnings and errors to the console
+    setup_logging('log.txt', console_level=logging.WARNING)
 
-        print("Reading CSV data...")
+    with stage('rotate_translate', file=csv_file_path) as record:
+        logger.info("Reading CSV data...")
         data = read_csv(csv_file_path)
 
-        print("Starting to process images...")
+        logger.info("Starting to process images...")
         for key, group_data in data.items():
-            print(f"Processing group: {key}")
+            logger.info(f"Processing group: {key}")
             rotate_and_translate_images(group_data)
+        record['items'] = sum(len(group_data) for group_data in data.values())
 
-        print("Processing complete.")
-
-    # After logging is done, reset the standard output to its original state
-    sys.stdout = original_stdout
+    logger.info("Processing complete.")
 
 # If this script is run directly, the main function is called
 if __name__ == "__main__":
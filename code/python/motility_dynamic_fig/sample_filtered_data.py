@@ -18,6 +18,11 @@ Entry Point:
 import csv
 import random
 from collections import defaultdict
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import stage
 
 def sample_csv_by_experiment_and_species(input_csv_path, output_csv_path):
     """
@@ -64,5 +69,6 @@ if __name__ == "__main__":
     input_path = 'experiments/filtered_unbinned_data.csv'
     output_path = 'experiments/sampled_unbinned_data.csv'
 
-    # Call the sampling function with the defined paths
-    sample_csv_by_experiment_and_species(input_path, output_path)
+    with stage('sample_filtered_data', file=input_path):
+        # Call the sampling function with the defined paths
+        sample_csv_by_experiment_and_species(input_path, output_path)
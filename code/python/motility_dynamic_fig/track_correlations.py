@@ -0,0 +1,229 @@
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import instrumented
+
+# Summary:
+# This script computes the autocorrelation functions of the velocity and angular velocity of all tracks at once, and
+# joint histograms of two measurements at a range of lags, aggregated per species (or experiment), as in
+# code/R/autocorrelation_and_joint_velocity_distribution_analyses.ipynb. It works on a table with one row per frame
+# of every track, e.g. the tracks of motility_tracks.py or centroids_displacements.csv of
+# angular_linear_displacement.py.
+# The ragged tracks are padded into one (tracks x frames) array with a mask of the frames that have a value. The
+# lagged products of every track are summed by FFT of the zero-padded rows, and the masks by FFT too, so pairs with
+# a missing frame never count and no pair crosses from one track into the next. The joint histograms of all lags
+# and groups are counted with one bincount.
+
+def pad_tracks(df, track_columns, value_columns, order_column=None):
+    """
+    Pad the ragged tracks of a table into arrays.
+
+    Input:
+    - df (DataFrame): One row per frame of every track.
+    - track_columns (list): Columns that identify a track, e.g. ['cell'] or
+      ['experiment', 'species', 'pool_ID', 'seq_number'].
+    - value_columns (list): Measurements to pad.
+    - order_column (str): Column giving the order of the frames in a track; without it, the table order is kept.
+    Output:
+    - dict with values (measurements x tracks x frames, 0 where missing), mask (same shape, True where a value is
+      present), lengths (frames per track) and keys (DataFrame with the track columns of every track).
+    """
+    track = df.groupby(track_columns, sort=True).ngroup().to_numpy()
+    order = np.lexsort((df[order_column].to_numpy(),) + (track,)) if order_column else \
+        np.argsort(track, kind='stable')
+    track = track[order]
+    n_tracks = track.max() + 1 if len(track) else 0
+    lengths = np.bincount(track, minlength=n_tracks)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    position = np.arange(len(track)) - starts[track]
+
+    values = np.zeros((len(value_columns), n_tracks, lengths.max() if n_tracks else 0))
+    mask = np.zeros(values.shape, dtype=bool)
+    for k, column in enumerate(value_columns):
+        column_values = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)[order]
+        present = ~np.isnan(column_values)
+        values[k, track[present], position[present]] = column_values[present]
+        mask[k, track[present], position[present]] = True
+
+    first_rows = order[starts]
+    keys = df.iloc[first_rows][track_columns].reset_index(drop=True)
+    return {'values': values, 'mask': mask, 'lengths': lengths, 'keys': keys}
+
+def acf(x, max_lag=100):
+    """
+    Autocorrelation of one series by FFT, as R's acf(x, lag.max) computes it (for lags 0 .. max_lag).
+    """
+    x = np.asarray(x, dtype=float)
+    x = x - x.mean()
+    n_fft = 1 << int(np.ceil(np.log2(2 * len(x) - 1)))
+    spectrum = np.fft.rfft(x, n_fft)
+    autocovariance = np.fft.irfft(spectrum * np.conj(spectrum), n_fft)[:min(max_lag, len(x) - 1) + 1]
+    return autocovariance / autocovariance[0]
+
+def lagged_sums(values, mask, max_lag=100, chunk_size=None):
+    """
+    Sums of lagged products and numbers of lagged pairs of every padded track, by FFT.
+
+    Input:
+    - values, mask (tracks x frames arrays): Padded (and centred) values; masked values are ignored.
+    Output:
+    - products, pairs (tracks x (max_lag + 1) arrays): sum over t of x[t] * x[t + lag] and the number of such pairs
+      with both frames present.
+    """
+    n_tracks, n_frames = values.shape
+    n_fft = 1 << int(np.ceil(np.log2(max(n_frames + max_lag, 1))))
+    chunk_size = chunk_size or max(1, 20_000_000 // n_fft)
+    lags = min(max_lag, max(n_frames - 1, 0)) + 1
+    products = np.zeros((n_tracks, max_lag + 1))
+    pairs = np.zeros((n_tracks, max_lag + 1))
+    for start in range(0, n_tracks, chunk_size):
+        stop = min(start + chunk_size, n_tracks)
+        for source, target in ((np.where(mask[start:stop], values[start:stop], 0.0), products),
+                               (mask[start:stop].astype(float), pairs)):
+            spectrum = np.fft.rfft(source, n_fft, axis=1)
+            target[start:stop, :lags] = np.fft.irfft(spectrum * np.conj(spectrum), n_fft, axis=1)[:, :lags]
+    # Pair counts are integers; FFT round-off is removed
+    return products, np.rint(pairs)
+
+def track_autocorrelation(df, columns=('velocity', 'angular_velocity'), track_columns=('cell',), order_column=None,
+                          by=('species',), max_lag=100, center="group", normalize="biased"):
+    """
+    Autocorrelation functions of every track and pooled per group, for every measurement.
+
+    Input:
+    - columns (sequence): Measurements to correlate.
+    - by (sequence): Columns grouping the tracks, e.g. ('species',) or ('experiment', 'species').
+    - center (str): Subtract the mean of the group ("group"), as acf does on the concatenated tracks of a species
+      in the notebook, or of every track ("track").
+    - normalize (str): "biased" divides the lagged sums by the sum at lag 0, as R's acf does; "pairs" divides
+      each lag by its number of pairs first.
+    Output:
+    - dict with lags, keys (DataFrame of track and group columns per track), track (measurements x tracks x lags)
+      and pooled (long DataFrame with the group columns, measurement, lag, acf and pairs).
+    """
+    columns, track_columns, by = list(columns), list(track_columns), list(by)
+    padded = pad_tracks(df, track_columns + [column for column in by if column not in track_columns], columns,
+                        order_column)
+    keys = padded['keys']
+    group = keys.groupby(by, sort=True).ngroup().to_numpy() if by else np.zeros(len(keys), dtype=int)
+    group_keys = keys[by].drop_duplicates().sort_values(by).reset_index(drop=True) if by else pd.DataFrame(index=[0])
+    n_groups = group.max() + 1 if len(group) else 0
+
+    track_acfs = []
+    pooled = []
+    for k, column in enumerate(columns):
+        values, mask = padded['values'][k], padded['mask'][k]
+        totals = (values * mask).sum(axis=1)
+        counts = mask.sum(axis=1)
+        if center == "track":
+            means = totals / np.maximum(counts, 1)
+        else:
+            means = (np.bincount(group, totals, minlength=n_groups) /
+                     np.maximum(np.bincount(group, counts, minlength=n_groups), 1))[group]
+        products, pairs = lagged_sums(values - means[:, None], mask, max_lag)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if normalize == "pairs":
+                track_acfs.append((products / pairs) / (products[:, :1] / pairs[:, :1]))
+            else:
+                track_acfs.append(products / products[:, :1])
+            # Pooled per group: lagged sums of all tracks of a group added up before normalizing
+            group_products = np.zeros((n_groups, max_lag + 1))
+            group_pairs = np.zeros((n_groups, max_lag + 1))
+            np.add.at(group_products, group, products)
+            np.add.at(group_pairs, group, pairs)
+            if normalize == "pairs":
+                group_acf = (group_products / group_pairs) / (group_products[:, :1] / group_pairs[:, :1])
+            else:
+                group_acf = group_products / group_products[:, :1]
+
+        table = group_keys.loc[np.repeat(np.arange(n_groups), max_lag + 1)].reset_index(drop=True)
+        table['measurement'] = column
+        table['lag'] = np.tile(np.arange(max_lag + 1), n_groups)
+        table['acf'] = group_acf.ravel()
+        table['pairs'] = group_pairs.ravel().astype(int)
+        pooled.append(table)
+
+    return {'lags': np.arange(max_lag + 1), 'keys': keys, 'track': np.array(track_acfs),
+            'pooled': pd.concat(pooled, ignore_index=True)}
+
+def joint_histograms(df, x='velocity', y='angular_velocity', lags=(0,), track_columns=('cell',), order_column=None,
+                     by=('species',), bins=(70, 100), lims=(0, 140, 0, 200)):
+    """
+    Joint histograms of x at every frame and y lag frames later in the same track, per group and lag.
+
+    Output:
+    - dict with counts (groups x lags x bins of x x bins of y), x_edges, y_edges, lags and groups (DataFrame of the
+      group columns of every group).
+    """
+    track_columns, by = list(track_columns), list(by)
+    padded = pad_tracks(df, track_columns + [column for column in by if column not in track_columns], [x, y],
+                        order_column)
+    keys = padded['keys']
+    group = keys.groupby(by, sort=True).ngroup().to_numpy() if by else np.zeros(len(keys), dtype=int)
+    group_keys = keys[by].drop_duplicates().sort_values(by).reset_index(drop=True) if by else pd.DataFrame(index=[0])
+    n_groups = group.max() + 1 if len(group) else 0
+
+    x_edges = np.linspace(lims[0], lims[1], bins[0] + 1)
+    y_edges = np.linspace(lims[2], lims[3], bins[1] + 1)
+    (x_values, y_values), (x_mask, y_mask) = padded['values'], padded['mask']
+    # Bin of every frame, -1 where missing or outside the limits
+    x_bins = np.where(x_mask, np.searchsorted(x_edges, x_values, side='right') - 1, -1)
+    x_bins[(x_bins >= bins[0]) & (x_values == x_edges[-1])] = bins[0] - 1
+    x_bins[x_bins >= bins[0]] = -1
+    y_bins = np.where(y_mask, np.searchsorted(y_edges, y_values, side='right') - 1, -1)
+    y_bins[(y_bins >= bins[1]) & (y_values == y_edges[-1])] = bins[1] - 1
+    y_bins[y_bins >= bins[1]] = -1
+
+    # One combined index of group, lag, x bin and y bin for every pair of frames, counted in one bincount
+    indices = []
+    n_frames = x_bins.shape[1]
+    for lag_index, lag in enumerate(lags):
+        # Lags as long as the longest track have no pairs
+        first, second = x_bins[:, :max(n_frames - lag, 0)], y_bins[:, lag:]
+        valid = (first >= 0) & (second >= 0)
+        rows = np.nonzero(valid)[0]
+        indices.append(((group[rows] * len(lags) + lag_index) * bins[0] + first[valid]) * bins[1] + second[valid])
+    size = n_groups * len(lags) * bins[0] * bins[1]
+    counts = np.bincount(np.concatenate(indices) if indices else np.array([], dtype=int), minlength=size)
+    return {'counts': counts.reshape(n_groups, len(lags), bins[0], bins[1]), 'x_edges': x_edges,
+            'y_edges': y_edges, 'lags': np.asarray(lags), 'groups': group_keys}
+
+@instrumented('track_correlations')
+def main():
+    """
+    Entry point of the script. Computes the pooled autocorrelations and lagged joint histograms of a track table.
+    """
+    parser = argparse.ArgumentParser(description='Autocorrelations and lagged joint histograms of motility tracks.')
+    parser.add_argument('tracks', help='Table with one row per frame of every track (.csv or .parquet).')
+    parser.add_argument('output_directory', help='Where autocorrelation.csv and joint_histograms.npz are saved.')
+    parser.add_argument('--track-columns', nargs='+', default=['cell'], help='Columns identifying a track.')
+    parser.add_argument('--order', default=None, help='Column ordering the frames of a track.')
+    parser.add_argument('--by', nargs='+', default=['species'], help='Columns grouping the tracks.')
+    parser.add_argument('--columns', nargs='+', default=['velocity', 'angular_velocity'],
+                        help='Measurements to correlate; the first two are used for the joint histograms.')
+    parser.add_argument('--max-lag', type=int, default=100, help='Largest lag of the autocorrelations.')
+    parser.add_argument('--lags', type=int, nargs='+', default=[0, 10, 20, 50, 100],
+                        help='Lags of the joint histograms.')
+    args = parser.parse_args()
+
+    tracks = pd.read_parquet(args.tracks) if args.tracks.endswith('.parquet') else pd.read_csv(args.tracks)
+    os.makedirs(args.output_directory, exist_ok=True)
+    correlations = track_autocorrelation(tracks, args.columns, args.track_columns, args.order, args.by, args.max_lag)
+    correlations['pooled'].to_csv(os.path.join(args.output_directory, 'autocorrelation.csv'), index=False)
+
+    histograms = joint_histograms(tracks, args.columns[0], args.columns[1], args.lags, args.track_columns,
+                                  args.order, args.by)
+    np.savez_compressed(os.path.join(args.output_directory, 'joint_histograms.npz'), counts=histograms['counts'],
+                        x_edges=histograms['x_edges'], y_edges=histograms['y_edges'], lags=histograms['lags'],
+                        groups=histograms['groups'].astype(str).to_numpy())
+    print(f"Saved autocorrelations of {len(correlations['keys'])} tracks and joint histograms of "
+          f"{len(histograms['groups'])} groups to {args.output_directory}")
+
+# If this script is run directly, the main function is called
+if __name__ == "__main__":
+    main()